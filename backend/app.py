@@ -15,6 +15,10 @@ from flask import Flask, send_from_directory, send_file, jsonify, request, Respo
 from flask_cors import CORS
 from database.db import Database
 from utils.email import EmailBatchProcessor, OutlookMailHandler
+from utils.email import http_session
+from utils.email.token_cache import token_cache
+from utils.email.job_queue import JOB_BACKFILL, JOB_ATTACHMENT
+from utils.email.graph_throttle import governor as graph_governor
 import requests
 import msal
 from ws_server.handler import WebSocketHandler
@@ -87,6 +91,8 @@ if not OUTLOOK_DEVICE_SCOPES:
 elif set(s.lower() for s in OUTLOOK_DEVICE_SCOPES) != set(s.lower() for s in _raw_outlook_scopes.split()):
     logger.info(f"Outlook device flow: filtered reserved scopes, effective scopes={OUTLOOK_DEVICE_SCOPES}")
 OUTLOOK_DEVICE_FLOW_CACHE_TTL = int(os.environ.get('OUTLOOK_DEVICE_FLOW_CACHE_TTL', '1800'))
+# 为 0 时实时检查、任务队列和令牌预刷新由独立的 worker.py 进程执行，Web 进程只处理 API
+SYNC_IN_PROCESS = os.environ.get('SYNC_IN_PROCESS', '1').strip().lower() not in ('0', 'false', 'no')
 _OUTLOOK_DEVICE_FLOW_LOCK = threading.Lock()
 _OUTLOOK_DEVICE_FLOWS = {}
 
@@ -110,6 +116,8 @@ email_processor = EmailBatchProcessor(db)
 # 初始化WebSocket处理器
 ws_handler = WebSocketHandler()
 ws_handler.set_dependencies(db, email_processor)
+# 检查任务的进度和结果推送给任务所属用户
+email_processor.check_jobs.add_listener(ws_handler.send_to_user_threadsafe)
 
 
 def _purge_expired_outlook_device_flows():
@@ -472,6 +480,11 @@ def get_all_emails(current_user):
         email_dict['unread_count'] = db.get_unread_count(email_dict['id'])
         emails_list.append(email_dict)
 
+    # 熔断中的邮箱附带原因和恢复时间，未熔断的为 None
+    circuits = email_processor.circuit_breakers.status_for(emails_list)
+    for email_dict in emails_list:
+        email_dict['circuit'] = circuits.get(email_dict['id'])
+
     return jsonify(emails_list)
 
 @app.route('/api/emails', methods=['POST'])
@@ -603,38 +616,16 @@ def check_email(current_user, email_id):
                 'status': 'processing'
             }), 409
 
-        # 创建进度回调
-        def progress_callback(progress, message):
-            logger.info(f"邮箱 ID {email_id} 处理进度: {progress}%, 消息: {message}")
-            # 通过WebSocket发送进度更新
-            try:
-                # 使用日志记录进度，不尝试调用异步方法
-                logger.info(f"向用户 {current_user['id']} 发送邮箱检查进度: {progress}%, {message}")
-                # 这里应使用同步方式发送消息，但WSHandler.broadcast_to_user是异步方法
-            except Exception as e:
-                logger.error(f"发送进度更新失败: {str(e)}")
-
-        # 提交任务到线程池
-        future = email_processor.manual_thread_pool.submit(
-            email_processor._check_email_task,
-            email_info,
-            progress_callback
-        )
-
-        # 等待任务完成
-        result = future.result(timeout=300)  # 设置超时时间为5分钟
-
-        # 记录任务完成
-        logger.info(f"任务完成: {result}")
+        # 不等待同步结束，进度通过 WebSocket 推送，结果通过 /api/check_jobs/<job_id> 查询
+        job = email_processor.start_check_job(current_user['id'], [email_id])
+        logger.info(f"邮箱 ID {email_id} 检查任务已提交: {job['id']}")
 
-        return jsonify(result)
-
-    except concurrent.futures.TimeoutError:
-        logger.error(f"检查邮箱超时: {email_id}")
         return jsonify({
-            'success': False,
-            'message': '检查邮箱超时，请稍后再试'
-        }), 408
+            'success': True,
+            'message': '已开始检查邮箱',
+            'job_id': job['id'],
+            'status': job['status']
+        }), 202
 
     except Exception as e:
         logger.error(f"检查邮箱失败: {str(e)}")
@@ -694,18 +685,24 @@ def batch_check_emails(current_user):
     valid_emails = [db.get_email_by_id(email_id)['email'] for email_id in valid_ids if db.get_email_by_id(email_id)]
     logger.info(f"批量检查开始处理 {len(valid_ids)} 个邮箱: {valid_emails} (用户ID: {current_user['id']})")
 
-    # 自定义进度回调
-    def progress_callback(email_id, progress, message):
-        logger.info(f"邮箱 ID {email_id} 处理进度: {progress}%, 消息: {message}")
-
-    # 启动邮件检查线程
-    email_processor.check_emails(valid_ids, progress_callback)
+    # 一个汇总任务跟踪所有邮箱的子结果
+    job = email_processor.start_check_job(current_user['id'], valid_ids, 'batch')
 
     return jsonify({
         'message': f'开始检查 {len(valid_ids)} 个邮箱',
+        'job_id': job['id'],
         'skipped': len(processing_ids),
         'total': len(email_ids)
-    })
+    }), 202
+
+@app.route('/api/check_jobs/<job_id>', methods=['GET'])
+@token_required
+def get_check_job(current_user, job_id):
+    """查询检查任务的状态和各邮箱的结果"""
+    job = email_processor.check_jobs.get(job_id)
+    if not job or (job['user_id'] != current_user['id'] and not current_user['is_admin']):
+        return jsonify({'error': '检查任务不存在或已过期'}), 404
+    return jsonify(job)
 
 @app.route('/api/emails/<int:email_id>/mail_records', methods=['GET'])
 @token_required
@@ -716,6 +713,9 @@ def get_mail_records(current_user, email_id):
     if not email_info:
         return jsonify({'error': f'邮箱 ID {email_id} 不存在或您没有权限'}), 404
 
+    # 用户打开了该邮箱，实时检查优先轮询
+    email_processor.mark_active(email_id)
+
     page = request.args.get('page', type=int)
     page_size = request.args.get('page_size', type=int)
 
@@ -845,13 +845,15 @@ def mark_mail_read(current_user, mail_id):
             if graph_message_id and refresh_token and client_id:
                 sync_attempted = True
                 try:
-                    access_token = OutlookMailHandler.get_new_access_token(refresh_token, client_id)
+                    access_token = token_cache.get_access_token(db, email_info)
                     if not access_token:
                         sync_error = '获取Access Token失败'
                     else:
                         OutlookMailHandler.mark_message_read(access_token, graph_message_id, True)
                         sync_success = True
                 except requests.exceptions.HTTPError as e:
+                    if getattr(e.response, 'status_code', None) == 401:
+                        token_cache.invalidate(email_info['id'], access_token)
                     sync_error = str(e)
                 except Exception as e:
                     sync_error = str(e)
@@ -878,6 +880,107 @@ def mark_mail_read(current_user, mail_id):
         logger.error(f"同步邮件已读状态失败: {str(e)}")
         return jsonify({'error': f'服务端错误: {str(e)}'}), 500
 
+@app.route('/api/mail_records/batch_mark_read', methods=['POST'])
+@token_required
+def batch_mark_mail_read(current_user):
+    """批量标记邮件已读/未读（本地优先，Outlook 通过 Graph $batch 尽力同步）"""
+    try:
+        data = request.json or {}
+        mail_ids = data.get('mail_ids') or []
+        if not isinstance(mail_ids, list) or not mail_ids:
+            return jsonify({'error': 'mail_ids不能为空'}), 400
+        is_read = bool(data.get('is_read', True))
+
+        normalized_ids = []
+        seen = set()
+        for item in mail_ids:
+            try:
+                mid = int(item)
+            except Exception:
+                continue
+            if mid > 0 and mid not in seen:
+                seen.add(mid)
+                normalized_ids.append(mid)
+
+        if not normalized_ids:
+            return jsonify({'error': 'mail_ids无有效ID'}), 400
+
+        failed = []
+        allowed_ids = []
+        email_infos = {}
+        outlook_batches = {}  # email_id -> list[{mail_id, graph_message_id}]
+
+        for mail_id in normalized_ids:
+            mail_record = db.get_mail_record_by_id(mail_id)
+            if not mail_record:
+                failed.append({'id': mail_id, 'error': '邮件不存在'})
+                continue
+
+            email_info = email_infos.get(mail_record['email_id'])
+            if email_info is None:
+                email_info = db.get_email_by_id(
+                    mail_record['email_id'],
+                    None if current_user['is_admin'] else current_user['id']
+                )
+                email_infos[mail_record['email_id']] = email_info
+            if not email_info:
+                failed.append({'id': mail_id, 'error': '无权限访问此邮件'})
+                continue
+
+            allowed_ids.append(mail_id)
+            graph_message_id = (mail_record.get('graph_message_id') or '').strip()
+            if email_info.get('mail_type') == 'outlook' and graph_message_id:
+                outlook_batches.setdefault(int(email_info['id']), []).append({
+                    'mail_id': mail_id,
+                    'graph_message_id': graph_message_id
+                })
+
+        # 先写本地，保证用户侧状态稳定可用
+        updated = db.set_mail_read_status_batch(allowed_ids, is_read)
+        if allowed_ids and updated <= 0:
+            return jsonify({'error': '本地更新已读状态失败'}), 500
+
+        synced_ids = []
+        sync_failed = []
+        for email_id, items in outlook_batches.items():
+            email_info = email_infos[email_id]
+            try:
+                access_token = token_cache.get_access_token(db, email_info)
+                if not access_token:
+                    sync_failed.extend({'id': it['mail_id'], 'error': '获取Access Token失败'} for it in items)
+                    continue
+                result = OutlookMailHandler.mark_messages_read_batch(
+                    access_token,
+                    [it['graph_message_id'] for it in items],
+                    is_read
+                )
+                failed_by_message_id = {str(x.get('message_id')): x for x in (result.get('failed') or [])}
+                for it in items:
+                    failure = failed_by_message_id.get(it['graph_message_id'])
+                    if failure:
+                        if failure.get('status') == 401:
+                            token_cache.invalidate(email_id, access_token)
+                        sync_failed.append({'id': it['mail_id'], 'error': f"服务端同步失败(HTTP {failure.get('status')})"})
+                    else:
+                        synced_ids.append(it['mail_id'])
+            except Exception as e:
+                sync_failed.extend({'id': it['mail_id'], 'error': f'服务端同步异常: {str(e)}'} for it in items)
+
+        if sync_failed:
+            logger.warning(f"批量已读服务端同步部分失败（已回退本地成功）: {len(sync_failed)} 封")
+
+        return jsonify({
+            'success': True,
+            'message': f"已本地标记 {len(allowed_ids)} 封邮件为{'已读' if is_read else '未读'}",
+            'success_ids': allowed_ids,
+            'synced_ids': synced_ids,
+            'sync_failed': sync_failed,
+            'failed': failed
+        }), 200
+    except Exception as e:
+        logger.error(f"批量标记已读失败: {str(e)}")
+        return jsonify({'error': f'服务端错误: {str(e)}'}), 500
+
 @app.route('/api/mail_records/<int:mail_id>/tag', methods=['POST'])
 @token_required
 def set_mail_tag(current_user, mail_id):
@@ -958,7 +1061,7 @@ def send_mail(current_user, email_id):
         if not to_list:
             return jsonify({'error': '收件人不能为空'}), 400
 
-        access_token = OutlookMailHandler.get_new_access_token(email_info.get('refresh_token'), email_info.get('client_id'))
+        access_token = token_cache.get_access_token(db, email_info)
         if not access_token:
             return jsonify({'error': '获取Access Token失败'}), 500
 
@@ -1032,7 +1135,7 @@ def reply_mail(current_user, mail_id):
         if not graph_message_id:
             return jsonify({'error': '缺少Graph消息ID，无法执行原生回复'}), 400
 
-        access_token = OutlookMailHandler.get_new_access_token(email_info.get('refresh_token'), email_info.get('client_id'))
+        access_token = token_cache.get_access_token(db, email_info)
         if not access_token:
             return jsonify({'error': '获取Access Token失败'}), 500
 
@@ -1070,6 +1173,28 @@ def reply_mail(current_user, mail_id):
         logger.error(f"回复邮件失败: {str(e)}")
         return jsonify({'error': f'服务端错误: {str(e)}'}), 500
 
+@app.route('/api/mail_records/<int:mail_id>', methods=['GET'])
+@token_required
+def get_mail_record(current_user, mail_id):
+    """获取单封邮件，只同步了摘要的邮件首次打开时获取完整正文"""
+    mail_record = db.get_mail_record_by_id(mail_id)
+    if not mail_record:
+        return jsonify({'error': '邮件不存在'}), 404
+
+    email_info = db.get_email_by_id(mail_record['email_id'], None if current_user['is_admin'] else current_user['id'])
+    if not email_info:
+        return jsonify({'error': '无权限访问此邮件'}), 403
+
+    if not mail_record.get('body_loaded', 1):
+        try:
+            mail_record['content'] = email_processor.load_mail_body(mail_record, email_info)
+            mail_record['body_loaded'] = 1
+        except Exception as e:
+            # 获取失败时仍返回摘要
+            logger.warning(f"获取邮件正文失败: mail_id={mail_id}, {str(e)}")
+
+    return jsonify(mail_record)
+
 @app.route('/api/mail_records/<int:mail_id>', methods=['DELETE'])
 @token_required
 def delete_mail_record(current_user, mail_id):
@@ -1086,7 +1211,7 @@ def delete_mail_record(current_user, mail_id):
         remote_delete_warning = None
         # Outlook/Graph: 先尝试删除远端，再删除本地
         if email_info.get('mail_type') == 'outlook' and mail_record.get('graph_message_id'):
-            access_token = OutlookMailHandler.get_new_access_token(email_info.get('refresh_token'), email_info.get('client_id'))
+            access_token = token_cache.get_access_token(db, email_info)
             if not access_token:
                 return jsonify({'error': '获取Access Token失败'}), 500
             try:
@@ -1094,6 +1219,8 @@ def delete_mail_record(current_user, mail_id):
             except requests.exceptions.HTTPError as http_err:
                 status = getattr(http_err.response, 'status_code', None)
                 # 常见场景：缺少 Mail.ReadWrite，远端无删除权限。此时允许仅删除本地记录。
+                if status == 401:
+                    token_cache.invalidate(email_info['id'], access_token)
                 if status in (401, 403):
                     remote_delete_warning = '远端删除失败（权限不足），已仅删除本地记录。请给应用补充 Mail.ReadWrite 权限。'
                     logger.warning(f"远端删除邮件失败(HTTP {status})，降级为仅本地删除: mail_id={mail_id}")
@@ -1137,8 +1264,6 @@ def batch_delete_mail_records(current_user):
 
         success_ids = []
         failed = []
-        token_cache = {}
-
         mail_records = {}
         email_infos = {}
         outlook_batches = {}  # email_id -> list[{mail_id, graph_message_id}]
@@ -1169,19 +1294,12 @@ def batch_delete_mail_records(current_user):
         remote_failed_mail_ids = set()
         for email_id, items in outlook_batches.items():
             try:
-                access_token = token_cache.get(email_id)
+                access_token = token_cache.get_access_token(db, email_infos[email_id])
                 if not access_token:
-                    info = email_infos.get(email_id) or {}
-                    access_token = OutlookMailHandler.get_new_access_token(
-                        info.get('refresh_token'),
-                        info.get('client_id')
-                    )
-                    if not access_token:
-                        for it in items:
-                            failed.append({'id': it['mail_id'], 'error': '获取Access Token失败'})
-                            remote_failed_mail_ids.add(it['mail_id'])
-                        continue
-                    token_cache[email_id] = access_token
+                    for it in items:
+                        failed.append({'id': it['mail_id'], 'error': '获取Access Token失败'})
+                        remote_failed_mail_ids.add(it['mail_id'])
+                    continue
 
                 graph_ids = [it['graph_message_id'] for it in items if it.get('graph_message_id')]
                 result = OutlookMailHandler.delete_messages_batch(access_token, graph_ids)
@@ -1257,6 +1375,22 @@ def download_attachment(current_user, attachment_id):
         if not email_info:
             return jsonify({'error': '无权下载此附件'}), 403
 
+        # 同步时只记录了元数据的附件，首次下载时从邮件服务器获取并缓存
+        if not attachment['file_path'] and attachment['content'] is None and attachment['remote_ref']:
+            try:
+                attachment = email_processor.materialize_attachment(attachment_id, email_info)
+            except Exception as e:
+                logger.error(f"从服务器获取附件失败: {str(e)}")
+                # 放入持久化队列在后台重试，成功后再次下载直接读取本地缓存
+                job_id = email_processor.enqueue_job(
+                    email_id, JOB_ATTACHMENT, payload={'attachment_id': attachment_id},
+                    dedup_key=f'attachment:{attachment_id}'
+                )
+                return jsonify({
+                    'error': f'从服务器获取附件失败: {str(e)}',
+                    'retry_job_id': job_id,
+                }), 502
+
         # 准备下载响应
         filename = attachment['filename']
         content_type = attachment['content_type']
@@ -1510,10 +1644,12 @@ def recheck_email_all(current_user, email_id):
         if email_info['user_id'] != current_user['id'] and not current_user['is_admin']:
             return jsonify({'error': '无权操作此邮箱'}), 403
 
-        db.reset_check_time(email_id)
-        email_processor.check_emails([email_id])
+        # 全量拉取耗时较长，放入持久化队列，服务重启后继续
+        job_id = email_processor.enqueue_job(email_id, JOB_BACKFILL)
+        if job_id is None:
+            return jsonify({'error': '添加全量拉取任务失败'}), 500
 
-        return jsonify({'success': True, 'message': '已触发重新全量拉取'}), 200
+        return jsonify({'success': True, 'message': '已触发重新全量拉取', 'job_id': job_id}), 200
     except Exception as e:
         logger.error(f"重新全量拉取失败: {str(e)}")
         return jsonify({'error': f'服务端错误: {str(e)}'}), 500
@@ -1629,7 +1765,7 @@ def outlook_device_token(current_user):
             'device_code': device_code,
             'grant_type': 'urn:ietf:params:oauth:grant-type:device_code'
         }
-        response = requests.post(url, data=payload, timeout=30)
+        response = http_session.post(url, data=payload, timeout=30)
         return jsonify(response.json()), response.status_code
     except Exception as e:
         logger.error(f"获取Token失败: {str(e)}")
@@ -1651,6 +1787,45 @@ def toggle_registration(current_user):
     else:
         return jsonify({'error': '更新注册配置失败'}), 500
 
+@app.route('/api/graph/notifications', methods=['POST'])
+def graph_notifications():
+    """接收 Microsoft Graph 变更通知（订阅地址由 GRAPH_WEBHOOK_URL 配置）"""
+    # 创建订阅时 Graph 会先发送验证请求，需原样返回 validationToken
+    validation_token = request.args.get('validationToken')
+    if validation_token is not None:
+        return Response(validation_token, status=200, mimetype='text/plain')
+
+    payload = request.get_json(silent=True) or {}
+    accepted = email_processor.graph_subscriptions.handle_notifications(payload)
+    return jsonify({'accepted': accepted}), 202
+
+@app.route('/api/admin/graph/throttle', methods=['GET'])
+@token_required
+@admin_required
+def get_graph_throttle_metrics(current_user):
+    """查看 Microsoft Graph 全局限流状态"""
+    return jsonify({'clients': graph_governor.metrics()})
+
+@app.route('/api/admin/sync_jobs', methods=['GET'])
+@token_required
+@admin_required
+def get_sync_job_stats(current_user):
+    """查看持久化同步任务队列状态"""
+    return jsonify({
+        'jobs': db.get_sync_job_stats(),
+        'worker': {
+            'owner': email_processor.job_queue.owner,
+            'running': email_processor.job_worker.is_running,
+            'active_jobs': email_processor.job_worker.running_count(),
+        },
+        # 各服务商通道的排队和执行数
+        'lanes': {
+            'jobs': email_processor.job_lanes.stats(),
+            'manual': email_processor.manual_thread_pool.stats(),
+        },
+        'realtime': email_processor.real_time_checker.get_runtime_status(),
+    })
+
 # 前端静态文件服务
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -1778,6 +1953,12 @@ def update_email(current_user, email_id):
                 update_data['port'] = data.get('port')
             if data.get('use_ssl') is not None:
                 update_data['use_ssl'] = data.get('use_ssl')
+            if data.get('imap_folders') is not None:
+                # 需要同步的文件夹列表，逗号分隔；留空表示默认文件夹
+                folders = data.get('imap_folders')
+                if isinstance(folders, list):
+                    folders = ','.join(str(f).strip() for f in folders if str(f).strip())
+                update_data['imap_folders'] = folders or None
 
         # 更新邮箱信息
         success = db.update_email(
@@ -1809,6 +1990,12 @@ def update_email(current_user, email_id):
 def start_real_time_check():
     """启动实时邮件检查"""
     try:
+        if not SYNC_IN_PROCESS:
+            return jsonify({
+                'success': False,
+                'message': '实时邮件检查由独立同步进程执行，请在 worker 进程中配置'
+            })
+
         check_interval = request.json.get('check_interval', 300)
         if check_interval < 30:  # 最小检查间隔为30秒
             check_interval = 30
@@ -1856,7 +2043,7 @@ def stop_real_time_check():
 
 @app.route('/api/email/add_to_real_time_queue', methods=['POST'])
 @token_required
-def add_to_real_time_queue():
+def add_to_real_time_queue(current_user):
     """将邮箱添加到实时检查队列"""
     try:
         email_id = request.json.get('email_id')
@@ -1866,6 +2053,9 @@ def add_to_real_time_queue():
                 'message': '缺少邮箱ID'
             })
 
+        if not db.get_email_by_id(email_id, None if current_user['is_admin'] else current_user['id']):
+            return jsonify({'error': '邮箱不存在或您没有权限'}), 404
+
         email_processor.add_to_real_time_queue(email_id)
         return jsonify({
             'success': True,
@@ -1945,9 +2135,15 @@ if __name__ == '__main__':
         ws_thread.daemon = True
         ws_thread.start()
 
-        # 启动实时邮件检查
-        email_processor.start_real_time_check(check_interval=300)
-        logger.info("实时邮件检查已启动")
+        if SYNC_IN_PROCESS:
+            # 启动实时邮件检查
+            email_processor.start_real_time_check(check_interval=300)
+            logger.info("实时邮件检查已启动")
+
+            # 启动Outlook令牌预刷新
+            email_processor.token_refresher.start()
+        else:
+            logger.info("SYNC_IN_PROCESS=0，后台同步由 worker.py 进程执行")
 
         # 启动Flask应用
         logger.info(f"学在华邮件助手启动于 http://{args.host}:{args.port}")
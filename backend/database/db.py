@@ -3,13 +3,17 @@ import os
 import threading
 import logging
 import hashlib
+import time
 import secrets
 import uuid
 import re
+import json
+from contextlib import contextmanager
 from typing import List, Dict, Optional, Callable
 from datetime import datetime, timezone
 import traceback
 from utils.email.logger import logger, log_progress
+from utils.email.sharding import shard_of
 
 # 配置日志
 logger = logging.getLogger('database')
@@ -17,6 +21,8 @@ logger = logging.getLogger('database')
 class Database:
     _instance = None
     _lock = threading.Lock()
+    # 同步任务、熔断状态的多语句操作共用一个连接，需串行执行
+    _job_lock = threading.RLock()
 
     def __new__(cls):
         with cls._lock:
@@ -34,6 +40,7 @@ class Database:
                     cls._instance.connect_db(db_path)
                     # 对已有数据库执行字段迁移
                     cls._instance._ensure_columns()
+                    cls._instance._ensure_tables()
 
                     # 检查数据库是否有用户，如果有则认为数据库已经初始化
                     cursor = cls._instance.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='users'")
@@ -72,8 +79,36 @@ class Database:
         os.makedirs(self.attachments_dir, exist_ok=True)
 
         logger.info(f"连接数据库: {db_path}")
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        busy_timeout = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '10000'))
+        self.busy_timeout = busy_timeout
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=busy_timeout / 1000)
         self.conn.row_factory = sqlite3.Row
+        # Web 进程和多个同步工作进程共用同一数据库文件：WAL 下读写互不阻塞，写锁冲突时等待而不是立即报错
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA busy_timeout={busy_timeout}")
+        self.conn.create_function('shard_of', 2, shard_of, deterministic=True)
+
+    @contextmanager
+    def _write_transaction(self):
+        """
+        在独立连接上执行多语句写事务
+
+        共用连接上其他线程的写入和提交会混进 BEGIN 之后的事务里，
+        多语句的批量更新改用短时连接，BEGIN IMMEDIATE 先拿到写锁，出错时整体回滚
+        """
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout / 1000)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute(f"PRAGMA busy_timeout={self.busy_timeout}")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        finally:
+            conn.close()
 
     def init_db(self):
         """初始化数据库连接和表结构"""
@@ -164,6 +199,7 @@ class Database:
 
             # 检查并添加新字段
             self._ensure_columns()
+            self._ensure_tables()
 
             self.conn.commit()
             logger.info(f"初始化数据库表结构: {self.db_path}")
@@ -197,6 +233,119 @@ class Database:
         self._check_and_add_column('mail_records', 'recipient', 'TEXT')
         self._check_and_add_column('mail_records', 'tag', 'TEXT')
         self._check_and_add_column('attachments', 'file_path', 'TEXT')
+        self._check_and_add_column('emails', 'imap_folders', 'TEXT')
+        self._check_and_add_column('mail_records', 'imap_uid', 'INTEGER')
+        self._check_and_add_column('mail_records', 'body_loaded', 'INTEGER DEFAULT 1')
+        self._check_and_add_column('attachments', 'remote_ref', 'TEXT')
+        self._check_and_add_column('emails', 'token_expires_at', 'INTEGER')
+        self._check_and_add_column('emails', 'token_status', 'TEXT')
+
+    def _ensure_tables(self):
+        """确保后续版本新增的表已在现有数据库中"""
+        try:
+            # IMAP 每个文件夹的增量同步状态
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS imap_folder_state (
+                    email_id INTEGER NOT NULL,
+                    folder TEXT NOT NULL,
+                    folder_key TEXT,
+                    uidvalidity INTEGER,
+                    uidnext INTEGER,
+                    last_uid INTEGER,
+                    messages INTEGER,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (email_id, folder),
+                    FOREIGN KEY (email_id) REFERENCES emails (id)
+                )
+            ''')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_mail_records_imap_uid ON mail_records (email_id, folder, imap_uid)"
+            )
+            # Graph 每个文件夹的 delta 同步状态
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS graph_sync_state (
+                    email_id INTEGER NOT NULL,
+                    folder_id TEXT NOT NULL,
+                    folder_name TEXT,
+                    delta_link TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (email_id, folder_id),
+                    FOREIGN KEY (email_id) REFERENCES emails (id)
+                )
+            ''')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_mail_records_graph_id ON mail_records (email_id, graph_message_id)"
+            )
+            # Graph 变更通知订阅，每个邮箱订阅收件箱
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS graph_subscriptions (
+                    email_id INTEGER PRIMARY KEY,
+                    subscription_id TEXT,
+                    resource TEXT,
+                    client_state TEXT,
+                    expires_at INTEGER,
+                    status TEXT,
+                    last_error TEXT,
+                    last_notified_at INTEGER,
+                    updated_at INTEGER,
+                    FOREIGN KEY (email_id) REFERENCES emails (id)
+                )
+            ''')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_graph_subscriptions_id ON graph_subscriptions (subscription_id)"
+            )
+            # 持久化同步任务队列，工作线程按租约领取
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email_id INTEGER NOT NULL,
+                    job_type TEXT NOT NULL,
+                    dedup_key TEXT NOT NULL DEFAULT '',
+                    payload TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 5,
+                    run_after REAL NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    FOREIGN KEY (email_id) REFERENCES emails (id)
+                )
+            ''')
+            # 同一邮箱同类任务在排队或执行中时只保留一条
+            self.conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_jobs_dedup ON sync_jobs (email_id, job_type, dedup_key) "
+                "WHERE status IN ('pending', 'running')"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sync_jobs_ready ON sync_jobs (status, run_after, priority)"
+            )
+            # 邮箱（account:<id>）和服务器（host:<主机名>）的熔断状态
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS circuit_breakers (
+                    key TEXT PRIMARY KEY,
+                    email_id INTEGER,
+                    state TEXT NOT NULL DEFAULT 'closed',
+                    failure_class TEXT,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    trips INTEGER NOT NULL DEFAULT 0,
+                    retry_at REAL,
+                    probe_at REAL,
+                    last_error TEXT,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            self.conn.commit()
+            self._check_and_add_column('graph_sync_state', 'next_link', 'TEXT')
+            self._check_and_add_column('graph_sync_state', 'total_count', 'INTEGER')
+            self._check_and_add_column('graph_sync_state', 'unread_count', 'INTEGER')
+            self._check_and_add_column('imap_folder_state', 'highestmodseq', 'INTEGER')
+            self._check_and_add_column('imap_folder_state', 'unseen', 'INTEGER')
+        except Exception as e:
+            logger.error(f"创建新增表失败: {str(e)}")
 
     def _safe_filename(self, filename: str) -> str:
         name = str(filename or '').strip()
@@ -473,7 +622,7 @@ class Database:
         return cursor.fetchall()
 
     # 邮箱相关方法
-    def add_email(self, user_id, email, password, client_id=None, refresh_token=None, mail_type='outlook', server=None, port=None, use_ssl=True):
+    def add_email(self, user_id, email, password, client_id=None, refresh_token=None, mail_type='outlook', server=None, port=None, use_ssl=True, imap_folders=None):
         """添加新的邮箱账号"""
         try:
             # 日志输出详细信息，但隐藏敏感信息
@@ -494,8 +643,8 @@ class Database:
                 # 将布尔值转换为整数值 (1=True, 0=False)
                 use_ssl_int = 1 if use_ssl else 0
                 cursor = self.conn.execute(
-                    "INSERT INTO emails (user_id, email, password, mail_type, server, port, use_ssl, enable_realtime_check) VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
-                    (user_id, email, password, mail_type, server, port, use_ssl_int)
+                    "INSERT INTO emails (user_id, email, password, mail_type, server, port, use_ssl, imap_folders, enable_realtime_check) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)",
+                    (user_id, email, password, mail_type, server, port, use_ssl_int, imap_folders)
                 )
             else:
                 logger.error(f"不支持的邮箱类型: {mail_type}")
@@ -580,6 +729,12 @@ class Database:
                 update_fields.append(f"{key} = ?")
                 params.append(value)
 
+            # 凭据变化后缓存的访问令牌作废
+            if ('refresh_token' in kwargs or 'client_id' in kwargs) and 'access_token' not in kwargs:
+                update_fields.append("access_token = NULL")
+                update_fields.append("token_expires_at = NULL")
+                update_fields.append("token_status = NULL")
+
             # 添加更新时间
             update_fields.append("updated_at = CURRENT_TIMESTAMP")
 
@@ -599,7 +754,10 @@ class Database:
                 WHERE {where_condition}
             """
 
-            self.conn.execute(sql, params)
+            cursor = self.conn.execute(sql, params)
+            # 凭据或服务器配置修改后重新开始同步，不再等待熔断冷却
+            if cursor.rowcount and set(kwargs) & {'password', 'refresh_token', 'client_id', 'server', 'port', 'use_ssl'}:
+                self.conn.execute("DELETE FROM circuit_breakers WHERE key = ?", (f"account:{email_id}",))
             self.conn.commit()
             logger.info(f"邮箱信息更新成功: ID={email_id}")
             return True
@@ -626,14 +784,24 @@ class Database:
         )
         self.conn.commit()
 
-    def update_email_token(self, email_id, access_token):
-        """更新Outlook邮箱的访问令牌"""
+    def update_email_token(self, email_id, access_token, expires_at=None, refresh_token=None):
+        """
+        更新Outlook邮箱的访问令牌，expires_at 为过期时间（Unix 秒）
+
+        refresh_token 不为空时同时保存微软轮换后的刷新令牌，并清除令牌失效标记。
+        """
         logger.debug(f"更新邮箱访问令牌, ID: {email_id}")
         try:
-            self.conn.execute(
-                "UPDATE emails SET access_token = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (access_token, email_id)
-            )
+            if refresh_token:
+                self.conn.execute(
+                    "UPDATE emails SET access_token = ?, token_expires_at = ?, refresh_token = ?, token_status = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (access_token, expires_at, refresh_token, email_id)
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE emails SET access_token = ?, token_expires_at = ?, token_status = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (access_token, expires_at, email_id)
+                )
             self.conn.commit()
             logger.info(f"成功更新邮箱 ID:{email_id} 的访问令牌")
             return True
@@ -641,6 +809,46 @@ class Database:
             logger.error(f"更新邮箱访问令牌失败, ID: {email_id}, 错误: {str(e)}")
             return False
 
+    def mark_email_token_invalid(self, email_id, status='invalid_grant'):
+        """标记刷新令牌已失效（如 invalid_grant），后台不再为该邮箱刷新令牌，直到凭据被更新"""
+        try:
+            self.conn.execute(
+                "UPDATE emails SET token_status = ?, access_token = NULL, token_expires_at = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (status, email_id)
+            )
+            self.conn.commit()
+            logger.warning(f"邮箱 ID:{email_id} 的刷新令牌已失效: {status}")
+            return True
+        except Exception as e:
+            logger.error(f"标记邮箱令牌失效失败, ID: {email_id}, 错误: {str(e)}")
+            return False
+
+    def get_token_refresh_candidates(self, email_ids=None) -> List[Dict]:
+        """
+        获取需要保持访问令牌有效的 Outlook 邮箱：开启了实时检查的用户的邮箱，以及 email_ids 中最近使用过的邮箱
+
+        已标记令牌失效的邮箱不在结果中。
+        """
+        try:
+            conditions = "user_id IN (SELECT DISTINCT user_id FROM emails WHERE enable_realtime_check = 1)"
+            params = []
+            if email_ids:
+                conditions += f" OR id IN ({','.join(['?'] * len(email_ids))})"
+                params.extend(email_ids)
+            cursor = self.conn.execute(
+                f"""
+                SELECT id, email, mail_type, refresh_token, client_id, token_expires_at
+                FROM emails
+                WHERE mail_type = 'outlook' AND refresh_token IS NOT NULL AND refresh_token != ''
+                  AND token_status IS NULL AND ({conditions})
+                """,
+                params
+            )
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"获取待刷新令牌的邮箱失败: {str(e)}")
+            return []
+
     def delete_email(self, email_id, user_id=None):
         """删除邮箱账号，可以验证所有者"""
         logger.info(f"删除邮箱账号, ID: {email_id}")
@@ -660,6 +868,11 @@ class Database:
             placeholders = ','.join(['?'] * len(mail_ids))
             self.conn.execute(f"DELETE FROM attachments WHERE mail_id IN ({placeholders})", mail_ids)
         self.conn.execute("DELETE FROM mail_records WHERE email_id = ?", (email_id,))
+        self.conn.execute("DELETE FROM imap_folder_state WHERE email_id = ?", (email_id,))
+        self.conn.execute("DELETE FROM graph_sync_state WHERE email_id = ?", (email_id,))
+        self.conn.execute("DELETE FROM graph_subscriptions WHERE email_id = ?", (email_id,))
+        self.conn.execute("DELETE FROM sync_jobs WHERE email_id = ?", (email_id,))
+        self.conn.execute("DELETE FROM circuit_breakers WHERE email_id = ?", (email_id,))
 
         # 再删除邮箱
         self.conn.execute(f"DELETE FROM emails WHERE {sql_where}", params)
@@ -700,11 +913,16 @@ class Database:
             mail_placeholders = ','.join(['?'] * len(mail_ids))
             self.conn.execute(f"DELETE FROM attachments WHERE mail_id IN ({mail_placeholders})", mail_ids)
         self.conn.execute(f"DELETE FROM mail_records WHERE email_id IN ({placeholders})", email_ids)
+        self.conn.execute(f"DELETE FROM imap_folder_state WHERE email_id IN ({placeholders})", email_ids)
+        self.conn.execute(f"DELETE FROM graph_sync_state WHERE email_id IN ({placeholders})", email_ids)
+        self.conn.execute(f"DELETE FROM graph_subscriptions WHERE email_id IN ({placeholders})", email_ids)
+        self.conn.execute(f"DELETE FROM sync_jobs WHERE email_id IN ({placeholders})", email_ids)
+        self.conn.execute(f"DELETE FROM circuit_breakers WHERE email_id IN ({placeholders})", email_ids)
         # 再删除邮箱
         self.conn.execute(f"DELETE FROM emails WHERE id IN ({placeholders})", email_ids)
         self.conn.commit()
 
-    def add_mail_record(self, email_id, subject, sender, received_time, content, folder=None, is_read=1, graph_message_id=None, has_attachments=0, recipient=None):
+    def add_mail_record(self, email_id, subject, sender, received_time, content, folder=None, is_read=1, graph_message_id=None, has_attachments=0, recipient=None, imap_uid=None, body_loaded=1):
         """添加邮件记录"""
         logger.debug(f"添加邮件记录, 邮箱ID: {email_id}, 主题: {subject}")
         try:
@@ -728,8 +946,8 @@ class Database:
 
             # 邮件不存在，添加新记录
             cursor = self.conn.execute(
-                "INSERT INTO mail_records (email_id, subject, sender, recipient, received_time, content, folder, is_read, graph_message_id, has_attachments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (email_id, subject, sender, recipient, normalized_received_time, content, folder, is_read, graph_message_id, has_attachments)
+                "INSERT INTO mail_records (email_id, subject, sender, recipient, received_time, content, folder, is_read, graph_message_id, has_attachments, imap_uid, body_loaded) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (email_id, subject, sender, recipient, normalized_received_time, content, folder, is_read, graph_message_id, has_attachments, imap_uid, body_loaded)
             )
             mail_id = cursor.lastrowid
             self.conn.commit()
@@ -856,6 +1074,681 @@ class Database:
             logger.error(f"更新邮件已读状态失败: {str(e)}")
             return False
 
+    def set_mail_read_status_batch(self, mail_ids: List[int], is_read: int) -> int:
+        """批量更新邮件已读状态，返回更新的记录数"""
+        if not mail_ids:
+            return 0
+        try:
+            updated = 0
+            value = 1 if is_read else 0
+            with self._write_transaction() as conn:
+                for start in range(0, len(mail_ids), 500):
+                    chunk = list(mail_ids[start:start + 500])
+                    placeholders = ",".join(["?"] * len(chunk))
+                    cursor = conn.execute(
+                        f"UPDATE mail_records SET is_read = ? WHERE id IN ({placeholders})",
+                        (value, *chunk)
+                    )
+                    updated += int(cursor.rowcount or 0)
+            return updated
+        except Exception as e:
+            logger.error(f"批量更新邮件已读状态失败: {str(e)}")
+            return 0
+
+    def set_mail_imap_uid(self, mail_id: int, imap_uid: int) -> bool:
+        """回填历史邮件的IMAP UID"""
+        try:
+            self.conn.execute(
+                "UPDATE mail_records SET imap_uid = ? WHERE id = ?",
+                (imap_uid, mail_id)
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"更新邮件IMAP UID失败: {str(e)}")
+            return False
+
+    def get_imap_folder_states(self, email_id: int) -> Dict[str, Dict]:
+        """获取邮箱各IMAP文件夹的增量同步状态，按实际文件夹名索引"""
+        try:
+            cursor = self.conn.execute(
+                "SELECT * FROM imap_folder_state WHERE email_id = ?",
+                (email_id,)
+            )
+            return {row['folder']: dict(row) for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"获取IMAP文件夹状态失败: {str(e)}")
+            return {}
+
+    def save_imap_folder_states(self, email_id: int, states: List[Dict]) -> bool:
+        """保存IMAP文件夹的增量同步状态"""
+        if not states:
+            return True
+        try:
+            for state in states:
+                self.conn.execute(
+                    """
+                    INSERT OR REPLACE INTO imap_folder_state
+                        (email_id, folder, folder_key, uidvalidity, uidnext, last_uid, messages, highestmodseq, unseen, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    """,
+                    (
+                        email_id,
+                        state.get('folder'),
+                        state.get('folder_key'),
+                        state.get('uidvalidity'),
+                        state.get('uidnext'),
+                        state.get('last_uid'),
+                        state.get('messages'),
+                        state.get('highestmodseq'),
+                        state.get('unseen'),
+                    )
+                )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"保存IMAP文件夹状态失败: {str(e)}")
+            return False
+
+    def sync_imap_folder_flags(self, email_id: int, changes: List[Dict]) -> Dict[str, int]:
+        """
+        在一个事务内把一轮IMAP同步得到的已读状态变化和已删除邮件写入本地
+
+        每项 change 包含:
+            folder: 实际文件夹名
+            flag_updates: {uid: 是否已读}
+            vanished_uids: 服务器上已删除的UID
+            present_uids / present_ranges: 服务器上位于 present_ranges [(起始UID, 结束UID)] 内的全部UID，
+                这些范围内本地多出的视为已删除
+            reset_uids: UIDVALIDITY 变化时清空该文件夹的本地UID
+
+        Returns:
+            dict: {'updated': 已读状态变化数, 'deleted': 删除的邮件数}
+        """
+        result = {'updated': 0, 'deleted': 0}
+        changes = [change for change in changes or [] if change]
+        if not changes:
+            return result
+        try:
+            deleted_ids = set()
+            for change in changes:
+                vanished = change.get('vanished_uids') or []
+                present_uids = change.get('present_uids')
+                present_ranges = change.get('present_ranges') or []
+                if not vanished and not (present_uids is not None and present_ranges):
+                    continue
+                cursor = self.conn.execute(
+                    "SELECT id, imap_uid FROM mail_records WHERE email_id = ? AND folder = ? AND imap_uid IS NOT NULL",
+                    (email_id, change['folder'])
+                )
+                local = {row['imap_uid']: row['id'] for row in cursor.fetchall()}
+                for uid in vanished:
+                    if uid in local:
+                        deleted_ids.add(local[uid])
+                if present_uids is not None and present_ranges:
+                    present = set(present_uids)
+                    for uid, mail_id in local.items():
+                        if uid not in present and any(low <= uid <= high for low, high in present_ranges):
+                            deleted_ids.add(mail_id)
+
+            deleted_ids = sorted(deleted_ids)
+            if deleted_ids:
+                self._remove_attachment_files_by_mail_ids(deleted_ids)
+
+            with self._write_transaction() as conn:
+                for change in changes:
+                    folder = change['folder']
+                    if change.get('reset_uids'):
+                        conn.execute(
+                            "UPDATE mail_records SET imap_uid = NULL WHERE email_id = ? AND folder = ?",
+                            (email_id, folder)
+                        )
+                    for uid, is_read in (change.get('flag_updates') or {}).items():
+                        value = 1 if is_read else 0
+                        cursor = conn.execute(
+                            "UPDATE mail_records SET is_read = ? WHERE email_id = ? AND folder = ? AND imap_uid = ? AND is_read != ?",
+                            (value, email_id, folder, uid, value)
+                        )
+                        result['updated'] += int(cursor.rowcount or 0)
+                # 分批删除，避免超过 SQLite 参数数量限制
+                for start in range(0, len(deleted_ids), 500):
+                    chunk = deleted_ids[start:start + 500]
+                    placeholders = ",".join(["?"] * len(chunk))
+                    conn.execute(f"DELETE FROM attachments WHERE mail_id IN ({placeholders})", tuple(chunk))
+                    cursor = conn.execute(f"DELETE FROM mail_records WHERE id IN ({placeholders})", tuple(chunk))
+                    result['deleted'] += int(cursor.rowcount or 0)
+            return result
+        except Exception as e:
+            logger.error(f"同步IMAP邮件状态失败: {str(e)}")
+            return {'updated': 0, 'deleted': 0}
+
+    def get_graph_sync_states(self, email_id: int) -> Dict[str, Dict]:
+        """获取邮箱各Graph文件夹的 delta 同步状态，按文件夹ID索引"""
+        try:
+            cursor = self.conn.execute(
+                "SELECT * FROM graph_sync_state WHERE email_id = ?",
+                (email_id,)
+            )
+            return {row['folder_id']: dict(row) for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"获取Graph同步状态失败: {str(e)}")
+            return {}
+
+    def save_graph_sync_states(self, email_id: int, states: List[Dict]) -> bool:
+        """保存Graph文件夹的 delta 同步状态"""
+        if not states:
+            return True
+        try:
+            for state in states:
+                self.conn.execute(
+                    """
+                    INSERT OR REPLACE INTO graph_sync_state
+                        (email_id, folder_id, folder_name, delta_link, next_link, total_count, unread_count, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    """,
+                    (
+                        email_id, state.get('folder_id'), state.get('folder_name'), state.get('delta_link'),
+                        state.get('next_link'), state.get('total_count'), state.get('unread_count')
+                    )
+                )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"保存Graph同步状态失败: {str(e)}")
+            return False
+
+    def get_graph_subscription(self, email_id: int) -> Optional[Dict]:
+        """获取邮箱的Graph变更通知订阅"""
+        try:
+            row = self.conn.execute(
+                "SELECT * FROM graph_subscriptions WHERE email_id = ?",
+                (email_id,)
+            ).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"获取Graph订阅失败: {str(e)}")
+            return None
+
+    def get_graph_subscription_by_id(self, subscription_id: str) -> Optional[Dict]:
+        """按Graph订阅ID查找订阅"""
+        try:
+            row = self.conn.execute(
+                "SELECT * FROM graph_subscriptions WHERE subscription_id = ?",
+                (subscription_id,)
+            ).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"获取Graph订阅失败: {str(e)}")
+            return None
+
+    def save_graph_subscription(self, email_id: int, subscription_id: Optional[str], resource: Optional[str],
+                                client_state: Optional[str], expires_at: Optional[int], status: str = 'active',
+                                last_error: Optional[str] = None) -> bool:
+        """保存Graph订阅状态，创建失败时 subscription_id 为空、status 为 failed"""
+        try:
+            self.conn.execute(
+                """
+                INSERT INTO graph_subscriptions
+                    (email_id, subscription_id, resource, client_state, expires_at, status, last_error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+                ON CONFLICT(email_id) DO UPDATE SET
+                    subscription_id = excluded.subscription_id,
+                    resource = excluded.resource,
+                    client_state = excluded.client_state,
+                    expires_at = excluded.expires_at,
+                    status = excluded.status,
+                    last_error = excluded.last_error,
+                    updated_at = excluded.updated_at
+                """,
+                (email_id, subscription_id, resource, client_state, expires_at, status, last_error)
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"保存Graph订阅失败: {str(e)}")
+            return False
+
+    def touch_graph_subscription(self, subscription_id: str) -> bool:
+        """记录订阅最近一次收到通知的时间"""
+        try:
+            self.conn.execute(
+                "UPDATE graph_subscriptions SET last_notified_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE subscription_id = ?",
+                (subscription_id,)
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"更新Graph订阅失败: {str(e)}")
+            return False
+
+    def delete_graph_subscription(self, email_id: int) -> bool:
+        """删除邮箱的Graph订阅记录"""
+        try:
+            self.conn.execute("DELETE FROM graph_subscriptions WHERE email_id = ?", (email_id,))
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"删除Graph订阅失败: {str(e)}")
+            return False
+
+    def enqueue_sync_job(self, email_id: int, job_type: str, payload: Optional[str] = None, dedup_key: str = '',
+                         priority: int = 0, run_after: float = 0, max_attempts: int = 5) -> Optional[int]:
+        """
+        添加同步任务，同一邮箱同类任务（相同 dedup_key）已在排队或执行时不重复添加
+
+        Returns:
+            int: 新任务或已有任务的ID，失败返回 None
+        """
+        try:
+            with self._job_lock:
+                now = time.time()
+                cursor = self.conn.execute(
+                    """
+                    INSERT OR IGNORE INTO sync_jobs
+                        (email_id, job_type, dedup_key, payload, priority, run_after, max_attempts, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (email_id, job_type, dedup_key, payload, priority, run_after, max_attempts, now, now)
+                )
+                if cursor.rowcount:
+                    job_id = cursor.lastrowid
+                else:
+                    # 已有任务排队时提升优先级、提前执行时间
+                    self.conn.execute(
+                        """
+                        UPDATE sync_jobs SET priority = MAX(priority, ?), run_after = MIN(run_after, ?), updated_at = ?
+                        WHERE email_id = ? AND job_type = ? AND dedup_key = ? AND status = 'pending'
+                        """,
+                        (priority, run_after, now, email_id, job_type, dedup_key)
+                    )
+                    row = self.conn.execute(
+                        "SELECT id FROM sync_jobs WHERE email_id = ? AND job_type = ? AND dedup_key = ? AND status IN ('pending', 'running')",
+                        (email_id, job_type, dedup_key)
+                    ).fetchone()
+                    job_id = row['id'] if row else None
+                self.conn.commit()
+                return job_id
+        except Exception as e:
+            logger.error(f"添加同步任务失败, 邮箱ID: {email_id}, 类型: {job_type}, 错误: {str(e)}")
+            return None
+
+    def claim_sync_jobs(self, owner: str, lease_seconds: float, limit: int = 1, shard=None,
+                        exclude_mail_types: Optional[List[str]] = None) -> List[Dict]:
+        """
+        领取到期任务并加租约；租约过期的执行中任务视为工作进程已退出，可被重新领取
+
+        每次领取生成新的租约令牌（lease_owner），之后续约、完成、失败都需带上该令牌。
+        同一邮箱同时只会有一个任务处于有效租约中。指定 shard 时只领取该分片邮箱的任务，
+        指定 exclude_mail_types 时跳过这些类型邮箱的任务（如对应的同步通道已满）。
+        """
+        try:
+            with self._job_lock:
+                now = time.time()
+                lease_token = f"{owner}:{uuid.uuid4().hex}"
+                conditions = ""
+                params = [lease_token, now + lease_seconds, now, now, now, now]
+                if shard is not None and not shard.is_all:
+                    conditions = " AND shard_of(email_id, ?) = ?"
+                    params.extend([shard.count, shard.index])
+                if exclude_mail_types:
+                    conditions += (
+                        " AND email_id NOT IN (SELECT id FROM emails WHERE COALESCE(mail_type, 'outlook') IN "
+                        f"({', '.join('?' * len(exclude_mail_types))}))"
+                    )
+                    params.extend(exclude_mail_types)
+                params.append(limit)
+                # 反复在执行中丢失租约（如进程崩溃）且已用完重试次数的任务不再领取
+                self.conn.execute(
+                    "UPDATE sync_jobs SET status = 'failed', lease_owner = NULL, last_error = COALESCE(last_error, '租约过期'), updated_at = ? "
+                    "WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts",
+                    (now, now)
+                )
+                # 单条 UPDATE 在 SQLite 中是原子的，多进程同时领取也不会拿到同一任务
+                self.conn.execute(
+                    f"""
+                    UPDATE sync_jobs
+                    SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ?
+                    WHERE id IN (
+                        SELECT id FROM sync_jobs
+                        WHERE ((status = 'pending' AND run_after <= ?) OR (status = 'running' AND lease_expires < ?))
+                          AND email_id NOT IN (
+                              SELECT email_id FROM sync_jobs WHERE status = 'running' AND lease_expires >= ?
+                          ){conditions}
+                        ORDER BY priority DESC, run_after, id
+                        LIMIT ?
+                    )
+                    """,
+                    params
+                )
+                self.conn.commit()
+                cursor = self.conn.execute(
+                    "SELECT * FROM sync_jobs WHERE status = 'running' AND lease_owner = ? ORDER BY priority DESC, id",
+                    (lease_token,)
+                )
+                jobs = []
+                seen = set()
+                for row in cursor.fetchall():
+                    job = dict(row)
+                    # 同一批领取到同一邮箱的多条任务时，多余的放回队列
+                    if job['email_id'] in seen:
+                        self.release_sync_job(job['id'], lease_token, 0, count_attempt=False)
+                        continue
+                    seen.add(job['email_id'])
+                    jobs.append(job)
+                return jobs
+        except Exception as e:
+            logger.error(f"领取同步任务失败: {str(e)}")
+            return []
+
+    def heartbeat_sync_jobs(self, leases: Dict[int, str], lease_seconds: float) -> List[int]:
+        """
+        延长任务租约，leases 为 {任务ID: 租约令牌}
+
+        Returns:
+            list: 租约仍归自己所有的任务ID
+        """
+        if not leases:
+            return []
+        try:
+            with self._job_lock:
+                now = time.time()
+                kept = []
+                for job_id, lease_token in leases.items():
+                    cursor = self.conn.execute(
+                        "UPDATE sync_jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                        (now + lease_seconds, now, job_id, lease_token)
+                    )
+                    if cursor.rowcount:
+                        kept.append(job_id)
+                self.conn.commit()
+                return kept
+        except Exception as e:
+            logger.error(f"延长同步任务租约失败: {str(e)}")
+            return list(leases)
+
+    def complete_sync_job(self, job_id: int, lease_token: str) -> bool:
+        """标记任务完成，租约已被他人接管时返回 False"""
+        try:
+            with self._job_lock:
+                now = time.time()
+                cursor = self.conn.execute(
+                    "UPDATE sync_jobs SET status = 'done', lease_owner = NULL, lease_expires = NULL, last_error = NULL, updated_at = ? "
+                    "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                    (now, job_id, lease_token)
+                )
+                self.conn.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"标记同步任务完成失败, ID: {job_id}, 错误: {str(e)}")
+            return False
+
+    def fail_sync_job(self, job_id: int, lease_token: str, error: str, retry_delay: float, retry: bool = True) -> Optional[str]:
+        """
+        记录任务失败，未达到最大次数时延迟重试；retry 为 False 时直接标记为 failed
+
+        Returns:
+            str: 任务的新状态 pending/failed，租约已被他人接管时返回 None
+        """
+        try:
+            with self._job_lock:
+                now = time.time()
+                cursor = self.conn.execute(
+                    """
+                    UPDATE sync_jobs
+                    SET status = CASE WHEN ? = 0 OR attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                        run_after = ?, lease_owner = NULL, lease_expires = NULL, last_error = ?, updated_at = ?
+                    WHERE id = ? AND status = 'running' AND lease_owner = ?
+                    """,
+                    (1 if retry else 0, now + retry_delay, (error or '')[:1000], now, job_id, lease_token)
+                )
+                self.conn.commit()
+                if not cursor.rowcount:
+                    return None
+                row = self.conn.execute("SELECT status FROM sync_jobs WHERE id = ?", (job_id,)).fetchone()
+                return row['status'] if row else None
+        except Exception as e:
+            logger.error(f"记录同步任务失败状态出错, ID: {job_id}, 错误: {str(e)}")
+            return None
+
+    def release_sync_job(self, job_id: int, lease_token: str, delay: float = 0, count_attempt: bool = True) -> bool:
+        """放弃租约并把任务放回队列，count_attempt 为 False 时不计入重试次数"""
+        try:
+            with self._job_lock:
+                now = time.time()
+                cursor = self.conn.execute(
+                    f"""
+                    UPDATE sync_jobs
+                    SET status = 'pending', run_after = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ?
+                        {'' if count_attempt else ', attempts = MAX(0, attempts - 1)'}
+                    WHERE id = ? AND status = 'running' AND lease_owner = ?
+                    """,
+                    (now + delay, now, job_id, lease_token)
+                )
+                self.conn.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"释放同步任务失败, ID: {job_id}, 错误: {str(e)}")
+            return False
+
+    def get_sync_job(self, job_id: int) -> Optional[Dict]:
+        """获取同步任务"""
+        try:
+            row = self.conn.execute("SELECT * FROM sync_jobs WHERE id = ?", (job_id,)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"获取同步任务失败, ID: {job_id}, 错误: {str(e)}")
+            return None
+
+    def get_sync_job_stats(self) -> Dict[str, Dict[str, int]]:
+        """按任务类型、状态统计任务数"""
+        try:
+            cursor = self.conn.execute("SELECT job_type, status, COUNT(*) AS count FROM sync_jobs GROUP BY job_type, status")
+            stats = {}
+            for row in cursor.fetchall():
+                stats.setdefault(row['job_type'], {})[row['status']] = row['count']
+            return stats
+        except Exception as e:
+            logger.error(f"统计同步任务失败: {str(e)}")
+            return {}
+
+    def purge_sync_jobs(self, older_than: float) -> int:
+        """删除 older_than（Unix 秒）之前结束的任务"""
+        try:
+            cursor = self.conn.execute(
+                "DELETE FROM sync_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (older_than,)
+            )
+            self.conn.commit()
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"清理同步任务失败: {str(e)}")
+            return 0
+
+    def get_circuit_breaker(self, key: str) -> Optional[Dict]:
+        """获取熔断状态"""
+        try:
+            row = self.conn.execute("SELECT * FROM circuit_breakers WHERE key = ?", (key,)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"获取熔断状态失败, key: {key}, 错误: {str(e)}")
+            return None
+
+    def get_circuit_breakers(self) -> List[Dict]:
+        """获取所有未关闭的熔断状态"""
+        try:
+            cursor = self.conn.execute("SELECT * FROM circuit_breakers WHERE state != 'closed'")
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"获取熔断状态失败: {str(e)}")
+            return []
+
+    def save_circuit_breaker(self, breaker: Dict) -> bool:
+        """保存熔断状态，breaker 为 circuit_breakers 表的一行"""
+        columns = ('key', 'email_id', 'state', 'failure_class', 'failures', 'trips',
+                   'retry_at', 'probe_at', 'last_error', 'updated_at')
+        try:
+            with self._job_lock:
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO circuit_breakers ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                    tuple(breaker.get(column) for column in columns)
+                )
+                self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"保存熔断状态失败, key: {breaker.get('key')}, 错误: {str(e)}")
+            return False
+
+    def delete_circuit_breaker(self, key: str) -> bool:
+        """删除熔断状态（恢复正常）"""
+        try:
+            with self._job_lock:
+                self.conn.execute("DELETE FROM circuit_breakers WHERE key = ?", (key,))
+                self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"删除熔断状态失败, key: {key}, 错误: {str(e)}")
+            return False
+
+    def claim_circuit_probe(self, key: str, now: float, stale_before: float) -> bool:
+        """
+        冷却结束的熔断器转为半开并占用探测名额
+
+        probe_at 早于 stale_before 的探测视为已丢失，可重新占用。
+
+        Returns:
+            bool: 是否由本次调用占用
+        """
+        try:
+            with self._job_lock:
+                cursor = self.conn.execute(
+                    """
+                    UPDATE circuit_breakers SET state = 'half_open', probe_at = ?, updated_at = ?
+                    WHERE key = ? AND (
+                        (state = 'open' AND retry_at <= ?)
+                        OR (state = 'half_open' AND (probe_at IS NULL OR probe_at < ?))
+                    )
+                    """,
+                    (now, now, key, now, stale_before)
+                )
+                self.conn.commit()
+                return cursor.rowcount == 1
+        except Exception as e:
+            logger.error(f"占用熔断探测失败, key: {key}, 错误: {str(e)}")
+            return False
+
+    def get_mails_without_body(self, email_id: int, since=None, limit: int = 100) -> List[Dict]:
+        """
+        获取只保存了摘要、尚未获取正文的Graph邮件，未读或 since 之后收到的优先
+
+        Returns:
+            list: [{'id', 'graph_message_id'}]，按收件时间倒序
+        """
+        try:
+            conditions = "is_read = 0"
+            params = [email_id]
+            if since is not None:
+                conditions += " OR received_time >= ?"
+                params.append(self._normalize_to_utc_timestamp(since))
+            params.append(limit)
+            cursor = self.conn.execute(
+                f"""
+                SELECT id, graph_message_id FROM mail_records
+                WHERE email_id = ? AND body_loaded = 0 AND graph_message_id IS NOT NULL AND ({conditions})
+                ORDER BY received_time DESC LIMIT ?
+                """,
+                params
+            )
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"获取待加载正文的邮件失败: {str(e)}")
+            return []
+
+    def update_mail_bodies(self, email_id: int, bodies: Dict[str, str]) -> int:
+        """按Graph消息ID保存获取到的邮件正文，返回更新的邮件数"""
+        if not bodies:
+            return 0
+        try:
+            updated = 0
+            for graph_message_id, content in bodies.items():
+                cursor = self.conn.execute(
+                    "UPDATE mail_records SET content = ?, body_loaded = 1 WHERE email_id = ? AND graph_message_id = ?",
+                    (content, email_id, graph_message_id)
+                )
+                updated += cursor.rowcount
+            self.conn.commit()
+            return updated
+        except Exception as e:
+            logger.error(f"保存邮件正文失败: {str(e)}")
+            self.conn.rollback()
+            return 0
+
+    def get_graph_message_ids(self, email_id: int) -> set:
+        """获取邮箱本地已保存的Graph消息ID"""
+        try:
+            cursor = self.conn.execute(
+                "SELECT graph_message_id FROM mail_records WHERE email_id = ? AND graph_message_id IS NOT NULL AND graph_message_id != ''",
+                (email_id,)
+            )
+            return {row[0] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"获取Graph消息ID失败: {str(e)}")
+            return set()
+
+    def sync_graph_message_changes(self, email_id: int, updates: Dict[str, Dict], removed_ids: List[str], folder: Optional[str] = None) -> Dict[str, int]:
+        """
+        在一个事务内应用Graph增量同步得到的变化
+
+        Args:
+            updates: {Graph消息ID: {'is_read': 是否已读, 'folder': 所在文件夹}}
+            removed_ids: 服务器上已删除（或移出该文件夹）的Graph消息ID
+            folder: 指定时只删除仍在该文件夹中的本地记录，已被移到其他文件夹的邮件保留
+
+        Returns:
+            dict: {'updated': 状态变化数, 'deleted': 删除的邮件数}
+        """
+        result = {'updated': 0, 'deleted': 0}
+        if not updates and not removed_ids:
+            return result
+        try:
+            deleted_ids = []
+            removed_ids = list(removed_ids or [])
+            for start in range(0, len(removed_ids), 500):
+                chunk = removed_ids[start:start + 500]
+                placeholders = ",".join(["?"] * len(chunk))
+                sql = f"SELECT id FROM mail_records WHERE email_id = ? AND graph_message_id IN ({placeholders})"
+                params = [email_id, *chunk]
+                if folder:
+                    sql += " AND folder = ?"
+                    params.append(folder)
+                cursor = self.conn.execute(sql, params)
+                deleted_ids.extend(row['id'] for row in cursor.fetchall())
+            if deleted_ids:
+                self._remove_attachment_files_by_mail_ids(deleted_ids)
+
+            with self._write_transaction() as conn:
+                for message_id, change in (updates or {}).items():
+                    value = 1 if change.get('is_read') else 0
+                    folder = change.get('folder')
+                    cursor = conn.execute(
+                        """
+                        UPDATE mail_records SET is_read = ?, folder = COALESCE(?, folder)
+                        WHERE email_id = ? AND graph_message_id = ?
+                          AND (is_read IS NOT ? OR (? IS NOT NULL AND folder IS NOT ?))
+                        """,
+                        (value, folder, email_id, message_id, value, folder, folder)
+                    )
+                    result['updated'] += int(cursor.rowcount or 0)
+                for start in range(0, len(deleted_ids), 500):
+                    chunk = deleted_ids[start:start + 500]
+                    placeholders = ",".join(["?"] * len(chunk))
+                    conn.execute(f"DELETE FROM attachments WHERE mail_id IN ({placeholders})", tuple(chunk))
+                    cursor = conn.execute(f"DELETE FROM mail_records WHERE id IN ({placeholders})", tuple(chunk))
+                    result['deleted'] += int(cursor.rowcount or 0)
+            return result
+        except Exception as e:
+            logger.error(f"同步Graph邮件状态失败: {str(e)}")
+            return {'updated': 0, 'deleted': 0}
+
     def set_mail_tag(self, mail_id: int, tag: Optional[str]) -> bool:
         try:
             normalized_tag = (tag or "").strip()
@@ -1029,14 +1922,7 @@ class Database:
             if existing:
                 return existing['id']
 
-            ext = os.path.splitext(safe_name)[1]
-            saved_name = f"{mail_id}_{uuid.uuid4().hex}{ext}"
-            mail_dir = os.path.join(self.attachments_dir, str(mail_id))
-            os.makedirs(mail_dir, exist_ok=True)
-            file_path = os.path.join(mail_dir, saved_name)
-
-            with open(file_path, 'wb') as f:
-                f.write(data)
+            file_path = self._write_attachment_file(mail_id, safe_name, data)
 
             cursor = self.conn.execute(
                 "INSERT INTO attachments (mail_id, filename, content_type, size, file_path, content) VALUES (?, ?, ?, ?, ?, NULL)",
@@ -1056,6 +1942,97 @@ class Database:
             logger.error(f"添加附件记录失败: {str(e)}")
             return None
 
+    def _new_attachment_path(self, mail_id, safe_name):
+        """在附件目录中生成新的附件文件路径"""
+        ext = os.path.splitext(safe_name)[1]
+        saved_name = f"{mail_id}_{uuid.uuid4().hex}{ext}"
+        mail_dir = os.path.join(self.attachments_dir, str(mail_id))
+        os.makedirs(mail_dir, exist_ok=True)
+        return os.path.join(mail_dir, saved_name)
+
+    def _write_attachment_file(self, mail_id, safe_name, data):
+        """将附件内容写入附件目录，返回文件路径"""
+        file_path = self._new_attachment_path(mail_id, safe_name)
+
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    def add_attachment_metadata(self, mail_id, filename, content_type, size, remote_ref):
+        """添加仅含元数据的附件记录，内容在首次下载时从服务器获取"""
+        logger.debug(f"添加附件元数据, 邮件ID: {mail_id}, 文件名: {filename}")
+        try:
+            safe_name = self._safe_filename(filename)
+            existing = self.conn.execute(
+                "SELECT id FROM attachments WHERE mail_id = ? AND filename = ?",
+                (mail_id, safe_name)
+            ).fetchone()
+            if existing:
+                return existing['id']
+
+            cursor = self.conn.execute(
+                "INSERT INTO attachments (mail_id, filename, content_type, size, file_path, content, remote_ref) VALUES (?, ?, ?, ?, NULL, NULL, ?)",
+                (mail_id, safe_name, content_type, int(size or 0), json.dumps(remote_ref, ensure_ascii=False))
+            )
+            self.conn.execute(
+                "UPDATE mail_records SET has_attachments = 1 WHERE id = ?",
+                (mail_id,)
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"添加附件元数据失败: {str(e)}")
+            return None
+
+    def store_attachment_content(self, attachment_id, content):
+        """保存按需下载的附件内容，并更新为实际大小"""
+        try:
+            attachment = self.get_attachment(attachment_id)
+            if not attachment:
+                return False
+            data = self._normalize_attachment_bytes(content)
+            file_path = self._write_attachment_file(attachment['mail_id'], attachment['filename'], data)
+            self.conn.execute(
+                "UPDATE attachments SET file_path = ?, size = ? WHERE id = ?",
+                (file_path, len(data), attachment_id)
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"保存附件内容失败: {str(e)}")
+            return False
+
+    def store_attachment_stream(self, attachment_id, writer):
+        """
+        以流的方式保存按需下载的附件内容
+
+        writer(fileobj) 负责把内容写入文件并返回写入的字节数；先写入临时文件，完成后再替换为正式文件。
+        """
+        attachment = self.get_attachment(attachment_id)
+        if not attachment:
+            return False
+        file_path = self._new_attachment_path(attachment['mail_id'], attachment['filename'])
+        part_path = file_path + '.part'
+        try:
+            with open(part_path, 'wb') as f:
+                size = writer(f)
+            os.replace(part_path, file_path)
+            self.conn.execute(
+                "UPDATE attachments SET file_path = ?, size = ? WHERE id = ?",
+                (file_path, int(size or os.path.getsize(file_path)), attachment_id)
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"保存附件内容失败: {str(e)}")
+            for path in (part_path, file_path):
+                if os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            raise
+
     def get_attachments(self, mail_id):
         """获取指定邮件的所有附件信息（不包含内容）"""
         logger.debug(f"获取邮件附件, 邮件ID: {mail_id}")
@@ -1165,7 +2142,7 @@ class Database:
             # 执行查询
             cursor = self.conn.execute(f'''
                 SELECT id, user_id, email, password, client_id, refresh_token,
-                       mail_type, server, port, use_ssl, last_check_time
+                       mail_type, server, port, use_ssl, last_check_time, imap_folders
                 FROM emails
                 WHERE id IN ({placeholders})
             ''', email_ids)
@@ -1184,7 +2161,8 @@ class Database:
                     'server': row['server'],
                     'port': row['port'],
                     'use_ssl': bool(row['use_ssl']),
-                    'last_check_time': row['last_check_time']
+                    'last_check_time': row['last_check_time'],
+                    'imap_folders': row['imap_folders']
                 }
                 emails.append(email)
 
@@ -1328,7 +2306,7 @@ class Database:
             cursor = self.conn.execute("""
                 SELECT id, email, password, mail_type, server, port,
                        use_ssl, client_id, refresh_token, last_check_time,
-                       enable_realtime_check
+                       enable_realtime_check, imap_folders
                 FROM emails
                 WHERE user_id = ? AND enable_realtime_check = 1
                 ORDER BY id
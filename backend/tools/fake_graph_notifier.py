@@ -0,0 +1,117 @@
+"""
+模拟 Microsoft Graph 推送变更通知
+用于在本地验证 /api/graph/notifications：订阅验证握手、clientState 校验以及通知触发的同步
+
+用法（在 backend 目录下执行）:
+    python tools/fake_graph_notifier.py validate --url http://127.0.0.1:5000/api/graph/notifications
+    python tools/fake_graph_notifier.py notify --url http://127.0.0.1:5000/api/graph/notifications --email-id 1
+    python tools/fake_graph_notifier.py notify --url ... --email-id 1 --count 5 --lifecycle missed
+    python tools/fake_graph_notifier.py notify --url ... --subscription-id xxx --client-state yyy
+"""
+
+import argparse
+import os
+import secrets
+import sqlite3
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'huohuo_email.db')
+
+
+def load_subscription(db_path, email_id):
+    """从数据库读取邮箱的订阅ID和 clientState"""
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT subscription_id, client_state, expires_at FROM graph_subscriptions WHERE email_id = ?",
+            (email_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row or not row[0]:
+        raise SystemExit(f"邮箱 ID:{email_id} 没有可用的Graph订阅")
+    return row
+
+
+def build_notification(subscription_id, client_state, change_type, lifecycle=None):
+    expires = (datetime.now(timezone.utc) + timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+    if lifecycle:
+        return {
+            'subscriptionId': subscription_id,
+            'subscriptionExpirationDateTime': expires,
+            'lifecycleEvent': lifecycle,
+            'clientState': client_state,
+            'tenantId': str(uuid.uuid4()),
+        }
+    message_id = 'AAMk' + secrets.token_hex(16)
+    return {
+        'subscriptionId': subscription_id,
+        'subscriptionExpirationDateTime': expires,
+        'changeType': change_type,
+        'resource': f"Users/{uuid.uuid4()}/Messages/{message_id}",
+        'resourceData': {
+            '@odata.type': '#Microsoft.Graph.Message',
+            '@odata.id': f"Users/{uuid.uuid4()}/Messages/{message_id}",
+            'id': message_id,
+        },
+        'clientState': client_state,
+        'tenantId': str(uuid.uuid4()),
+    }
+
+
+def cmd_validate(args):
+    token = secrets.token_urlsafe(16)
+    resp = requests.post(args.url, params={'validationToken': token}, timeout=10)
+    ok = resp.status_code == 200 and resp.text == token
+    print(f"验证握手: HTTP {resp.status_code}, 返回{'一致' if ok else '不一致'}")
+    return 0 if ok else 1
+
+
+def cmd_notify(args):
+    if args.subscription_id:
+        subscription_id, client_state = args.subscription_id, args.client_state or ''
+    else:
+        if args.email_id is None:
+            raise SystemExit("需要 --email-id 或 --subscription-id")
+        subscription_id, client_state, _ = load_subscription(args.db, args.email_id)
+    if args.bad_client_state:
+        client_state = 'invalid-' + secrets.token_hex(4)
+
+    payload = {'value': [
+        build_notification(subscription_id, client_state, args.change_type, args.lifecycle)
+        for _ in range(args.count)
+    ]}
+    resp = requests.post(args.url, json=payload, timeout=10)
+    print(f"推送 {args.count} 条通知: HTTP {resp.status_code} {resp.text.strip()}")
+    return 0 if resp.status_code in (200, 202) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟 Microsoft Graph 变更通知')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    validate = sub.add_parser('validate', help='发送订阅验证请求')
+    validate.add_argument('--url', required=True)
+
+    notify = sub.add_parser('notify', help='发送变更通知')
+    notify.add_argument('--url', required=True)
+    notify.add_argument('--db', default=DEFAULT_DB)
+    notify.add_argument('--email-id', type=int)
+    notify.add_argument('--subscription-id')
+    notify.add_argument('--client-state')
+    notify.add_argument('--change-type', default='created', choices=['created', 'updated', 'deleted'])
+    notify.add_argument('--lifecycle', choices=['missed', 'reauthorizationRequired', 'subscriptionRemoved'])
+    notify.add_argument('--count', type=int, default=1)
+    notify.add_argument('--bad-client-state', action='store_true', help='使用错误的 clientState，验证通知会被拒绝')
+
+    args = parser.parse_args()
+    handler = {'validate': cmd_validate, 'notify': cmd_notify}[args.command]
+    sys.exit(handler(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+IMAP传输基准测试
+对比 COMPRESS=DEFLATE 与 TLS 会话复用开启前后的线路字节数和握手耗时
+
+用法（在 backend 目录下执行）:
+    python tools/imap_bench.py --server imap.example.com --user me@example.com --password xxx
+    python tools/imap_bench.py --server 127.0.0.1 --port 143 --no-ssl --user u --password p --rounds 5 --messages 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.email import imap_transport  # noqa: E402
+from utils.email.imap import IMAPMailHandler  # noqa: E402
+
+MODES = [
+    ('plain', False, False),
+    ('tls-reuse', False, True),
+    ('compress', True, False),
+    ('tuned', True, True),
+]
+
+
+def run_round(args):
+    """建立一次连接，登录后拉取最近若干封邮件的邮件头"""
+    start = time.monotonic()
+    mail = IMAPMailHandler._open_connection(args.server, args.port, not args.no_ssl)
+    try:
+        mail.login(args.user, args.password)
+        IMAPMailHandler._enable_extensions(mail)
+        typ, _ = mail.select(IMAPMailHandler._quote_folder(args.folder), readonly=True)
+        if typ != 'OK':
+            raise RuntimeError(f"无法打开文件夹 {args.folder}")
+        typ, data = mail.uid('SEARCH', 'ALL')
+        uids = (data[0] or b'').split()[-args.messages:]
+        if uids:
+            mail.uid('FETCH', b','.join(uids).decode(), '(UID FLAGS BODY.PEEK[HEADER])')
+        return {
+            'elapsed': time.monotonic() - start,
+            'handshake': mail.handshake_seconds,
+            'reused': mail.session_reused,
+            'compressed': mail.compressed,
+        }
+    finally:
+        IMAPMailHandler._logout(mail)
+
+
+def run_mode(args, name, compress, reuse):
+    imap_transport.COMPRESS_ENABLED = compress
+    imap_transport.SESSION_REUSE_ENABLED = reuse
+    imap_transport._sessions.clear()
+    imap_transport.stats.reset()
+
+    rounds = [run_round(args) for _ in range(args.rounds)]
+    snapshot = imap_transport.stats.snapshot()
+    return {
+        'mode': name,
+        'rounds': len(rounds),
+        'avg_ms': sum(r['elapsed'] for r in rounds) * 1000 / len(rounds),
+        'avg_handshake_ms': snapshot['avg_handshake_ms'],
+        'reused': snapshot['sessions_reused'],
+        'compressed': snapshot['compressed_connections'],
+        'sent': snapshot['bytes_sent'],
+        'received': snapshot['bytes_received'],
+        'uncompressed': snapshot['bytes_received_uncompressed'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='IMAP COMPRESS/TLS 会话复用基准测试')
+    parser.add_argument('--server', required=True)
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--folder', default='INBOX')
+    parser.add_argument('--no-ssl', action='store_true')
+    parser.add_argument('--rounds', type=int, default=3, help='每种模式的连接次数')
+    parser.add_argument('--messages', type=int, default=20, help='每次拉取邮件头的邮件数')
+    parser.add_argument('--modes', default=','.join(name for name, _, _ in MODES))
+    args = parser.parse_args()
+    args.port = args.port or (143 if args.no_ssl else 993)
+
+    wanted = [name.strip() for name in args.modes.split(',') if name.strip()]
+    results = [run_mode(args, name, compress, reuse) for name, compress, reuse in MODES if name in wanted]
+
+    header = f"{'模式':<10} {'平均耗时ms':>10} {'握手ms':>8} {'会话复用':>8} {'压缩':>4} {'发送字节':>10} {'接收字节':>10} {'解压后':>10}"
+    print(header)
+    for r in results:
+        print(
+            f"{r['mode']:<10} {r['avg_ms']:>10.1f} {r['avg_handshake_ms']:>8.1f} {r['reused']:>8} "
+            f"{r['compressed']:>4} {r['sent']:>10} {r['received']:>10} {r['uncompressed']:>10}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,110 @@
 ﻿"""Realtime email checking scheduler."""
 
+import heapq
 import logging
+import math
+import os
 import threading
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+
+from .circuit_breaker import retry_time
 
 logger = logging.getLogger(__name__)
 
+# Polling interval bounds for a single account (seconds).
+MIN_INTERVAL = int(os.environ.get("REALTIME_MIN_INTERVAL", "60"))
+MAX_INTERVAL = int(os.environ.get("REALTIME_MAX_INTERVAL", "1800"))
+# Aim for this many expected new mails between two polls of an account.
+TARGET_ARRIVALS = float(os.environ.get("REALTIME_TARGET_ARRIVALS", "0.5"))
+# Time constant of the arrival-rate EWMA (seconds).
+RATE_WINDOW = float(os.environ.get("REALTIME_RATE_WINDOW", "21600"))
+# An account opened in the UI is polled at MIN_INTERVAL for this long.
+ACTIVE_WINDOW = int(os.environ.get("REALTIME_ACTIVE_WINDOW", "600"))
+# How often the enabled account list and Graph subscriptions are reloaded.
+ACCOUNT_REFRESH_SECONDS = int(os.environ.get("REALTIME_ACCOUNT_REFRESH", "60"))
+# A queued check that has not finished after this long is treated as lost.
+JOB_TIMEOUT_SECONDS = int(os.environ.get("REALTIME_JOB_TIMEOUT", "3600"))
+# Queue priority of checks for accounts the user is looking at.
+ACTIVE_PRIORITY = 10
+
+
+def _parse_check_time(value):
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class _AccountState:
+    """Scheduling state of one account."""
+
+    __slots__ = ("account", "next_due", "rate", "last_check", "failures", "active_until", "running", "submitted_at")
+
+    def __init__(self, account, next_due):
+        self.account = account
+        self.next_due = next_due
+        self.rate = None
+        self.last_check = _parse_check_time(account.get("last_check_time"))
+        self.failures = 0
+        self.active_until = 0.0
+        self.running = False
+        self.submitted_at = 0.0
+
+    def observe(self, new_mails, now):
+        """Fold the mails found since the previous check into the arrival-rate EWMA."""
+        if self.last_check is not None and now > self.last_check:
+            elapsed = now - self.last_check
+            observed = new_mails / elapsed
+            if self.rate is None:
+                self.rate = observed
+            else:
+                weight = 1 - math.exp(-elapsed / RATE_WINDOW)
+                self.rate = weight * observed + (1 - weight) * self.rate
+        self.last_check = now
+
+    def interval(self, base_interval, now):
+        if self.active_until > now:
+            interval = MIN_INTERVAL
+        elif self.rate is None:
+            interval = base_interval
+        elif self.rate <= 0:
+            interval = MAX_INTERVAL
+        else:
+            interval = TARGET_ARRIVALS / self.rate
+        interval = min(MAX_INTERVAL, max(MIN_INTERVAL, interval))
+        if self.failures:
+            interval = min(MAX_INTERVAL, interval * 2 ** self.failures)
+        return interval
+
 
 class RealTimeChecker:
-    """Run realtime sync in fixed-size rotating batches."""
+    """Schedule realtime sync by per-account next-due time and keep the sync job queue fed."""
 
-    def __init__(self, db, email_processor, batch_size=5):
+    def __init__(self, db, email_processor, max_concurrent=None):
         self.db = db
         self.email_processor = email_processor
         self.running = False
         self.thread = None
         self.check_interval = 300
-        self.batch_size = max(1, int(batch_size))
+        self.max_concurrent = max(1, int(max_concurrent or getattr(email_processor, "realtime_workers", 5)))
 
         self._lock = threading.Lock()
         self._stop_event = threading.Event()
-        self._cursor = 0
-        self._eligible_accounts = []
-        self._last_round_started_at = None
-        self._last_round_selected = []
+        self._wake = threading.Event()
+        self._states = {}
+        self._heap = []
+        self._polled_ids = set()
+        self._accounts_loaded_at = 0.0
+        self._eligible_count = 0
+        self._subscribed_count = 0
+        self._submitted = 0
+        # Set by standalone workers; only accounts of this shard are scheduled.
+        self.shard = None
+
+        job_worker = getattr(email_processor, "job_worker", None)
+        if job_worker is not None:
+            job_worker.add_listener(self._on_job_finished)
 
     def start(self, check_interval=60):
         if self.running:
@@ -34,12 +114,13 @@ class RealTimeChecker:
         self.check_interval = max(int(check_interval), 30)
         self.running = True
         self._stop_event.clear()
+        self._accounts_loaded_at = 0.0
         self.thread = threading.Thread(target=self._check_loop, daemon=True)
         self.thread.start()
         logger.info(
-            "Realtime checker started: interval=%ss, batch_size=%s",
+            "Realtime checker started: base_interval=%ss, max_concurrent=%s",
             self.check_interval,
-            self.batch_size,
+            self.max_concurrent,
         )
         return True
 
@@ -50,21 +131,54 @@ class RealTimeChecker:
 
         self.running = False
         self._stop_event.set()
+        self._wake.set()
         if self.thread:
             self.thread.join(timeout=5)
         logger.info("Realtime checker stopped")
         return True
 
+    def mark_active(self, email_id):
+        """Poll an account soon and at the shortest interval while the user is looking at it."""
+        now = time.time()
+        with self._lock:
+            state = self._states.get(email_id)
+            if state is None:
+                return False
+            state.active_until = now + ACTIVE_WINDOW
+            due = now if state.last_check is None or now - state.last_check >= MIN_INTERVAL else state.last_check + MIN_INTERVAL
+            if due < state.next_due and not state.running:
+                self._schedule(state, due)
+        self._wake.set()
+        return True
+
     def get_runtime_status(self):
+        now = time.time()
         with self._lock:
+            upcoming = sorted(
+                (state for state in self._states.values() if state.account.get("id") in self._polled_ids),
+                key=lambda s: s.next_due,
+            )[:10]
             return {
                 "running": self.running,
                 "check_interval": self.check_interval,
-                "batch_size": self.batch_size,
-                "eligible_count": len(self._eligible_accounts),
-                "next_cursor": self._cursor,
-                "last_round_started_at": self._last_round_started_at,
-                "last_round_selected": list(self._last_round_selected),
+                "max_concurrent": self.max_concurrent,
+                "shard": str(self.shard) if self.shard else None,
+                "inflight": self._inflight_count(),
+                "eligible_count": self._eligible_count,
+                "subscribed_count": self._subscribed_count,
+                "submitted": self._submitted,
+                "upcoming": [
+                    {
+                        "id": s.account.get("id"),
+                        "email": s.account.get("email"),
+                        "due_in": round(s.next_due - now, 1),
+                        "interval": round(s.interval(self.check_interval, now), 1),
+                        "mails_per_hour": round(s.rate * 3600, 2) if s.rate is not None else None,
+                        "failures": s.failures,
+                        "active": s.active_until > now,
+                    }
+                    for s in upcoming
+                ],
             }
 
     def _collect_enabled_accounts(self):
@@ -73,96 +187,187 @@ class RealTimeChecker:
         for user in users:
             user_accounts = self.db.get_user_emails(user["id"]) or []
             for acc in user_accounts:
-                accounts.append(acc)
+                if self.shard is None or self.shard.owns(acc.get("id")):
+                    accounts.append(acc)
 
         accounts.sort(key=lambda x: (x.get("user_id", 0), x.get("id", 0)))
         return accounts
 
-    def _select_next_batch(self, accounts):
-        if not accounts:
-            return []
+    def _inflight_count(self):
+        return sum(1 for state in list(self._states.values()) if state.running)
 
-        total = len(accounts)
-        if self._cursor >= total:
-            self._cursor = 0
+    def _schedule(self, state, due):
+        # Caller holds self._lock; superseded heap entries are skipped when popped.
+        state.next_due = due
+        heapq.heappush(self._heap, (due, state.account["id"]))
 
-        start = self._cursor
-        count = min(self.batch_size, total)
-        indices = [(start + i) % total for i in range(count)]
-        selected = [accounts[i] for i in indices]
-        self._cursor = (start + count) % total
-        return selected
+    def _reload_accounts(self, now):
+        accounts = self._collect_enabled_accounts()
+        # Subscribed Outlook accounts are synced by notifications; poll them only as a fallback.
+        polled = self._refresh_subscriptions(accounts)
+        with self._lock:
+            current = {}
+            for account in accounts:
+                account_id = account.get("id")
+                if not account_id:
+                    continue
+                state = self._states.get(account_id)
+                if state is None:
+                    last_check = _parse_check_time(account.get("last_check_time"))
+                    state = _AccountState(account, 0)
+                    self._schedule(state, max(now, last_check + self.check_interval) if last_check else now)
+                else:
+                    state.account = account
+                current[account_id] = state
+            self._states = current
+            self._polled_ids = {account.get("id") for account in polled}
+            self._eligible_count = len(accounts)
+        self._accounts_loaded_at = now
 
-    def _wait_next_round(self):
-        # Wait in small steps so stop() can break promptly.
-        for _ in range(self.check_interval):
-            if not self.running or self._stop_event.is_set():
-                break
-            self._stop_event.wait(1)
+    def _pop_due(self, now):
+        """Return the next due account state, or the seconds until one becomes due."""
+        with self._lock:
+            while self._heap:
+                due, account_id = self._heap[0]
+                state = self._states.get(account_id)
+                if state is not None and state.running:
+                    if now - state.submitted_at <= JOB_TIMEOUT_SECONDS:
+                        if due > now:
+                            # The earliest entry is this job's watchdog; nothing else is due before it.
+                            return None, due - now
+                        heapq.heappop(self._heap)
+                        continue
+                    # The finish callback never came; release the slot and poll the account again.
+                    logger.warning("Realtime job for id=%s did not finish in time, rescheduling", account_id)
+                    state.running = False
+                    heapq.heappop(self._heap)
+                    self._schedule(state, now)
+                    continue
+                if state is None or due != state.next_due:
+                    heapq.heappop(self._heap)
+                    continue
+                if due > now:
+                    return None, due - now
+                heapq.heappop(self._heap)
+                if account_id not in self._polled_ids:
+                    # Covered by a Graph subscription; look again after the next reload.
+                    self._schedule(state, now + ACCOUNT_REFRESH_SECONDS)
+                    continue
+                return state, 0
+            return None, None
 
     def _check_loop(self):
         while self.running and not self._stop_event.is_set():
             try:
-                accounts = self._collect_enabled_accounts()
-                with self._lock:
-                    self._eligible_accounts = accounts
-
-                if not accounts:
-                    logger.info("No realtime-enabled email accounts")
-                    self._wait_next_round()
-                    continue
-
-                selected = self._select_next_batch(accounts)
-                round_started = datetime.now().isoformat()
+                now = time.time()
+                if now - self._accounts_loaded_at >= ACCOUNT_REFRESH_SECONDS:
+                    self._reload_accounts(now)
 
-                selected_info = [
-                    {
-                        "id": acc.get("id"),
-                        "email": acc.get("email"),
-                        "user_id": acc.get("user_id"),
-                        "mail_type": acc.get("mail_type"),
-                    }
-                    for acc in selected
-                ]
-                with self._lock:
-                    self._last_round_started_at = round_started
-                    self._last_round_selected = selected_info
-
-                logger.info(
-                    "Realtime round started: selected=%s/%s, next_cursor=%s",
-                    len(selected),
-                    len(accounts),
-                    self._cursor,
-                )
-
-                for account in selected:
-                    if not self.running or self._stop_event.is_set():
+                self._wake.clear()
+                wait = ACCOUNT_REFRESH_SECONDS - (now - self._accounts_loaded_at)
+                while self.running and self._inflight_count() < self.max_concurrent:
+                    state, delay = self._pop_due(time.time())
+                    if state is None:
+                        if delay is not None:
+                            wait = min(wait, delay)
                         break
+                    self._submit_check_task(state)
 
-                    account_id = account.get("id")
-                    if not account_id:
-                        continue
-
-                    if self.email_processor.is_email_being_processed(account_id):
-                        logger.info("Skip busy account id=%s email=%s", account_id, account.get("email"))
-                        continue
-
-                    self._submit_check_task(account)
-
-                self._wait_next_round()
+                # Woken early by finished tasks, mark_active() or stop().
+                self._wake.wait(max(0.05, min(wait, ACCOUNT_REFRESH_SECONDS)))
             except Exception as exc:
                 logger.error("Realtime check loop error: %s", exc)
-                self._wait_next_round()
+                self._stop_event.wait(5)
 
-    def _submit_check_task(self, account):
+    def _refresh_subscriptions(self, accounts):
+        """Create or renew Graph subscriptions and return the accounts that still need polling."""
+        subscriptions = getattr(self.email_processor, "graph_subscriptions", None)
+        if subscriptions is None or not subscriptions.enabled:
+            with self._lock:
+                self._subscribed_count = 0
+            return accounts
+
+        polled = []
+        subscribed = 0
+        for account in accounts:
+            if not self.running or self._stop_event.is_set():
+                break
+            if subscriptions.ensure(account):
+                subscribed += 1
+                if subscriptions.covers(account):
+                    continue
+            polled.append(account)
+        with self._lock:
+            self._subscribed_count = subscribed
+        return polled
+
+    def _submit_check_task(self, state):
+        account = state.account
         account_id = account.get("id")
+        now = time.time()
 
-        def progress_callback(progress, message):
-            logger.info("Realtime progress id=%s %s%% %s", account_id, progress, message)
+        if self.email_processor.is_email_being_processed(account_id):
+            # A manual check is running; it updates the mailbox anyway.
+            logger.info("Skip busy account id=%s email=%s", account_id, account.get("email"))
+            with self._lock:
+                self._schedule(state, now + MIN_INTERVAL)
+            return
 
-        self.email_processor.realtime_thread_pool.submit(
-            self.email_processor._check_email_task,
-            account,
-            progress_callback,
+        breaker = self.email_processor.circuit_breakers.blocked(account, now)
+        if breaker:
+            # Account or server circuit is open; come back when it allows a probe.
+            logger.info("Skip account id=%s email=%s: circuit %s open", account_id, account.get("email"), breaker["key"])
+            with self._lock:
+                self._schedule(state, max(now + MIN_INTERVAL, retry_time(breaker)))
+            return
+
+        with self._lock:
+            state.running = True
+            state.submitted_at = now
+            self._submitted += 1
+            # Watchdog entry: _pop_due reclaims the slot if the job never reports back.
+            heapq.heappush(self._heap, (now + JOB_TIMEOUT_SECONDS + 1, account_id))
+        # The checker retries on its own schedule, so the queue does not retry realtime jobs.
+        job_id = self.email_processor.enqueue_job(
+            account_id,
+            "incremental",
+            priority=ACTIVE_PRIORITY if state.active_until > now else 0,
+            max_attempts=1,
+        )
+        if job_id is None:
+            with self._lock:
+                state.running = False
+                self._schedule(state, now + MIN_INTERVAL)
+            logger.error("Failed to enqueue realtime job id=%s", account_id)
+            return
+        logger.info("Queued realtime job %s: id=%s email=%s", job_id, account_id, account.get("email"))
+
+    def _on_job_finished(self, job, result):
+        if job.get("job_type") != "incremental":
+            return
+        now = time.time()
+        with self._lock:
+            state = self._states.get(job.get("email_id"))
+            if state is None or not state.running:
+                return
+            state.running = False
+            if result.get("success"):
+                state.failures = 0
+                state.observe(int(result.get("saved") or 0), now)
+            elif result.get("cancelled") and not result.get("retry"):
+                # Stopped on request rather than a server failure; keep the current backoff
+                pass
+            elif not result.get("circuit"):
+                state.failures += 1
+            interval = state.interval(self.check_interval, now)
+            if result.get("circuit"):
+                # The circuit opened after the job was queued; the breaker owns the backoff.
+                interval = max(MIN_INTERVAL, result["circuit"]["retry_at"] - now)
+            self._schedule(state, now + interval)
+        logger.info(
+            "Realtime task done: id=%s success=%s next_in=%.0fs",
+            state.account.get("id"),
+            bool(result.get("success")),
+            interval,
         )
-        logger.info("Submitted realtime task: id=%s email=%s", account_id, account.get("email"))
+        self._wake.set()
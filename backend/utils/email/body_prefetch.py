@@ -0,0 +1,80 @@
+"""
+Graph邮件正文预取模块
+preview 模式同步后，在后台为未读和最近收到的邮件补全正文，
+用户打开这些邮件时无需再等待网络请求
+"""
+
+import os
+import threading
+import logging
+import concurrent.futures
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+from .outlook import OutlookMailHandler
+from .token_cache import token_cache
+
+logger = logging.getLogger(__name__)
+
+# 预取最近多少天收到的邮件（未读邮件不受此限制），每轮每个邮箱最多预取多少封
+PREFETCH_DAYS = int(os.environ.get('GRAPH_BODY_PREFETCH_DAYS', '3'))
+PREFETCH_LIMIT = int(os.environ.get('GRAPH_BODY_PREFETCH_LIMIT', '200'))
+PREFETCH_WORKERS = max(1, int(os.environ.get('GRAPH_BODY_PREFETCH_WORKERS', '2')))
+
+
+class BodyPrefetcher:
+    """后台正文预取，同一邮箱同时只有一个预取任务"""
+
+    def __init__(self):
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def schedule(self, db, email_info):
+        """提交邮箱的正文预取任务，已在队列中时忽略"""
+        if PREFETCH_LIMIT <= 0:
+            return False
+        email_id = email_info['id']
+        with self._lock:
+            if email_id in self._pending:
+                return False
+            self._pending.add(email_id)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=PREFETCH_WORKERS, thread_name_prefix='body-prefetch'
+                )
+            self._executor.submit(self._run, db, dict(email_info))
+        return True
+
+    def _run(self, db, email_info):
+        email_id = email_info['id']
+        try:
+            since = datetime.now(timezone.utc) - timedelta(days=PREFETCH_DAYS)
+            pending = db.get_mails_without_body(email_id, since=since, limit=PREFETCH_LIMIT)
+            if not pending:
+                return
+            message_ids = [row['graph_message_id'] for row in pending]
+            loaded = 0
+            for start in range(0, len(message_ids), OutlookMailHandler.GRAPH_BATCH_SIZE):
+                chunk = message_ids[start:start + OutlookMailHandler.GRAPH_BATCH_SIZE]
+                access_token = token_cache.get_access_token(db, email_info)
+                if not access_token:
+                    logger.warning(f"邮箱 ID:{email_id} 获取访问令牌失败，停止预取正文")
+                    return
+                try:
+                    bodies = OutlookMailHandler.fetch_message_bodies(access_token, chunk)
+                except requests.HTTPError as e:
+                    if e.response is not None and e.response.status_code == 401:
+                        token_cache.invalidate(email_id, access_token)
+                    raise
+                loaded += db.update_mail_bodies(email_id, bodies)
+            logger.info(f"邮箱 ID:{email_id} 已预取 {loaded} 封邮件正文")
+        except Exception as e:
+            logger.warning(f"邮箱 ID:{email_id} 预取邮件正文失败: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending.discard(email_id)
+
+
+body_prefetcher = BodyPrefetcher()
@@ -0,0 +1,143 @@
+"""
+同步任务的协作式取消
+每次同步持有一个 CancelToken，停止请求或超过截止时间后，拉取循环在邮件之间、分页之间检查并退出；
+网络读写的超时不超过剩余时间，取消时关闭已登记的连接，阻塞中的读写立即返回
+"""
+
+import os
+import threading
+import concurrent.futures
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 单次同步的截止时间（秒）
+SYNC_DEADLINE_SECONDS = float(os.environ.get('SYNC_JOB_DEADLINE', '600'))
+# 剩余时间很少时网络操作的最小超时，避免超时为 0 变成非阻塞
+MIN_TIMEOUT_SECONDS = 1.0
+
+CANCELLED = 'cancelled'
+TIMED_OUT = 'timeout'
+
+
+class SyncCancelled(Exception):
+    """同步被停止或超过截止时间"""
+
+    def __init__(self, reason=CANCELLED):
+        super().__init__('同步已超时' if reason == TIMED_OUT else '同步已取消')
+        self.reason = reason
+
+
+class CancelToken:
+    """可在多个线程间共享的取消令牌"""
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+        self.deadline = None
+        if timeout:
+            self.set_deadline(timeout)
+
+    def set_deadline(self, timeout):
+        """从现在起 timeout 秒后视为超时"""
+        self.deadline = time.monotonic() + timeout
+
+    def cancel(self, reason=CANCELLED):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"取消回调出错: {str(e)}")
+        return True
+
+    def _expired(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            # 超时后同样关闭登记的连接
+            self.cancel(TIMED_OUT)
+        return self._event.is_set()
+
+    @property
+    def cancelled(self):
+        return self._expired()
+
+    @property
+    def timed_out(self):
+        return self._expired() and self.reason == TIMED_OUT
+
+    def remaining(self):
+        """距截止时间的秒数，没有截止时间时为 None"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        if self._expired():
+            raise SyncCancelled(self.reason)
+
+    def timeout(self, default):
+        """网络操作的超时：不超过 default 和剩余时间"""
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return max(MIN_TIMEOUT_SECONDS, min(default, remaining)) if default else max(MIN_TIMEOUT_SECONDS, remaining)
+
+    def sleep(self, seconds):
+        """可被取消打断的等待"""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._event.wait(seconds)
+        self.check()
+
+    def on_cancel(self, callback):
+        """登记取消时执行的回调（如关闭连接），已取消时立即执行；返回注销函数"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+# 以下函数允许 cancel 为 None，供可选传入令牌的处理器使用
+
+def check(cancel):
+    if cancel is not None:
+        cancel.check()
+
+
+def timeout(cancel, default):
+    return default if cancel is None else cancel.timeout(default)
+
+
+def sleep(cancel, seconds):
+    if cancel is None:
+        time.sleep(seconds)
+    else:
+        cancel.sleep(seconds)
+
+
+def wait_result(cancel, future, poll=0.5):
+    """等待后台线程中的操作完成，期间检查取消，取消后不再等待"""
+    if cancel is None:
+        return future.result()
+    while True:
+        try:
+            return future.result(timeout=poll)
+        except concurrent.futures.TimeoutError:
+            cancel.check()
@@ -0,0 +1,138 @@
+"""
+手动检查任务
+/api/emails/<id>/check 和 batch_check 提交后立即返回任务ID，同步在线程池中进行；
+任务记录各邮箱的进度和结果，结束后保留一段时间供查询，进度变化通知 listeners(user_id, message)
+"""
+
+import os
+import uuid
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+# 已结束任务的保留时长（秒）
+RETENTION_SECONDS = float(os.environ.get('CHECK_JOB_RETENTION', '3600'))
+
+
+class CheckJobs:
+    """进程内的检查任务表，一个任务包含一个或多个邮箱的子结果"""
+
+    def __init__(self, retention=RETENTION_SECONDS):
+        self.retention = retention
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def create(self, user_id, email_ids, kind='single'):
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'user_id': user_id,
+            'status': PENDING,
+            'created_at': now,
+            'updated_at': now,
+            'finished_at': None,
+            'results': {
+                email_id: {'status': PENDING, 'progress': 0, 'message': '等待检查', 'result': None}
+                for email_id in email_ids
+            },
+        }
+        with self._lock:
+            self._purge(now)
+            self._jobs[job['id']] = job
+            return self._snapshot(job)
+
+    def progress(self, job_id, email_id, progress, message):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            item = job and job['results'].get(email_id)
+            if not item or item['status'] not in (PENDING, RUNNING):
+                return
+            item.update(status=RUNNING, progress=progress, message=message)
+            job['status'] = RUNNING
+            job['updated_at'] = time.time()
+            user_id = job['user_id']
+            job_progress = self._progress(job)
+        self._notify(user_id, {
+            'type': 'check_progress',
+            'job_id': job_id,
+            'email_id': email_id,
+            'progress': progress,
+            'message': message,
+            'job_progress': job_progress,
+        })
+
+    def finish(self, job_id, email_id, result):
+        """记录一个邮箱的检查结果，所有邮箱都结束后任务结束"""
+        now = time.time()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            item = job and job['results'].get(email_id)
+            if not item or item['status'] in (COMPLETED, FAILED):
+                return
+            success = bool(result.get('success'))
+            item.update(status=COMPLETED if success else FAILED, progress=100,
+                        message=result.get('message') or '', result=result)
+            job['updated_at'] = now
+            done = all(sub['status'] in (COMPLETED, FAILED) for sub in job['results'].values())
+            if done:
+                # 任一邮箱成功即视为完成，各邮箱的失败原因见子结果
+                succeeded = any(sub['status'] == COMPLETED for sub in job['results'].values())
+                job['status'] = COMPLETED if succeeded else FAILED
+                job['finished_at'] = now
+            snapshot = self._snapshot(job)
+        if done:
+            logger.info(f"检查任务 {job_id} 结束: {snapshot['succeeded']} 个成功, {snapshot['failed']} 个失败")
+            self._notify(snapshot['user_id'], {'type': 'check_job', 'job': snapshot})
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job else None
+
+    def _purge(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished_at'] and job['finished_at'] + self.retention < now]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    @staticmethod
+    def _progress(job):
+        results = job['results'].values()
+        return int(sum(item['progress'] for item in results) / len(results)) if results else 100
+
+    @classmethod
+    def _snapshot(cls, job):
+        results = job['results']
+        return {
+            'id': job['id'],
+            'kind': job['kind'],
+            'user_id': job['user_id'],
+            'status': job['status'],
+            'progress': cls._progress(job),
+            'total': len(results),
+            'succeeded': sum(1 for item in results.values() if item['status'] == COMPLETED),
+            'failed': sum(1 for item in results.values() if item['status'] == FAILED),
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at'],
+            'finished_at': job['finished_at'],
+            'results': [dict(item, email_id=email_id) for email_id, item in results.items()],
+        }
+
+    def _notify(self, user_id, message):
+        for listener in list(self._listeners):
+            try:
+                listener(user_id, message)
+            except Exception as e:
+                logger.error(f"检查任务通知失败: {str(e)}")
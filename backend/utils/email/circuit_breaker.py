@@ -0,0 +1,241 @@
+"""
+邮箱和服务器的熔断器
+邮箱连续认证失败、网络失败或被限流后暂停同步，服务器上连续出现网络失败或限流（不区分邮箱）时暂停该服务器的所有邮箱。
+冷却时间按熔断次数指数增长，冷却结束后只放行一次探测：成功则恢复，失败则重新熔断。
+状态保存在 circuit_breakers 表中，多个同步进程共享
+"""
+
+import os
+import imaplib
+import threading
+import time
+import logging
+
+from .lanes import route_for
+
+logger = logging.getLogger(__name__)
+
+AUTH = 'auth'
+NETWORK = 'network'
+THROTTLE = 'throttle'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def _policy(failure_class, threshold, cooldown, max_cooldown):
+    prefix = f'BREAKER_{failure_class.upper()}'
+    return (
+        max(1, int(os.environ.get(f'{prefix}_THRESHOLD', threshold))),
+        float(os.environ.get(f'{prefix}_COOLDOWN', cooldown)),
+        float(os.environ.get(f'{prefix}_MAX_COOLDOWN', max_cooldown)),
+    )
+
+
+# 各类失败：连续失败多少次后熔断、首次冷却时间、冷却时间上限（秒）
+POLICIES = {
+    AUTH: _policy(AUTH, 2, 1800, 86400),
+    NETWORK: _policy(NETWORK, 3, 120, 3600),
+    THROTTLE: _policy(THROTTLE, 1, 300, 3600),
+}
+# 同一服务器连续多少次网络失败或限流后熔断整个服务器
+HOST_THRESHOLD = max(1, int(os.environ.get('BREAKER_HOST_THRESHOLD', '5')))
+# 半开状态的探测超过该时间仍没有结果时，允许重新探测
+PROBE_TIMEOUT_SECONDS = 900
+
+# 服务器返回的认证失败、限流提示（大写比较）
+_AUTH_MARKERS = (
+    'AUTHENTICATIONFAILED', 'AUTHORIZATIONFAILED', 'AUTHENTICATE FAILED', 'INVALID CREDENTIALS',
+    'LOGIN FAIL', 'LOGIN ERROR', 'PASSWORD', 'INVALID_GRANT',
+)
+_THROTTLE_MARKERS = ('[THROTTLED]', '[LIMIT]', '[UNAVAILABLE]', 'TOO MANY', 'RATE LIMIT')
+
+# 不是按邮箱域名推断服务器的类型
+_PROVIDER_HOSTS = {
+    'outlook': 'graph.microsoft.com',
+    'gmail': 'imap.gmail.com',
+    'qq': 'imap.qq.com',
+}
+
+
+def classify_error(error):
+    """
+    判断同步异常的类别，沿 __cause__ 查找被包装的原始异常
+
+    Returns:
+        str: AUTH / NETWORK / THROTTLE，无法判断时返回 None
+    """
+    while error is not None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if status in (401, 403):
+            return AUTH
+        if status in (429, 503):
+            return THROTTLE
+        if isinstance(error, imaplib.IMAP4.abort):
+            return NETWORK
+        if isinstance(error, imaplib.IMAP4.error):
+            text = str(error).upper()
+            if any(marker in text for marker in _THROTTLE_MARKERS):
+                return THROTTLE
+            if any(marker in text for marker in _AUTH_MARKERS):
+                return AUTH
+        # 套接字超时、SSL 错误、连接失败以及 requests 的网络异常都是 OSError
+        if isinstance(error, OSError):
+            return NETWORK
+        error = error.__cause__
+    return None
+
+
+def retry_time(breaker):
+    """熔断记录下次允许同步的时间（Unix 秒）"""
+    if breaker['state'] == HALF_OPEN:
+        return (breaker.get('probe_at') or 0) + PROBE_TIMEOUT_SECONDS
+    return breaker.get('retry_at') or 0
+
+
+_CLASS_NAMES = {AUTH: '认证失败', NETWORK: '连接失败', THROTTLE: '被服务器限流'}
+
+
+def describe(breaker):
+    """熔断原因和恢复时间的提示文字"""
+    scope, _, name = breaker['key'].partition(':')
+    reason = _CLASS_NAMES.get(breaker.get('failure_class'), '同步失败')
+    subject = f"服务器 {name} " if scope == 'host' else '邮箱'
+    resume = time.strftime('%H:%M:%S', time.localtime(retry_time(breaker)))
+    return f"{subject}{reason}，已暂停同步，{resume} 后重试"
+
+
+class CircuitBreakers:
+    """按邮箱和服务器维护的熔断状态"""
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host_of(email_info):
+        route = route_for(email_info)
+        return route.host or _PROVIDER_HOSTS.get(route.lane)
+
+    @staticmethod
+    def _keys(email_info):
+        """(服务器键, 邮箱键)，无法确定服务器时服务器键为 None"""
+        host = CircuitBreakers.host_of(email_info)
+        return (f'host:{host}' if host else None), f"account:{email_info['id']}"
+
+    @staticmethod
+    def _blocking(breaker, now):
+        if breaker['state'] == OPEN:
+            return (breaker.get('retry_at') or 0) > now
+        if breaker['state'] == HALF_OPEN:
+            # 探测进行中
+            return bool(breaker.get('probe_at')) and breaker['probe_at'] + PROBE_TIMEOUT_SECONDS > now
+        return False
+
+    def blocked(self, email_info, now=None):
+        """查询邮箱当前是否被熔断（不占用探测名额），返回起作用的熔断记录或 None"""
+        now = now or time.time()
+        for key in filter(None, self._keys(email_info)):
+            breaker = self.db.get_circuit_breaker(key)
+            if breaker and self._blocking(breaker, now):
+                return breaker
+        return None
+
+    def acquire(self, email_info, now=None):
+        """
+        同步前调用：没有熔断时放行；冷却已结束时占用探测名额后放行
+
+        Returns:
+            dict: 阻止本次同步的熔断记录，放行时返回 None
+        """
+        now = now or time.time()
+        breakers = [breaker for breaker in map(self.db.get_circuit_breaker, filter(None, self._keys(email_info))) if breaker]
+        for breaker in breakers:
+            if self._blocking(breaker, now):
+                return breaker
+        for breaker in breakers:
+            if breaker['state'] == CLOSED:
+                continue
+            # 多个进程同时到期时只有一个拿到探测名额
+            if not self.db.claim_circuit_probe(breaker['key'], now, now - PROBE_TIMEOUT_SECONDS):
+                return self.db.get_circuit_breaker(breaker['key']) or breaker
+            logger.info(f"熔断器 {breaker['key']} 冷却结束，放行一次探测")
+        return None
+
+    def record(self, email_info, failure_class=None, error=None, success=False, now=None):
+        """
+        记录一次同步结果
+
+        success 时关闭邮箱和服务器的熔断；failure_class 为 None 的失败（如用户取消、解析错误）不计入熔断，
+        只释放可能占用的探测名额
+        """
+        now = now or time.time()
+        host_key, account_key = self._keys(email_info)
+        with self._lock:
+            for key in (account_key, host_key):
+                if key is None:
+                    continue
+                breaker = self.db.get_circuit_breaker(key)
+                # 认证失败说明服务器可达，对服务器而言等同于成功
+                if success or (key == host_key and failure_class == AUTH):
+                    if breaker:
+                        self.db.delete_circuit_breaker(key)
+                        if breaker['state'] != CLOSED:
+                            logger.info(f"熔断器 {key} 已恢复")
+                    continue
+                if failure_class is None:
+                    if breaker and breaker['state'] == HALF_OPEN:
+                        self.db.save_circuit_breaker(dict(breaker, probe_at=None, updated_at=now))
+                    continue
+                threshold, cooldown, max_cooldown = POLICIES[failure_class]
+                if key == host_key:
+                    threshold = HOST_THRESHOLD
+                self._fail(key, breaker, email_info['id'] if key == account_key else None,
+                           failure_class, error, threshold, cooldown, max_cooldown, now)
+
+    def _fail(self, key, breaker, email_id, failure_class, error, threshold, cooldown, max_cooldown, now):
+        breaker = breaker or {'key': key, 'state': CLOSED, 'failures': 0, 'trips': 0, 'failure_class': None}
+        failures = breaker['failures'] + 1 if breaker.get('failure_class') == failure_class else 1
+        updated = dict(
+            breaker, email_id=email_id, failure_class=failure_class, failures=failures,
+            last_error=str(error or '')[:500] or None, probe_at=None, updated_at=now
+        )
+        if breaker['state'] == HALF_OPEN or failures >= threshold:
+            trips = breaker['trips'] + 1
+            delay = min(max_cooldown, cooldown * 2 ** (trips - 1))
+            updated.update(state=OPEN, trips=trips, retry_at=now + delay)
+            logger.warning(f"熔断器 {key} 打开: {failure_class} 连续失败 {failures} 次，{delay:.0f} 秒后探测: {updated['last_error']}")
+        else:
+            updated.update(state=CLOSED, retry_at=None)
+        self.db.save_circuit_breaker(updated)
+
+    def status_for(self, emails, now=None):
+        """
+        邮箱列表中各邮箱的熔断状态，邮箱本身和所在服务器都熔断时优先显示邮箱的
+
+        Returns:
+            dict: {email_id: {'scope', 'state', 'failure_class', 'failures', 'retry_at', 'last_error'}}
+        """
+        now = now or time.time()
+        breakers = {breaker['key']: breaker for breaker in self.db.get_circuit_breakers()}
+        if not breakers:
+            return {}
+        result = {}
+        for email_info in emails:
+            host_key, account_key = self._keys(email_info)
+            for key in (account_key, host_key):
+                breaker = breakers.get(key)
+                if not breaker or breaker['state'] == CLOSED:
+                    continue
+                result[email_info['id']] = {
+                    'scope': key.split(':', 1)[0],
+                    # 冷却已结束、等待探测的显示为半开
+                    'state': breaker['state'] if self._blocking(breaker, now) else HALF_OPEN,
+                    'failure_class': breaker['failure_class'],
+                    'failures': breaker['failures'],
+                    'retry_at': retry_time(breaker),
+                    'last_error': breaker['last_error'],
+                }
+                break
+        return result
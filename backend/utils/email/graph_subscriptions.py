@@ -0,0 +1,186 @@
+"""
+Graph变更通知订阅模块
+为开启实时检查的 Outlook 邮箱订阅收件箱变更，收到通知后触发增量同步；
+未配置 GRAPH_WEBHOOK_URL 或订阅不可用的邮箱仍由 RealTimeChecker 轮询
+"""
+
+import os
+import hmac
+import secrets
+import threading
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+from .outlook import OutlookMailHandler
+from .token_cache import token_cache
+from .job_queue import JOB_INCREMENTAL
+
+logger = logging.getLogger(__name__)
+
+# Graph 推送通知的公网地址，指向 /api/graph/notifications；为空时不创建订阅
+WEBHOOK_URL = os.environ.get('GRAPH_WEBHOOK_URL', '').strip()
+# 订阅有效期（分钟），邮件资源最长不超过 10080
+SUBSCRIPTION_MINUTES = min(10080, int(os.environ.get('GRAPH_SUBSCRIPTION_MINUTES', '4200')))
+# 剩余有效期不足该秒数时续订
+RENEW_BEFORE_SECONDS = int(os.environ.get('GRAPH_SUBSCRIPTION_RENEW_BEFORE', '43200'))
+# 创建订阅失败后多久再试
+RETRY_SECONDS = int(os.environ.get('GRAPH_SUBSCRIPTION_RETRY', '1800'))
+# 有订阅的邮箱仍按该间隔兜底轮询一次，防止漏掉通知
+FALLBACK_POLL_SECONDS = int(os.environ.get('GRAPH_SUBSCRIPTION_POLL_INTERVAL', '3600'))
+# 收到通知后等待合并同一邮箱的后续通知
+NOTIFICATION_DEBOUNCE_SECONDS = float(os.environ.get('GRAPH_NOTIFICATION_DEBOUNCE', '2'))
+
+INBOX_RESOURCE = "me/mailFolders('Inbox')/messages"
+
+
+def _parse_graph_time(value):
+    """解析 Graph 返回的 UTC 时间（小数秒可能有 7 位），返回时间戳"""
+    if not value:
+        return None
+    text = str(value).rstrip('Z')
+    if '.' in text:
+        head, fraction = text.split('.', 1)
+        text = f"{head}.{fraction[:6]}"
+    try:
+        return int(datetime.fromisoformat(text).replace(tzinfo=timezone.utc).timestamp())
+    except ValueError:
+        return None
+
+
+class GraphSubscriptionManager:
+    """创建、续订 Graph 订阅，并把收到的通知转换为同步任务"""
+
+    def __init__(self, db, email_processor):
+        self.db = db
+        self.email_processor = email_processor
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(WEBHOOK_URL)
+
+    def ensure(self, account):
+        """
+        确保邮箱有可用订阅，临近过期时续订
+
+        Returns:
+            bool: 订阅是否可用
+        """
+        if not self.enabled or account.get('mail_type') != 'outlook':
+            return False
+        email_id = account['id']
+        sub = self.db.get_graph_subscription(email_id)
+        now = int(time.time())
+        active = bool(sub and sub['status'] == 'active' and sub['subscription_id'] and (sub['expires_at'] or 0) > now)
+        if active and sub['expires_at'] - now > RENEW_BEFORE_SECONDS:
+            return True
+        if sub and sub['status'] == 'failed' and now - (sub['updated_at'] or 0) < RETRY_SECONDS:
+            return False
+
+        access_token = token_cache.get_access_token(self.db, account)
+        if not access_token:
+            self.db.save_graph_subscription(email_id, None, INBOX_RESOURCE, None, None, status='failed', last_error='获取访问令牌失败')
+            return False
+
+        expiration = datetime.now(timezone.utc) + timedelta(minutes=SUBSCRIPTION_MINUTES)
+        try:
+            if active:
+                try:
+                    result = OutlookMailHandler.renew_subscription(access_token, sub['subscription_id'], expiration)
+                    expires_at = _parse_graph_time(result.get('expirationDateTime')) or int(expiration.timestamp())
+                    self.db.save_graph_subscription(email_id, sub['subscription_id'], sub['resource'], sub['client_state'], expires_at)
+                    logger.info(f"邮箱 {account.get('email')} 的Graph订阅已续订")
+                    return True
+                except requests.exceptions.HTTPError as e:
+                    if getattr(e.response, 'status_code', None) != 404:
+                        raise
+                    logger.info(f"邮箱 {account.get('email')} 的Graph订阅已不存在，重新创建")
+
+            client_state = secrets.token_urlsafe(24)
+            result = OutlookMailHandler.create_subscription(access_token, INBOX_RESOURCE, WEBHOOK_URL, client_state, expiration)
+            expires_at = _parse_graph_time(result.get('expirationDateTime')) or int(expiration.timestamp())
+            self.db.save_graph_subscription(email_id, result['id'], INBOX_RESOURCE, client_state, expires_at)
+            logger.info(f"邮箱 {account.get('email')} 已创建Graph订阅: {result['id']}")
+            return True
+        except Exception as e:
+            logger.warning(f"邮箱 {account.get('email')} 创建Graph订阅失败，继续轮询: {str(e)}")
+            self.db.save_graph_subscription(email_id, None, INBOX_RESOURCE, None, None, status='failed', last_error=str(e)[:500])
+            return False
+
+    def covers(self, account):
+        """订阅有效且距上次同步未超过兜底轮询间隔时返回 True，此时无需轮询该邮箱"""
+        if not self.enabled or account.get('mail_type') != 'outlook':
+            return False
+        sub = self.db.get_graph_subscription(account['id'])
+        now = int(time.time())
+        if not sub or sub['status'] != 'active' or (sub['expires_at'] or 0) <= now:
+            return False
+        try:
+            last_check = datetime.strptime(str(account.get('last_check_time')), '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError):
+            return False
+        return now - last_check.timestamp() < FALLBACK_POLL_SECONDS
+
+    def handle_notifications(self, payload):
+        """
+        处理 Graph 推送的通知，只做校验和排队（Graph 要求 3 秒内响应）
+
+        Returns:
+            int: 通过校验的通知数
+        """
+        accepted = 0
+        for item in (payload or {}).get('value', []):
+            sub = self.db.get_graph_subscription_by_id(str(item.get('subscriptionId') or ''))
+            if not sub or not sub['client_state'] or not hmac.compare_digest(str(item.get('clientState') or ''), sub['client_state']):
+                logger.warning(f"忽略无法验证的Graph通知: subscription={item.get('subscriptionId')}")
+                continue
+            accepted += 1
+            self.db.touch_graph_subscription(sub['subscription_id'])
+            lifecycle = item.get('lifecycleEvent')
+            if lifecycle in ('reauthorizationRequired', 'subscriptionRemoved'):
+                # 让下一次 ensure 立即续订或重建
+                self.db.save_graph_subscription(sub['email_id'], sub['subscription_id'], sub['resource'], sub['client_state'], int(time.time()) + 1)
+                threading.Thread(target=self._renew, args=(sub['email_id'],), daemon=True).start()
+            # missed 以及普通变更通知都触发一次增量同步
+            self.schedule_sync(sub['email_id'])
+        return accepted
+
+    def _renew(self, email_id):
+        account = self.db.get_email_by_id(email_id)
+        if account:
+            self.ensure(account)
+
+    def schedule_sync(self, email_id, delay=None):
+        """短暂延迟后同步邮箱，期间的重复通知合并为一次"""
+        with self._lock:
+            if email_id in self._timers:
+                return
+            timer = threading.Timer(NOTIFICATION_DEBOUNCE_SECONDS if delay is None else delay, self._run_sync, args=(email_id,))
+            timer.daemon = True
+            self._timers[email_id] = timer
+        timer.start()
+
+    def _run_sync(self, email_id):
+        with self._lock:
+            self._timers.pop(email_id, None)
+        account = self.db.get_email_by_id(email_id)
+        if not account:
+            return
+        if self.email_processor.is_email_being_processed(email_id):
+            # 正在同步的任务可能已错过这次变化，结束后再同步一次
+            self.schedule_sync(email_id)
+            return
+
+        job_id = self.email_processor.enqueue_job(email_id, JOB_INCREMENTAL, priority=5, max_attempts=3)
+        logger.info(f"收到Graph通知，已添加同步任务 {job_id}: id={email_id} email={account.get('email')}")
+
+    def cancel_all(self):
+        with self._lock:
+            timers = list(self._timers.values())
+            self._timers.clear()
+        for timer in timers:
+            timer.cancel()
@@ -0,0 +1,162 @@
+"""
+Microsoft Graph 全局限流模块
+按 client_id 维护令牌桶，所有工作线程共享同一份速率预算：
+- 收到 429/503 时该应用整体减速并暂停到 Retry-After 之后
+- 一段时间没有再被限流后逐步恢复速率
+"""
+
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from . import cancellation
+
+logger = logging.getLogger(__name__)
+
+# 每个 client_id 的最大/最小请求速率（次/秒）和突发容量
+MAX_RATE = float(os.environ.get('GRAPH_RATE_PER_SECOND', '10'))
+MIN_RATE = float(os.environ.get('GRAPH_RATE_MIN', '0.5'))
+BURST = float(os.environ.get('GRAPH_RATE_BURST', '20'))
+# 未再被限流多少秒后开始恢复，每次恢复最大速率的比例
+RAMP_INTERVAL = float(os.environ.get('GRAPH_RATE_RAMP_SECONDS', '5'))
+RAMP_STEP = float(os.environ.get('GRAPH_RATE_RAMP_STEP', '0.1'))
+# 没有 Retry-After 时的默认暂停秒数
+DEFAULT_PAUSE = float(os.environ.get('GRAPH_THROTTLE_PAUSE', '2'))
+
+THROTTLE_STATUS = {429, 503}
+DEFAULT_KEY = 'default'
+_MAX_TOKENS_TRACKED = 10000
+
+
+class _Budget:
+    """单个 client_id 的令牌桶及限流状态"""
+
+    def __init__(self, key):
+        self.key = key
+        self.rate = MAX_RATE
+        self.tokens = BURST
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_throttle = 0.0
+        self.last_ramp = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+
+    def _refill(self, now):
+        # 暂停期间不积累令牌
+        start = max(self.updated, self.paused_until)
+        if now > start:
+            self.tokens = min(BURST, self.tokens + (now - start) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def reserve(self, now):
+        """预留一个令牌，返回需要等待的秒数"""
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        # 令牌不足时预支，暂停结束后按当前速率补足
+        self.tokens -= 1
+        if self.tokens < 0:
+            wait += -self.tokens / self.rate
+        return wait
+
+    def on_throttled(self, now, retry_after):
+        self.throttled += 1
+        self.last_throttle = now
+        self.rate = max(MIN_RATE, self.rate / 2)
+        self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else DEFAULT_PAUSE))
+        self.tokens = min(self.tokens, 0)
+
+    def on_success(self, now):
+        if self.rate >= MAX_RATE:
+            return
+        if now - self.last_throttle >= RAMP_INTERVAL and now - self.last_ramp >= RAMP_INTERVAL:
+            self._refill(now)
+            self.rate = min(MAX_RATE, self.rate + MAX_RATE * RAMP_STEP)
+            self.last_ramp = now
+
+
+class GraphRateGovernor:
+    """进程级 Graph 速率调节器"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._budgets = {}
+        self._token_keys = OrderedDict()
+
+    def register_token(self, access_token, client_id):
+        """记录访问令牌所属的 client_id，之后用该令牌的请求计入对应预算"""
+        if not access_token or not client_id:
+            return
+        with self._lock:
+            self._token_keys[access_token] = client_id
+            self._token_keys.move_to_end(access_token)
+            while len(self._token_keys) > _MAX_TOKENS_TRACKED:
+                self._token_keys.popitem(last=False)
+
+    def _budget(self, access_token):
+        key = self._token_keys.get(access_token) or DEFAULT_KEY
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = _Budget(key)
+            self._budgets[key] = budget
+        return budget
+
+    def acquire(self, access_token, cancel=None):
+        """发送请求前调用，按预算等待；cancel 停止或超时后等待立即结束并抛出 SyncCancelled"""
+        with self._lock:
+            budget = self._budget(access_token)
+            wait = budget.reserve(time.monotonic())
+            budget.requests += 1
+            budget.waited_seconds += wait
+        if wait > 0:
+            cancellation.sleep(cancel, wait)
+
+    def record(self, access_token, status, retry_after=None):
+        """收到响应后调用，429/503 触发全局退避，成功响应逐步恢复速率"""
+        now = time.monotonic()
+        with self._lock:
+            budget = self._budget(access_token)
+            if status in THROTTLE_STATUS:
+                budget.on_throttled(now, _parse_retry_after(retry_after))
+                rate, pause = budget.rate, budget.paused_until - now
+            elif status and status < 400:
+                budget.on_success(now)
+                return
+            else:
+                return
+        logger.warning(f"Graph 请求被限流(HTTP {status})，client={budget.key} 速率降至 {rate:.2f}/s，暂停 {pause:.1f} 秒")
+
+    def metrics(self):
+        """当前各 client_id 的速率和限流计数"""
+        now = time.monotonic()
+        with self._lock:
+            result = []
+            for budget in self._budgets.values():
+                budget._refill(now)
+                result.append({
+                    'client_id': budget.key,
+                    'rate': round(budget.rate, 3),
+                    'max_rate': MAX_RATE,
+                    'tokens': round(budget.tokens, 2),
+                    'paused_seconds': round(max(0.0, budget.paused_until - now), 2),
+                    'requests': budget.requests,
+                    'throttled': budget.throttled,
+                    'waited_seconds': round(budget.waited_seconds, 2),
+                    'seconds_since_throttle': round(now - budget.last_throttle, 1) if budget.last_throttle else None,
+                })
+            return result
+
+
+def _parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+governor = GraphRateGovernor()
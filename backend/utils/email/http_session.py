@@ -0,0 +1,90 @@
+"""
+HTTP连接池模块
+Microsoft Graph 和 OAuth 令牌请求共用按主机划分的 keep-alive 会话，
+避免每次调用都重新建立 TCP + TLS 连接
+"""
+
+import os
+import threading
+import logging
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# 每个主机的连接池大小，默认由 EmailBatchProcessor 按工作线程数配置
+DEFAULT_POOL_SIZE = 10
+
+_pool_size = int(os.environ.get('HTTP_POOL_SIZE') or DEFAULT_POOL_SIZE)
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _new_adapter():
+    return HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size, max_retries=0)
+
+
+def _new_session():
+    session = requests.Session()
+    # 多个邮箱账号共用会话，不保存服务端下发的 Cookie
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = _new_adapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure(pool_size):
+    """
+    设置每个主机的连接池大小，一般与并发工作线程数一致
+
+    环境变量 HTTP_POOL_SIZE 优先；已创建的会话会换用新大小的连接池。
+    """
+    global _pool_size
+    size = max(1, int(os.environ.get('HTTP_POOL_SIZE') or pool_size or DEFAULT_POOL_SIZE))
+    with _lock:
+        if size == _pool_size:
+            return
+        _pool_size = size
+        for session in _sessions.values():
+            adapter = _new_adapter()
+            for prefix in ('https://', 'http://'):
+                old = session.adapters.get(prefix)
+                session.mount(prefix, adapter)
+                if old is not None:
+                    old.close()
+    logger.info(f"HTTP连接池大小设置为 {size}")
+
+
+def get_session(url):
+    """获取目标主机的共享会话"""
+    host = urlsplit(url).netloc.lower()
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _new_session()
+            _sessions[host] = session
+        return session
+
+
+def request(method, url, **kwargs):
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def close_all():
+    """关闭所有会话（进程退出时调用）"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
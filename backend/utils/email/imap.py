@@ -5,10 +5,18 @@ IMAP邮件处理模块 - 增强版
 
 import imaplib
 import email
+import email.message
+import base64
+import binascii
+import quopri
+import uuid
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 import os
+import re
 import logging
+import queue
+import concurrent.futures
 from datetime import datetime, timedelta
 import threading
 import socket
@@ -26,6 +34,12 @@ from .common import (
     normalize_check_time,
     format_date_for_imap_search
 )
+from . import imap_transport
+from . import cancellation
+from .lanes import host_limiter, route_for
+from .cancellation import SyncCancelled
+from .circuit_breaker import classify_error
+from .imap_structure import parse_fetch_response, walk_parts, estimate_decoded_size
 from .logger import (
     logger,
     log_email_start,
@@ -39,6 +53,13 @@ from .logger import (
 
 logger = logging.getLogger(__name__)
 
+# LIST 响应: (\HasNoChildren \Junk) "/" "Junk"
+_LIST_RESPONSE_RE = re.compile(r'\((?P<flags>[^)]*)\)\s+(?P<delimiter>"(?:[^"\\]|\\.)*"|NIL)\s+(?P<name>.+)$')
+_FETCH_UID_RE = re.compile(rb'UID (\d+)')
+_FETCH_FLAGS_RE = re.compile(rb'FLAGS \(([^)]*)\)')
+_STATUS_ITEM_RE = re.compile(rb'([A-Z]+) (\d+)')
+
+
 class IMAPMailHandler:
     """IMAP邮箱处理类 - 增强版"""
 
@@ -52,6 +73,35 @@ class IMAPMailHandler:
         'ARCHIVE': ['Archive', 'ARCHIVE', 'All Mail', '归档']
     }
 
+    # RFC 6154 special-use 标记，优先于名称别名匹配
+    SPECIAL_USE_FLAGS = {
+        'SENT': ['\\sent'],
+        'DRAFTS': ['\\drafts'],
+        'TRASH': ['\\trash'],
+        'SPAM': ['\\junk'],
+        'ARCHIVE': ['\\archive', '\\all'],
+    }
+
+    # 未单独配置时同步的文件夹（逻辑名，经 DEFAULT_FOLDERS 解析为服务器上的实际名称）
+    DEFAULT_SYNC_FOLDERS = ['INBOX', 'SPAM']
+
+    # 同一账号并行同步文件夹时最多同时打开的连接数
+    MAX_FOLDER_CONNECTIONS = max(1, int(os.environ.get('IMAP_FOLDER_CONNECTIONS', '3')))
+    # 按需下载附件时等待服务器连接名额的最长时间（秒）
+    HOST_SLOT_TIMEOUT = float(os.environ.get('IMAP_HOST_SLOT_TIMEOUT', '30'))
+
+    # 带附件的邮件只拉取正文部分，附件在首次下载时再从服务器获取
+    LAZY_ATTACHMENTS = os.environ.get('IMAP_LAZY_ATTACHMENTS', '1') != '0'
+
+    # 一次 FETCH 获取 BODYSTRUCTURE 的邮件数
+    STRUCTURE_BATCH_SIZE = 50
+
+    # 不支持 CONDSTORE 时按UID分段拉取标记，每段的UID跨度
+    FLAG_FETCH_CHUNK = max(1, int(os.environ.get('IMAP_FLAG_FETCH_CHUNK', '1000')))
+
+    # 连接和单条命令的读写超时（秒），同步任务中不超过剩余时间
+    SOCKET_TIMEOUT = float(os.environ.get('IMAP_TIMEOUT', '60'))
+
     def __init__(self, server, username, password, use_ssl=True, port=None):
         """初始化IMAP处理器"""
         self.server = server
@@ -63,34 +113,160 @@ class IMAPMailHandler:
         self.error = None
 
         # 自动检测服务器
-        if not server and '@' in username:
-            domain = username.split('@')[1].lower()
-            if 'gmail' in domain:
-                self.server = 'imap.gmail.com'
-            elif 'qq.com' in domain:
-                self.server = 'imap.qq.com'
-            elif 'outlook' in domain or 'hotmail' in domain or 'live' in domain:
-                self.server = 'outlook.office365.com'
-            elif '163.com' in domain:
-                self.server = 'imap.163.com'
-            elif '126.com' in domain:
-                self.server = 'imap.126.com'
+        if not server:
+            self.server = IMAPMailHandler.guess_server(username)
+
+    @staticmethod
+    def guess_server(username):
+        """根据邮箱域名推测IMAP服务器"""
+        if not username or '@' not in username:
+            return None
+        domain = username.split('@')[1].lower()
+        if 'gmail' in domain:
+            return 'imap.gmail.com'
+        elif 'qq.com' in domain:
+            return 'imap.qq.com'
+        elif 'outlook' in domain or 'hotmail' in domain or 'live' in domain:
+            return 'outlook.office365.com'
+        elif '163.com' in domain:
+            return 'imap.163.com'
+        elif '126.com' in domain:
+            return 'imap.126.com'
+        return None
+
+    @staticmethod
+    def _open_connection(server, port, use_ssl, cancel=None):
+        """建立到IMAP服务器的连接（未登录），SSL 连接共用 SSLContext 并复用 TLS 会话"""
+        timeout = cancellation.timeout(cancel, IMAPMailHandler.SOCKET_TIMEOUT)
+        return imap_transport.open_connection(server, port, use_ssl, timeout=timeout)
+
+    @staticmethod
+    def _checkpoint(mail, cancel):
+        """检查是否已取消，并把连接的读写超时调整为不超过剩余时间"""
+        if cancel is not None:
+            imap_transport.set_timeout(mail, cancel.timeout(IMAPMailHandler.SOCKET_TIMEOUT))
 
     def connect(self):
         """连接到IMAP服务器"""
         try:
-            if self.use_ssl:
-                self.mail = imaplib.IMAP4_SSL(self.server, self.port)
-            else:
-                self.mail = imaplib.IMAP4(self.server, self.port)
-
+            self.mail = IMAPMailHandler._open_connection(self.server, self.port, self.use_ssl)
             self.mail.login(self.username, self.password)
+            IMAPMailHandler._enable_extensions(self.mail)
             return True
         except Exception as e:
             self.error = str(e)
             logger.error(f"IMAP连接失败: {e}")
             return False
 
+    @staticmethod
+    def _parse_list_response(folders):
+        """解析LIST响应，返回 [(flags, folder_name)]"""
+        entries = []
+        for folder in folders or []:
+            if folder is None:
+                continue
+            if isinstance(folder, tuple):
+                # 文件夹名以literal形式返回: (b'(\\HasNoChildren) "/" {5}', b'Inbox')
+                prefix = folder[0].decode('utf-8', errors='ignore') if isinstance(folder[0], bytes) else str(folder[0])
+                name = folder[1].decode('utf-8', errors='ignore') if isinstance(folder[1], bytes) else str(folder[1])
+                match = _LIST_RESPONSE_RE.match(re.sub(r'\{\d+\}$', '""', prefix.strip()))
+                flags = match.group('flags') if match else ''
+                entries.append((set(flags.lower().split()), name))
+                continue
+
+            if isinstance(folder, bytes):
+                folder = folder.decode('utf-8', errors='ignore')
+
+            match = _LIST_RESPONSE_RE.match(folder.strip())
+            if match:
+                flags = match.group('flags')
+                name = match.group('name').strip()
+                if len(name) >= 2 and name[0] == '"' and name[-1] == '"':
+                    name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+            else:
+                # 简单解析
+                flags = ''
+                parts = folder.split('"')
+                name = parts[-2] if len(parts) >= 3 else folder.split()[-1]
+
+            if name and name not in ['.', '..'] and '\\noselect' not in flags.lower():
+                entries.append((set(flags.lower().split()), name))
+        return entries
+
+    @staticmethod
+    def _quote_folder(folder):
+        """为包含空格等字符的文件夹名加引号"""
+        if not folder:
+            return 'INBOX'
+        if folder.startswith('"') and folder.endswith('"'):
+            return folder
+        return '"' + folder.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    @staticmethod
+    def parse_folder_config(value):
+        """解析账号的文件夹配置（逗号分隔字符串或列表），为空时使用默认文件夹"""
+        if isinstance(value, str):
+            items = [item.strip() for item in value.replace('\n', ',').split(',')]
+        elif isinstance(value, (list, tuple)):
+            items = [str(item).strip() for item in value]
+        else:
+            items = []
+        items = [item for item in items if item]
+        return items or list(IMAPMailHandler.DEFAULT_SYNC_FOLDERS)
+
+    @staticmethod
+    def resolve_folders(listing, wanted):
+        """
+        将配置的文件夹解析为服务器上的实际文件夹名
+
+        Args:
+            listing: _parse_list_response 的结果
+            wanted: 逻辑名（DEFAULT_FOLDERS 的键）或实际文件夹名列表
+
+        Returns:
+            list: [(配置项, 实际文件夹名)]，已去重
+        """
+        by_lower = {}
+        for flags, name in listing:
+            by_lower.setdefault(name.lower(), (flags, name))
+
+        resolved = []
+        seen = set()
+        for key in wanted:
+            upper = key.upper()
+            actual = None
+            if upper == 'INBOX':
+                actual = by_lower.get('inbox', (None, 'INBOX'))[1]
+            elif upper in IMAPMailHandler.DEFAULT_FOLDERS:
+                special = IMAPMailHandler.SPECIAL_USE_FLAGS.get(upper, [])
+                for flags, name in listing:
+                    if any(flag in flags for flag in special):
+                        actual = name
+                        break
+                if not actual:
+                    for alias in IMAPMailHandler.DEFAULT_FOLDERS[upper]:
+                        if alias.lower() in by_lower:
+                            actual = by_lower[alias.lower()][1]
+                            break
+                        # Gmail 等服务器把系统文件夹放在 [Gmail]/ 之类的前缀下
+                        for lower_name, (_, name) in by_lower.items():
+                            if lower_name.endswith('/' + alias.lower()) or lower_name.endswith('.' + alias.lower()):
+                                actual = name
+                                break
+                        if actual:
+                            break
+            elif key.lower() in by_lower:
+                actual = by_lower[key.lower()][1]
+
+            if not actual:
+                logger.warning(f"服务器上未找到文件夹: {key}")
+                continue
+            if actual in seen:
+                continue
+            seen.add(actual)
+            resolved.append((key, actual))
+        return resolved
+
     def get_folders(self):
         """获取文件夹列表"""
         if not self.mail:
@@ -98,22 +274,7 @@ class IMAPMailHandler:
 
         try:
             _, folders = self.mail.list()
-            folder_list = []
-
-            for folder in folders:
-                if isinstance(folder, bytes):
-                    folder = folder.decode('utf-8', errors='ignore')
-
-                # 解析文件夹名称
-                parts = folder.split('"')
-                if len(parts) >= 3:
-                    folder_name = parts[-2]
-                else:
-                    # 简单解析
-                    folder_name = folder.split()[-1]
-
-                if folder_name and folder_name not in ['.', '..']:
-                    folder_list.append(folder_name)
+            folder_list = [name for _, name in IMAPMailHandler._parse_list_response(folders)]
 
             # 确保常用文件夹在列表中
             default_folders = ['INBOX', 'Sent', 'Drafts', 'Trash', 'Spam']
@@ -132,7 +293,7 @@ class IMAPMailHandler:
             return []
 
         try:
-            self.mail.select(folder)
+            self.mail.select(IMAPMailHandler._quote_folder(folder))
             _, messages = self.mail.search(None, 'ALL')
             message_numbers = messages[0].split()
 
@@ -170,200 +331,831 @@ class IMAPMailHandler:
             self.mail = None
 
     @staticmethod
-    @timing_decorator
-    def fetch_emails(email_address, password, server, port=993, use_ssl=True, folder="INBOX", callback=None, last_check_time=None):
-        """获取邮箱中的邮件"""
-        mail_records = []
-        mail = None
+    def _logout(mail):
+        if not mail:
+            return
+        try:
+            mail.logout()
+        except Exception:
+            pass
 
+    @staticmethod
+    def _enable_extensions(mail):
+        """
+        登录后启用服务器支持的扩展：
+        COMPRESS=DEFLATE 压缩后续所有流量；QRESYNC 使 SELECT 直接带回标记变化和已删除UID
+        """
+        imap_transport.enable_compression(mail)
+        mail.firemail_qresync = False
+        if 'QRESYNC' not in mail.capabilities or not hasattr(mail, 'enable'):
+            return
         try:
-            # 创建回调函数
-            if callback is None:
-                callback = lambda progress, message: None
+            typ, _ = mail.enable('QRESYNC')
+            mail.firemail_qresync = typ == 'OK'
+        except Exception as e:
+            logger.debug(f"启用QRESYNC失败: {str(e)}")
+
+    @staticmethod
+    def _expand_uid_set(value):
+        """展开UID集合，如 b'1,3:5' -> [1, 3, 4, 5]"""
+        if isinstance(value, bytes):
+            value = value.decode('ascii', errors='ignore')
+        uids = []
+        for part in (value or '').replace('(EARLIER)', '').strip().split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if ':' in part:
+                start, end = part.split(':', 1)
+                if start.isdigit() and end.isdigit():
+                    low, high = sorted((int(start), int(end)))
+                    uids.extend(range(low, high + 1))
+            elif part.isdigit():
+                uids.append(int(part))
+        return uids
+
+    @staticmethod
+    def _parse_flag_responses(data, max_uid=None, min_uid=None, unparsed=None):
+        """
+        解析 FETCH (UID FLAGS) 响应，返回 {uid: 是否已读}
+
+        unparsed 为列表时记录无法解析的响应条数，调用方据此判断结果是否完整
+        """
+        updates = {}
+        for item in data or []:
+            if isinstance(item, tuple):
+                item = item[0]
+            if not isinstance(item, bytes):
+                continue
+            uid_match = _FETCH_UID_RE.search(item)
+            flags_match = _FETCH_FLAGS_RE.search(item)
+            if not uid_match or not flags_match:
+                if unparsed is not None:
+                    unparsed.append(item)
+                continue
+            uid = int(uid_match.group(1))
+            if (max_uid is not None and uid > max_uid) or (min_uid is not None and uid < min_uid):
+                continue
+            updates[uid] = b'\\seen' in flags_match.group(1).lower()
+        return updates
+
+    @staticmethod
+    def _fetch_flags_chunked(mail, folder, last_uid):
+        """
+        按UID分段拉取 1:last_uid 的标记
+
+        Returns:
+            tuple: ({uid: 是否已读}, 服务器上存在的UID, 结果完整可用于判断删除的UID范围)
+        """
+        flags = {}
+        present = []
+        ranges = []
+        # 从第一封邮件的UID开始分段，跳过前面已被删除的UID
+        typ, data = mail.fetch('1', '(UID FLAGS)')
+        first = IMAPMailHandler._parse_flag_responses(data) if typ == 'OK' else {}
+        start = min(first) if first else 1
+        if first and start > 1:
+            ranges.append((1, start - 1))
+        for low in range(start, last_uid + 1, IMAPMailHandler.FLAG_FETCH_CHUNK):
+            high = min(last_uid, low + IMAPMailHandler.FLAG_FETCH_CHUNK - 1)
+            typ, data = mail.uid('FETCH', f'{low}:{high}', '(UID FLAGS)')
+            if typ != 'OK':
+                logger.warning(f"获取邮件标记失败: {folder} UID {low}:{high} {data}")
+                continue
+            unparsed = []
+            updates = IMAPMailHandler._parse_flag_responses(data, high, low, unparsed)
+            flags.update(updates)
+            if unparsed:
+                # 有响应没能解析时不知道缺少的是哪封，这一段不判断删除
+                logger.warning(f"文件夹 {folder} UID {low}:{high} 有 {len(unparsed)} 条标记响应无法解析")
+                continue
+            present.extend(updates)
+            ranges.append((low, high))
+        return flags, present, ranges
+
+    @staticmethod
+    def _sync_flags(mail, folder, state, highestmodseq, messages_count, new_count, qresync_used):
+        """
+        同步已有邮件的已读状态，并检测已删除的邮件
+
+        - QRESYNC: SELECT 已带回变化的 FETCH 和 VANISHED，直接读取
+        - CONDSTORE: UID FETCH (CHANGEDSINCE modseq) 只拉取变化的标记；
+          邮件数比预期少时再用 UID SEARCH 找出已删除的邮件
+        - 都不支持: 按UID分段 UID FETCH (FLAGS) 比对，只在拉取成功的分段内判断删除
 
-            # 标准化处理last_check_time
-            last_check_time = normalize_check_time(last_check_time)
-            if not last_check_time:
-                # Default to last 60 days on first sync
-                last_check_time = datetime.utcnow() - timedelta(days=60)
+        Returns:
+            dict: sync_imap_folder_flags 所需的 change
+        """
+        last_uid = int(state['last_uid'])
+        saved_modseq = state.get('highestmodseq')
+        change = {'folder': folder, 'flag_updates': {}, 'vanished_uids': []}
 
+        if qresync_used:
+            _, vanished = mail.response('VANISHED')
+            for item in vanished or []:
+                if item is not None:
+                    change['vanished_uids'].extend(IMAPMailHandler._expand_uid_set(item))
+            _, fetched = mail.response('FETCH')
+            change['flag_updates'] = IMAPMailHandler._parse_flag_responses(fetched, last_uid)
+            mode = 'QRESYNC'
+        elif saved_modseq and highestmodseq:
+            mode = 'CONDSTORE'
+            if highestmodseq != saved_modseq:
+                typ, data = mail.uid('FETCH', f'1:{last_uid}', '(UID FLAGS)', f'(CHANGEDSINCE {saved_modseq})')
+                if typ != 'OK':
+                    raise imaplib.IMAP4.error(f"获取标记变化失败: {folder} {data}")
+                change['flag_updates'] = IMAPMailHandler._parse_flag_responses(data, last_uid)
 
-            if last_check_time:
-                logger.info(f"获取自 {last_check_time.isoformat()} 以来的新邮件")
+            # 已有邮件数少于上次记录时说明有邮件被删除
+            previous = state.get('messages')
+            if previous is not None and messages_count is not None and messages_count - new_count < previous:
+                typ, data = mail.uid('SEARCH', 'UID', f'1:{last_uid}')
+                if typ != 'OK':
+                    raise imaplib.IMAP4.error(f"搜索邮件失败: {folder} {data}")
+                change['present_uids'] = [int(x) for x in (data[0] or b'').split() if x.isdigit()]
+                change['present_ranges'] = [(1, last_uid)]
+        else:
+            mode = 'FLAGS'
+            flags, present, ranges = IMAPMailHandler._fetch_flags_chunked(mail, folder, last_uid)
+            change['flag_updates'] = flags
+            change['present_uids'] = present
+            change['present_ranges'] = ranges
+
+        logger.info(
+            f"文件夹 {folder} 标记同步({mode}): {len(change['flag_updates'])} 个标记, "
+            f"{len(change['vanished_uids'])} 个已删除UID"
+        )
+        return change
+
+    @staticmethod
+    def _folder_status(mail, folder):
+        """STATUS 查询文件夹概况，不需要打开文件夹"""
+        items = 'MESSAGES UIDNEXT UIDVALIDITY'
+        if 'CONDSTORE' in mail.capabilities or 'QRESYNC' in mail.capabilities:
+            items += ' HIGHESTMODSEQ'
+        else:
+            # 没有 MODSEQ 时用未读数变化判断已读状态是否改变
+            items += ' UNSEEN'
+        typ, data = mail.status(IMAPMailHandler._quote_folder(folder), f'({items})')
+        if typ != 'OK' or not data or not isinstance(data[-1], bytes):
+            raise imaplib.IMAP4.error(f"STATUS 失败: {folder} {data}")
+        body = data[-1].rsplit(b'(', 1)[-1]
+        return {key.decode().lower(): int(value) for key, value in _STATUS_ITEM_RE.findall(body)}
+
+    @staticmethod
+    def _folder_unchanged(state, status):
+        """根据 STATUS 结果判断文件夹自上次同步以来是否没有任何变化"""
+        if not state:
+            return False
+        for key in ('uidvalidity', 'uidnext', 'messages'):
+            if status.get(key) is None or state.get(key) != status.get(key):
+                return False
+        if 'highestmodseq' in status:
+            return state.get('highestmodseq') == status['highestmodseq']
+        return state.get('unseen') is not None and state.get('unseen') == status.get('unseen')
+
+    @staticmethod
+    def _precheck_folders(mail, resolved, folder_states):
+        """
+        用 STATUS 预检查文件夹，跳过没有变化的文件夹
+
+        Returns:
+            tuple: (需要同步的 [(key, folder)], 跳过的文件夹, STATUS 失败的文件夹, {folder: status})
+        """
+        pending, skipped, failed, statuses = [], [], [], {}
+        for key, folder in resolved:
+            try:
+                status = IMAPMailHandler._folder_status(mail, folder)
+            except Exception as e:
+                logger.warning(f"文件夹 {folder} STATUS 预检查失败: {str(e)}")
+                failed.append(folder)
+                pending.append((key, folder))
+                continue
+            statuses[folder] = status
+            if IMAPMailHandler._folder_unchanged(folder_states.get(folder), status):
+                skipped.append(folder)
             else:
-                logger.info(f"获取所有邮件")
+                pending.append((key, folder))
+        return pending, skipped, failed, statuses
 
-            # 连接IMAP服务器
-            logger.info(f"连接IMAP服务器 {server}:{port} (SSL: {use_ssl})")
-            if callback:
-                callback(0, "正在连接邮箱服务器")
+    @staticmethod
+    def _log_transport(email_address, connections):
+        """记录本次同步在线路上的流量和握手情况"""
+        conns = [conn for conn in connections if conn is not None and hasattr(conn, 'bytes_received')]
+        if not conns:
+            return
+        received = sum(conn.bytes_received for conn in conns)
+        uncompressed = sum(conn.bytes_received_uncompressed for conn in conns)
+        logger.info(
+            f"邮箱 {email_address} IMAP流量: 连接 {len(conns)} 个, "
+            f"发送 {sum(conn.bytes_sent for conn in conns)} 字节, 接收 {received} 字节 (解压后 {uncompressed}), "
+            f"压缩 {sum(1 for conn in conns if conn.compressed)} 个, TLS会话复用 {sum(1 for conn in conns if conn.session_reused)} 个, "
+            f"握手 {max(conn.handshake_seconds for conn in conns) * 1000:.0f}ms"
+        )
 
-            if use_ssl:
-                mail = imaplib.IMAP4_SSL(server, port)
+    @staticmethod
+    def _response_int(mail, code):
+        """读取 SELECT/EXAMINE 附带的响应码（如 UIDVALIDITY）"""
+        try:
+            _, data = mail.response(code)
+            if data and data[0] is not None:
+                value = data[0]
+                if isinstance(value, bytes):
+                    value = value.decode('ascii', errors='ignore')
+                return int(str(value).split()[0])
+        except Exception:
+            pass
+        return None
+
+    @staticmethod
+    def _parse_fetch_message(msg_data):
+        """从 UID FETCH (FLAGS BODY.PEEK[]) 的响应中取出 uid、flags 和原始邮件"""
+        uid = None
+        flags = b''
+        raw = None
+        for item in msg_data or []:
+            if isinstance(item, tuple):
+                header = item[0] or b''
+                if raw is None:
+                    raw = item[1]
+            elif isinstance(item, bytes):
+                header = item
             else:
-                mail = imaplib.IMAP4(server, port)
+                continue
+            uid_match = _FETCH_UID_RE.search(header)
+            if uid_match and uid is None:
+                uid = int(uid_match.group(1))
+            flags_match = _FETCH_FLAGS_RE.search(header)
+            if flags_match:
+                flags = flags_match.group(1)
+        return uid, flags, raw
 
-            # 登录
-            logger.info(f"登录邮箱 {email_address}")
-            if callback:
-                callback(10, "正在登录邮箱")
+    @staticmethod
+    def _parse_raw_message(email_body, folder):
+        """解析原始邮件，标准解析失败时回退到EML解析器"""
+        try:
+            msg = email.message_from_bytes(email_body)
+            mail_record = parse_email_message(msg, folder)
+        except Exception as e:
+            logger.warning(f"标准方式解析邮件失败，尝试使用EML解析器: {str(e)}")
+            mail_record = None
 
-            mail.login(email_address, password)
+        if not mail_record:
+            try:
+                from .file_parser import EmailFileParser
+                logger.info("使用EML解析器解析邮件")
+                mail_record = EmailFileParser.parse_eml_content(email_body)
+                if mail_record:
+                    # 设置文件夹信息
+                    mail_record['folder'] = folder
+            except Exception as e:
+                logger.error(f"EML解析器解析邮件失败: {str(e)}")
+                mail_record = None
+        return mail_record
 
-            # 选择邮件文件夹
-            logger.info(f"选择文件夹 {folder}")
-            if callback:
-                callback(20, f"正在选择文件夹 {folder}")
+    @staticmethod
+    def _fetch_structures(mail, uids, cancel=None):
+        """批量获取邮件的 FLAGS 和 BODYSTRUCTURE，返回 {uid: parse_fetch_response 结果}"""
+        structures = {}
+        size = IMAPMailHandler.STRUCTURE_BATCH_SIZE
+        for start in range(0, len(uids), size):
+            IMAPMailHandler._checkpoint(mail, cancel)
+            chunk = uids[start:start + size]
+            try:
+                typ, data = mail.uid('FETCH', ','.join(str(uid) for uid in chunk), '(UID FLAGS BODYSTRUCTURE)')
+                if typ != 'OK':
+                    logger.warning(f"获取BODYSTRUCTURE失败: status={typ}")
+                    continue
+                for message in parse_fetch_response(data):
+                    if message.get('uid'):
+                        structures[message['uid']] = message
+            except Exception as e:
+                logger.warning(f"解析BODYSTRUCTURE失败，改为完整拉取: {str(e)}")
+        return structures
 
-            mail.select(folder)
+    @staticmethod
+    def _fetch_partial_message(mail, uid, parts, folder, uidvalidity):
+        """
+        只拉取邮件头和正文部分，附件仅记录元数据
 
-            # 搜索邮件
-            search_criteria = 'ALL'
+        Returns:
+            dict: 邮件记录，其中 remote_attachments 为待按需下载的附件；失败时返回 None
+        """
+        text_parts = [part for part in parts if part['is_text']]
+        items = ['BODY.PEEK[HEADER]'] + [f"BODY.PEEK[{part['section']}]" for part in text_parts]
+        typ, data = mail.uid('FETCH', str(uid), '(' + ' '.join(items) + ')')
+        if typ != 'OK':
+            return None
+        messages = parse_fetch_response(data)
+        if not messages:
+            return None
+        sections = messages[0]['sections']
+        header = sections.get('HEADER')
+        if not header:
+            return None
 
-            # 如果提供了上次检查时间，只获取新邮件
-            if last_check_time:
-                # 将日期转换成IMAP搜索格式 (DD-MMM-YYYY)
-                date_str = format_date_for_imap_search(last_check_time)
-                if date_str:
-                    search_criteria = f'SINCE {date_str}'
-                    logger.info(f"获取自 {date_str} 以来的新邮件")
+        # 用邮件头和正文部分重新组装邮件，沿用原有的解析逻辑
+        msg = email.message_from_bytes(header)
+        for name in ('Content-Type', 'Content-Transfer-Encoding'):
+            del msg[name]
+        msg['Content-Type'] = f'multipart/mixed; boundary="firemail-{uuid.uuid4().hex}"'
+        msg.set_payload(None)
+        for part in text_parts:
+            content = sections.get(part['section'].upper())
+            if content is None:
+                return None
+            sub = email.message.Message()
+            content_type = part['content_type']
+            if part.get('charset'):
+                content_type += f'; charset="{part["charset"]}"'
+            sub['Content-Type'] = content_type
+            sub['Content-Transfer-Encoding'] = part['encoding']
+            sub.set_payload(content.decode('ascii', errors='surrogateescape'))
+            msg.attach(sub)
 
-            _, messages = mail.search(None, search_criteria)
-            message_numbers = messages[0].split()
-            total_messages = len(message_numbers)
+        mail_record = parse_email_message(msg, folder)
+        if not mail_record:
+            return None
 
-            logger.info(f"找到 {total_messages} 封邮件")
+        remote_attachments = []
+        for part in parts:
+            if not part['is_attachment']:
+                continue
+            remote_attachments.append({
+                'filename': part['filename'] or 'unnamed_attachment',
+                'content_type': part['content_type'] or 'application/octet-stream',
+                'size': estimate_decoded_size(part['size'], part['encoding']),
+                'remote_ref': {
+                    'provider': 'imap',
+                    'folder': folder,
+                    'uid': uid,
+                    'uidvalidity': uidvalidity,
+                    'section': part['section'],
+                    'encoding': part['encoding'],
+                },
+            })
+        mail_record['has_attachments'] = bool(remote_attachments)
+        mail_record['attachments'] = [
+            {'filename': att['filename'], 'content_type': att['content_type'], 'size': att['size']}
+            for att in remote_attachments
+        ]
+        mail_record['full_attachments'] = []
+        mail_record['remote_attachments'] = remote_attachments
+        return mail_record
 
-            # 处理每封邮件
-            for i, num in enumerate(message_numbers):
-                try:
-                    # 更新进度
-                    progress = int((i + 1) / total_messages * 100)
-                    if callback:
-                        callback(progress, f"正在处理第 {i + 1}/{total_messages} 封邮件")
+    @staticmethod
+    def _decode_part(data, encoding):
+        """按传输编码解码附件内容"""
+        encoding = (encoding or '').lower()
+        if encoding == 'base64':
+            try:
+                return base64.b64decode(data)
+            except (binascii.Error, ValueError):
+                return base64.b64decode(re.sub(rb'[^A-Za-z0-9+/=]', b'', data) + b'==')
+        if encoding == 'quoted-printable':
+            return quopri.decodestring(data)
+        return data
 
-                    # 获取邮件头信息，用于提前判断是否已存在
-                    _, header_data = mail.fetch(num, '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])')
-                    msg_header = email.message_from_bytes(header_data[0][1])
+    @staticmethod
+    def fetch_attachment(email_info, remote_ref):
+        """
+        从服务器下载单个附件
 
-                    subject = decode_mime_words(msg_header.get("subject", "")) if msg_header.get("subject") else "(无主题)"
-                    sender = decode_mime_words(msg_header.get("from", "")) if msg_header.get("from") else "(未知发件人)"
-                    date_str = msg_header.get("date", "")
-                    received_time = parse_email_date(date_str) if date_str else datetime.now()
+        Args:
+            email_info: 邮箱信息（server、port、use_ssl、email、password）
+            remote_ref: 同步时记录的附件位置 {folder, uid, uidvalidity, section, encoding}
 
-                    # 创建一个唯一标识用于检查邮件是否已存在
-                    mail_key = f"{subject}|{sender}|{received_time.isoformat()}"
+        Returns:
+            bytes: 解码后的附件内容
+        """
+        email_address = email_info['email']
+        use_ssl = email_info.get('use_ssl', True)
+        server = email_info.get('server') or IMAPMailHandler.guess_server(email_address)
+        port = email_info.get('port') or (993 if use_ssl else 143)
+        folder = remote_ref['folder']
+        uid = remote_ref['uid']
+        section = remote_ref['section']
 
-                    # 在这里可以添加检查邮件是否已存在于数据库的代码
-                    # 如果已经有接口可以查询，则直接调用
-                    # 此处仅收集基本信息，稍后在批量处理时进行检查
+        # 附件下载不经过同步线程池，单独占用一个服务器连接名额
+        host = route_for(email_info).host
+        if not host_limiter.acquire(host, timeout=IMAPMailHandler.HOST_SLOT_TIMEOUT):
+            raise imaplib.IMAP4.error(f"服务器 {server} 的连接数已达上限，请稍后再试")
+        mail = None
+        try:
+            mail = IMAPMailHandler._open_connection(server, port, use_ssl)
+            mail.login(email_address, email_info['password'])
+            IMAPMailHandler._enable_extensions(mail)
+            typ, data = mail.select(IMAPMailHandler._quote_folder(folder), readonly=True)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"选择文件夹失败: {folder} {data}")
+            uidvalidity = IMAPMailHandler._response_int(mail, 'UIDVALIDITY')
+            if remote_ref.get('uidvalidity') and uidvalidity is not None and uidvalidity != remote_ref['uidvalidity']:
+                raise imaplib.IMAP4.error(f"文件夹 {folder} 的UIDVALIDITY已变化，无法定位附件")
 
-                    # 获取完整邮件内容
-                    _, msg_data = mail.fetch(num, '(RFC822)')
-                    email_body = msg_data[0][1]
+            typ, data = mail.uid('FETCH', str(uid), f'(BODY.PEEK[{section}])')
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"获取附件失败: uid={uid}, section={section}")
+            messages = parse_fetch_response(data)
+            content = messages[0]['sections'].get(section.upper()) if messages else None
+            if content is None:
+                raise imaplib.IMAP4.error(f"服务器上已找不到该附件: uid={uid}, section={section}")
+            return IMAPMailHandler._decode_part(content, remote_ref.get('encoding'))
+        finally:
+            IMAPMailHandler._logout(mail)
+            host_limiter.release(host)
 
-                    # 尝试使用标准方式解析邮件
-                    try:
-                        msg = email.message_from_bytes(email_body)
-                        mail_record = parse_email_message(msg, folder)
-                    except Exception as e:
-                        logger.warning(f"标准方式解析邮件失败，尝试使用EML解析器: {str(e)}")
-                        mail_record = None
+    @staticmethod
+    def _sync_folder(mail, folder, last_check_time, state=None, callback=None, cancel=None):
+        """
+        增量同步单个文件夹
+
+        UIDVALIDITY 未变化时只拉取 last_uid 之后的新邮件，否则按 SINCE 日期重新搜索。
+
+        Returns:
+            dict: {'folder', 'records', 'state'}
+        """
+        state = state or {}
+        mailbox = IMAPMailHandler._quote_folder(folder)
+        qresync_used = bool(
+            getattr(mail, 'firemail_qresync', False)
+            and state.get('last_uid') and state.get('uidvalidity') and state.get('highestmodseq')
+        )
+        if qresync_used:
+            mailbox = f"{mailbox} (QRESYNC ({state['uidvalidity']} {state['highestmodseq']} 1:{state['last_uid']}))"
+        IMAPMailHandler._checkpoint(mail, cancel)
+        typ, data = mail.select(mailbox, readonly=True)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"选择文件夹失败: {folder} {data}")
+
+        try:
+            messages_count = int(data[0])
+        except Exception:
+            messages_count = None
+        uidvalidity = IMAPMailHandler._response_int(mail, 'UIDVALIDITY')
+        uidnext = IMAPMailHandler._response_int(mail, 'UIDNEXT')
+        highestmodseq = IMAPMailHandler._response_int(mail, 'HIGHESTMODSEQ')
+        if not qresync_used and 'CONDSTORE' not in mail.capabilities:
+            highestmodseq = None
+
+        last_uid = 0
+        incremental = bool(state.get('last_uid') and uidvalidity is not None and state.get('uidvalidity') == uidvalidity)
+        if incremental:
+            last_uid = int(state['last_uid'])
+            search_args = ('UID', f'{last_uid + 1}:*')
+            logger.info(f"文件夹 {folder} 增量获取 UID > {last_uid} 的邮件")
+        else:
+            date_str = format_date_for_imap_search(last_check_time)
+            search_args = ('SINCE', date_str) if date_str else ('ALL',)
+            logger.info(f"文件夹 {folder} 获取自 {date_str} 以来的邮件")
+
+        typ, data = mail.uid('SEARCH', *search_args)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"搜索邮件失败: {folder} {data}")
+
+        # UID n:* 在没有新邮件时仍会返回最后一封，需要过滤
+        uids = [int(x) for x in (data[0] or b'').split() if x.isdigit() and int(x) > last_uid]
+        total_messages = len(uids)
+        logger.info(f"文件夹 {folder} 找到 {total_messages} 封邮件")
+
+        IMAPMailHandler._checkpoint(mail, cancel)
+        if incremental:
+            change = IMAPMailHandler._sync_flags(
+                mail, folder, state, highestmodseq, messages_count, total_messages, qresync_used
+            )
+        else:
+            # UIDVALIDITY 变化后本地保存的UID已失效
+            change = {'folder': folder, 'reset_uids': True} if state.get('uidvalidity') else None
+
+        # 先看结构，带附件的邮件只拉取正文
+        structures = IMAPMailHandler._fetch_structures(mail, uids, cancel) if IMAPMailHandler.LAZY_ATTACHMENTS and uids else {}
+
+        records = []
+        # 获取或解析失败的UID，下次同步重试
+        failed = []
+        for i, uid in enumerate(uids):
+            IMAPMailHandler._checkpoint(mail, cancel)
+            try:
+                if callback:
+                    callback(int((i + 1) / total_messages * 100), f"正在处理 {folder} 第 {i + 1}/{total_messages} 封邮件")
+
+                mail_record = None
+                structure = structures.get(uid)
+                if structure:
+                    flags = ' '.join(structure['flags']).encode()
+                    parts = walk_parts(structure['bodystructure'])
+                    if any(part['is_attachment'] for part in parts):
+                        mail_record = IMAPMailHandler._fetch_partial_message(mail, uid, parts, folder, uidvalidity)
 
-                    # 如果标准解析失败，尝试使用EML解析器
+                if not mail_record:
+                    typ, msg_data = mail.uid('FETCH', str(uid), '(UID FLAGS BODY.PEEK[])')
+                    if typ != 'OK':
+                        logger.error(f"获取邮件失败: folder={folder}, uid={uid}, status={typ}")
+                        failed.append(uid)
+                        continue
+                    _, flags, email_body = IMAPMailHandler._parse_fetch_message(msg_data)
+                    if not email_body:
+                        failed.append(uid)
+                        continue
+
+                    mail_record = IMAPMailHandler._parse_raw_message(email_body, folder)
                     if not mail_record:
-                        try:
-                            from .file_parser import EmailFileParser
-                            logger.info("使用EML解析器解析邮件")
-                            mail_record = EmailFileParser.parse_eml_content(email_body)
-                            if mail_record:
-                                # 设置文件夹信息
-                                mail_record['folder'] = folder
-                        except Exception as e:
-                            logger.error(f"EML解析器解析邮件失败: {str(e)}")
-                            mail_record = None
+                        logger.error(f"无法解析邮件: folder={folder}, uid={uid}")
+                        failed.append(uid)
+                        continue
 
-                    if mail_record:
-                        # 添加一些额外信息用于去重判断
-                        mail_record['mail_key'] = mail_key
-                        mail_records.append(mail_record)
-                        message_id = mail_record.get('message_id', 'unknown')
-                        subject = mail_record.get('subject', '(无主题)')
-                        log_message_processing(message_id, i+1, total_messages, subject)
-                    else:
-                        logger.error(f"无法解析邮件: {mail_key}")
+                received_time = mail_record.get('received_time') or datetime.now()
+                if isinstance(received_time, datetime):
+                    received_time = received_time.isoformat()
+                mail_record['mail_key'] = f"{mail_record.get('subject')}|{mail_record.get('sender')}|{received_time}"
+                mail_record['folder'] = folder
+                mail_record['imap_uid'] = uid
+                mail_record['is_read'] = b'\\seen' in flags.lower()
+                records.append(mail_record)
+                log_message_processing(mail_record.get('message_id', uid), i + 1, total_messages, mail_record.get('subject', '(无主题)'))
+            except SyncCancelled:
+                raise
+            except Exception as e:
+                logger.error(f"处理邮件失败: {str(e)}")
+                log_message_error(uid, str(e))
+                failed.append(uid)
+                continue
 
-                except Exception as e:
-                    logger.error(f"处理邮件失败: {str(e)}")
-                    message_id = 'unknown'
-                    log_message_error(message_id, str(e))
-                    continue
+        # SINCE 搜索已覆盖 UIDNEXT 之前的全部邮件，下次从这里继续；
+        # 有失败的邮件时停在第一封失败的邮件之前，重复获取的邮件保存时按主题、发件人和时间去重
+        watermark = max(uids + [last_uid, (uidnext - 1) if uidnext else 0])
+        if failed:
+            watermark = max(last_uid, min(failed) - 1)
+            logger.warning(f"文件夹 {folder} 有 {len(failed)} 封邮件获取失败，下次从 UID {watermark + 1} 重新获取")
 
-            # 关闭连接
-            mail.close()
-            mail.logout()
+        new_state = {
+            'folder': folder,
+            'uidvalidity': uidvalidity,
+            # 有失败的邮件时保存的 UIDNEXT 与服务器不一致，下一轮 STATUS 预检查不会跳过该文件夹
+            'uidnext': watermark + 1 if failed else uidnext,
+            'messages': messages_count,
+            'highestmodseq': highestmodseq,
+            'last_uid': watermark or None,
+        }
+        return {'folder': folder, 'records': records, 'state': new_state, 'change': change}
+
+    @staticmethod
+    @timing_decorator
+    def fetch_folders(email_address, password, server, port=993, use_ssl=True, folders=None, callback=None,
+                      last_check_time=None, folder_states=None, max_connections=None, cancel=None, host=None):
+        """
+        并行同步多个文件夹
+
+        文件夹通过 LIST 结果和 DEFAULT_FOLDERS 别名解析，每个文件夹使用独立的增量状态；
+        同一账号最多同时打开 max_connections 个连接，连接在文件夹之间复用。
+        指定 host 时主连接使用同步任务出队时占用的服务器名额，额外的连接各自再占一个，没有名额时复用已有连接。
+        打开文件夹前先用 STATUS 与保存的状态比较，没有变化的文件夹直接跳过。
 
-            # 记录完成日志
-            log_email_complete(email_address, "未知", len(mail_records), len(mail_records), len(mail_records))
+        Args:
+            folders: 文件夹配置，见 parse_folder_config
+            folder_states: {实际文件夹名: 上次同步状态}
+            host: 参与服务器连接数限制的服务器名，见 lanes.route_for
+            cancel: CancelToken，取消后中断所有连接并抛出 SyncCancelled
 
-            return mail_records
+        Returns:
+            dict: {'records': [...], 'states': [...], 'changes': [...], 'skipped': [...], 'errors': {folder: error}}
+        """
+        if callback is None:
+            callback = lambda progress, message: None
 
+        last_check_time = normalize_check_time(last_check_time)
+        if not last_check_time:
+            # Default to last 60 days on first sync
+            last_check_time = datetime.utcnow() - timedelta(days=60)
+
+        port = port or (993 if use_ssl else 143)
+        folder_states = folder_states or {}
+        wanted = IMAPMailHandler.parse_folder_config(folders)
+        limit = max(1, int(max_connections or IMAPMailHandler.MAX_FOLDER_CONNECTIONS))
+
+        logger.info(f"连接IMAP服务器 {server}:{port} (SSL: {use_ssl})")
+        callback(0, "正在连接邮箱服务器")
+        primary = IMAPMailHandler._open_connection(server, port, use_ssl, cancel)
+        opened = [primary]
+        result = {'records': [], 'states': [], 'changes': [], 'skipped': [], 'errors': {}}
+        unregister = []
+        # 额外连接占用的服务器名额数
+        host_slots = [0]
+
+        def watch(conn):
+            # 取消时关闭连接，阻塞在读写上的线程立即返回
+            if cancel is not None:
+                unregister.append(cancel.on_cancel(lambda: imap_transport.abort(conn)))
+
+        watch(primary)
+        try:
+            logger.info(f"登录邮箱 {email_address}")
+            callback(10, "正在登录邮箱")
+            primary.login(email_address, password)
+            IMAPMailHandler._enable_extensions(primary)
+
+            def list_folders():
+                _, listing = primary.list()
+                found = IMAPMailHandler.resolve_folders(IMAPMailHandler._parse_list_response(listing), wanted)
+                return found or [('INBOX', 'INBOX')]
+
+            # 所有配置项都已有同步状态时直接复用上次解析的文件夹名，省去 LIST
+            known = {state.get('folder_key'): folder for folder, state in folder_states.items() if state.get('folder_key')}
+            from_state = False
+            if wanted == ['INBOX']:
+                resolved = [('INBOX', 'INBOX')]
+            elif all(key in known for key in wanted):
+                resolved = [(key, known[key]) for key in wanted]
+                from_state = True
+            else:
+                resolved = list_folders()
+
+            pending, skipped, failed, statuses = IMAPMailHandler._precheck_folders(primary, resolved, folder_states)
+            if failed and from_state:
+                # 文件夹可能已被重命名或删除，重新 LIST 解析
+                resolved = list_folders()
+                pending, skipped, failed, statuses = IMAPMailHandler._precheck_folders(primary, resolved, folder_states)
+            result['skipped'] = skipped
+            if skipped:
+                logger.info(f"文件夹无变化，跳过: {skipped}")
+            if not pending:
+                callback(100, "没有找到新邮件")
+                return result
+            logger.info(f"待同步文件夹: {[name for _, name in pending]}")
+
+            pool = queue.Queue()
+            pool.put(primary)
+            pool_lock = threading.Lock()
+            completed = [0]
+            total = len(pending)
+
+            def acquire():
+                try:
+                    return pool.get_nowait()
+                except queue.Empty:
+                    pass
+                with pool_lock:
+                    can_open = len(opened) < limit and host_limiter.try_acquire(host)
+                    if can_open:
+                        opened.append(None)
+                        if host is not None:
+                            host_slots[0] += 1
+                if not can_open:
+                    return pool.get()
+                conn = None
+                try:
+                    conn = IMAPMailHandler._open_connection(server, port, use_ssl, cancel)
+                    watch(conn)
+                    conn.login(email_address, password)
+                    IMAPMailHandler._enable_extensions(conn)
+                    with pool_lock:
+                        opened[opened.index(None)] = conn
+                    return conn
+                except Exception:
+                    IMAPMailHandler._logout(conn)
+                    with pool_lock:
+                        opened.remove(None)
+                        if host is not None:
+                            host_slots[0] -= 1
+                    host_limiter.release(host)
+                    # 新连接失败时等待已有连接空闲
+                    return pool.get()
+
+            def sync_one(key, folder):
+                cancellation.check(cancel)
+                conn = acquire()
+                try:
+                    callback(20, f"正在同步文件夹 {folder}")
+                    folder_result = IMAPMailHandler._sync_folder(
+                        conn, folder, last_check_time, folder_states.get(folder), cancel=cancel
+                    )
+                    folder_result['state']['folder_key'] = key
+                    folder_result['state']['unseen'] = statuses.get(folder, {}).get('unseen')
+                    return folder_result
+                finally:
+                    pool.put(conn)
+
+            workers = min(limit, total)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(sync_one, key, folder): folder for key, folder in pending}
+                first_error = None
+                for future in concurrent.futures.as_completed(futures):
+                    folder = futures[future]
+                    completed[0] += 1
+                    try:
+                        folder_result = future.result()
+                        result['records'].extend(folder_result['records'])
+                        result['states'].append(folder_result['state'])
+                        if folder_result.get('change'):
+                            result['changes'].append(folder_result['change'])
+                    except Exception as e:
+                        logger.error(f"同步文件夹 {folder} 失败: {str(e)}")
+                        result['errors'][folder] = str(e)
+                        first_error = first_error or e
+                    callback(20 + int(completed[0] / total * 80), f"已完成 {completed[0]}/{total} 个文件夹")
+
+            # 已取消时丢弃部分结果，文件夹状态不推进，下次从原位置继续
+            cancellation.check(cancel)
+            if result['errors'] and len(result['errors']) == total:
+                # 保留原始异常，供熔断器判断失败类别
+                raise imaplib.IMAP4.error('; '.join(f"{k}: {v}" for k, v in result['errors'].items())) from first_error
+
+            log_email_complete(email_address, "未知", len(result['records']), len(result['records']), len(result['records']))
+            return result
+        finally:
+            for remove in unregister:
+                remove()
+            for conn in opened:
+                IMAPMailHandler._logout(conn)
+            for _ in range(host_slots[0]):
+                host_limiter.release(host)
+            IMAPMailHandler._log_transport(email_address, opened)
+
+    @staticmethod
+    @timing_decorator
+    def fetch_emails(email_address, password, server, port=993, use_ssl=True, folder="INBOX", callback=None, last_check_time=None):
+        """获取邮箱中的邮件"""
+        try:
+            result = IMAPMailHandler.fetch_folders(
+                email_address,
+                password,
+                server,
+                port=port,
+                use_ssl=use_ssl,
+                folders=[folder],
+                callback=callback,
+                last_check_time=last_check_time
+            )
+            return result['records']
         except Exception as e:
             logger.error(f"获取邮件失败: {str(e)}")
             log_email_error(email_address, "未知", str(e))
-            if mail:
-                try:
-                    mail.close()
-                    mail.logout()
-                except:
-                    pass
             return []
 
     @staticmethod
     @timing_decorator
-    def check_mail(email_info, db, progress_callback=None):
+    def check_mail(email_info, db, progress_callback=None, cancel=None):
         """检查邮箱中的新邮件"""
         try:
+            email_id = email_info['id']
             email_address = email_info['email']
             password = email_info['password']
-            server = email_info.get('server', 'imap.gmail.com')
-            port = email_info.get('port', 993)
+            server = email_info.get('server') or IMAPMailHandler.guess_server(email_address) or 'imap.gmail.com'
             use_ssl = email_info.get('use_ssl', True)
+            port = email_info.get('port') or (993 if use_ssl else 143)
 
             # 创建进度回调
-            def folder_progress_callback(progress, folder):
+            def folder_progress_callback(progress, message):
                 if progress_callback:
-                    progress_callback(progress, f"正在检查文件夹: {folder}")
+                    progress_callback(progress, message)
 
             # 获取邮件
-            mail_records = IMAPMailHandler.fetch_emails(
+            result = IMAPMailHandler.fetch_folders(
                 email_address=email_address,
                 password=password,
                 server=server,
                 port=port,
                 use_ssl=use_ssl,
-                callback=folder_progress_callback
+                folders=email_info.get('imap_folders'),
+                callback=folder_progress_callback,
+                last_check_time=email_info.get('last_check_time'),
+                folder_states=db.get_imap_folder_states(email_id),
+                cancel=cancel,
+                host=route_for(email_info).host
             )
+            mail_records = result['records']
+
+            saved_count = 0
+            if mail_records:
+                # 保存邮件记录
+                from .mail_processor import MailProcessor
+                saved_count = MailProcessor.save_mail_records(db, email_id, mail_records, progress_callback)
+
+            # 已有邮件的已读状态变化和删除在同一事务中写入
+            synced = db.sync_imap_folder_flags(email_id, result['changes'])
+            if synced['updated'] or synced['deleted']:
+                logger.info(f"邮箱 {email_address} 同步已读状态 {synced['updated']} 封，删除 {synced['deleted']} 封")
+
+            # 邮件入库后再推进各文件夹的增量状态
+            db.save_imap_folder_states(email_id, result['states'])
 
             if not mail_records:
                 if progress_callback:
-                    progress_callback(0, "没有找到新邮件")
-                return {'success': False, 'message': '没有找到新邮件'}
-
-            # 保存邮件记录
-            saved_count = db.save_mail_records(email_info['id'], mail_records, progress_callback)
+                    progress_callback(100, "没有找到新邮件")
+                return {'success': True, 'message': '没有找到新邮件', 'total': 0, 'saved': 0, 'synced': synced}
 
             if progress_callback:
                 progress_callback(100, f"成功获取 {len(mail_records)} 封邮件，新增 {saved_count} 封")
 
             return {
                 'success': True,
-                'message': f'成功获取 {len(mail_records)} 封邮件，新增 {saved_count} 封'
+                'message': f'成功获取 {len(mail_records)} 封邮件，新增 {saved_count} 封',
+                'total': len(mail_records),
+                'saved': saved_count,
+                'synced': synced
             }
 
         except Exception as e:
             logger.error(f"检查邮件失败: {str(e)}")
             if progress_callback:
                 progress_callback(0, f"检查邮件失败: {str(e)}")
-            return {'success': False, 'message': str(e)}
-
+            return {'success': False, 'message': str(e), 'error_class': classify_error(e)}
@@ -0,0 +1,234 @@
+"""
+IMAP FETCH 响应解析模块
+解析带括号列表和 literal 的 FETCH 响应（BODYSTRUCTURE、BODY[section]），
+用于只拉取正文部分、附件按需下载
+"""
+
+import re
+import email.utils
+import urllib.parse
+from typing import Dict, List, Optional
+
+from .common import decode_mime_words
+
+_LITERAL_RE = re.compile(rb'\{(\d+)\}\s*$')
+
+
+def _tokenize(data) -> List:
+    """
+    将 imaplib 返回的 FETCH 数据拆分为词法单元
+
+    imaplib 把 literal 拆成 (前缀, 内容) 元组，这里把内容作为单独的字符串单元插回原位置。
+    """
+    tokens = []
+    for item in data or []:
+        if isinstance(item, tuple):
+            text = item[0] or b''
+            literal = item[1] if len(item) > 1 else b''
+            match = _LITERAL_RE.search(text)
+            if match:
+                text = text[:match.start()]
+            _tokenize_text(text, tokens)
+            tokens.append(('string', literal or b''))
+        elif isinstance(item, bytes):
+            _tokenize_text(item, tokens)
+    return tokens
+
+
+def _tokenize_text(text: bytes, tokens: List):
+    i = 0
+    length = len(text)
+    while i < length:
+        ch = text[i:i + 1]
+        if ch in (b' ', b'\t', b'\r', b'\n'):
+            i += 1
+        elif ch in (b'(', b')'):
+            tokens.append((ch.decode(), None))
+            i += 1
+        elif ch == b'"':
+            i += 1
+            value = bytearray()
+            while i < length and text[i:i + 1] != b'"':
+                if text[i:i + 1] == b'\\' and i + 1 < length:
+                    i += 1
+                value += text[i:i + 1]
+                i += 1
+            tokens.append(('string', bytes(value)))
+            i += 1
+        else:
+            start = i
+            depth = 0
+            while i < length:
+                ch = text[i:i + 1]
+                if ch == b'[':
+                    depth += 1
+                elif ch == b']':
+                    depth -= 1
+                elif depth <= 0 and (ch in (b'(', b')') or ch in (b' ', b'\t', b'\r', b'\n')):
+                    break
+                i += 1
+            atom = text[start:i].decode('ascii', errors='ignore')
+            if atom.upper() == 'NIL':
+                tokens.append(('atom', None))
+            elif atom.isdigit():
+                tokens.append(('atom', int(atom)))
+            else:
+                tokens.append(('atom', atom))
+
+
+def _build(tokens: List, pos: int = 0, nested: bool = False):
+    """把词法单元组装为嵌套列表：原子为 str/int/None，字符串和 literal 为 bytes"""
+    values = []
+    while pos < len(tokens):
+        kind, value = tokens[pos]
+        pos += 1
+        if kind == '(':
+            child, pos = _build(tokens, pos, True)
+            values.append(child)
+        elif kind == ')':
+            if nested:
+                return values, pos
+        else:
+            values.append(value)
+    return values, pos
+
+
+def parse_fetch_response(data) -> List[Dict]:
+    """
+    解析 UID FETCH 的响应
+
+    Returns:
+        list: 每封邮件一个字典 {'uid', 'flags', 'size', 'bodystructure', 'sections': {section: bytes}}
+    """
+    values, _ = _build(_tokenize(data))
+    messages = []
+    for value in values:
+        if not isinstance(value, list):
+            continue
+        message = {'uid': None, 'flags': [], 'size': None, 'bodystructure': None, 'sections': {}}
+        for index in range(0, len(value) - 1, 2):
+            key = value[index]
+            item = value[index + 1]
+            if not isinstance(key, str):
+                continue
+            upper = key.upper()
+            if upper == 'UID':
+                message['uid'] = item
+            elif upper == 'FLAGS':
+                message['flags'] = [flag for flag in item or [] if isinstance(flag, str)]
+            elif upper == 'RFC822.SIZE':
+                message['size'] = item
+            elif upper in ('BODYSTRUCTURE', 'BODY') and isinstance(item, list):
+                message['bodystructure'] = item
+            elif upper.startswith('BODY['):
+                section = key[5:key.index(']')] if ']' in key else key[5:]
+                if isinstance(item, str):
+                    item = item.encode('utf-8')
+                message['sections'][section.upper()] = item
+        messages.append(message)
+    return messages
+
+
+def _text(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def _params(value) -> Dict[str, str]:
+    """解析 ("name" "value" ...) 形式的参数列表"""
+    params = {}
+    if isinstance(value, list):
+        for index in range(0, len(value) - 1, 2):
+            params[_text(value[index]).lower()] = _text(value[index + 1])
+    return params
+
+
+def _param_filename(params: Dict[str, str]) -> Optional[str]:
+    for key in ('filename', 'name'):
+        if params.get(key):
+            return decode_mime_words(params[key])
+        encoded = params.get(key + '*')
+        if encoded:
+            # RFC 2231: utf-8''%E9%99%84%E4%BB%B6.pdf
+            charset, _, text = email.utils.decode_rfc2231(encoded)
+            try:
+                return urllib.parse.unquote(text, encoding=charset or 'utf-8', errors='replace')
+            except LookupError:
+                return urllib.parse.unquote(text, errors='replace')
+    return None
+
+
+def walk_parts(structure, section: str = '') -> List[Dict]:
+    """
+    展开 BODYSTRUCTURE，返回所有叶子部分
+
+    每个部分包含 section、content_type、charset、encoding、size、filename、
+    is_attachment（是否附件）和 is_text（是否正文）。message/rfc822 作为整体附件，不再展开。
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+
+    if isinstance(structure[0], list):
+        parts = []
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            parts.extend(walk_parts(child, f"{section}.{index}" if section else str(index)))
+        return parts
+
+    main_type = _text(structure[0]).lower()
+    sub_type = _text(structure[1] if len(structure) > 1 else '').lower()
+    params = _params(structure[2] if len(structure) > 2 else None)
+    encoding = _text(structure[5] if len(structure) > 5 else '').lower() or '7bit'
+    size = structure[6] if len(structure) > 6 and isinstance(structure[6], int) else 0
+
+    # 扩展字段的位置取决于类型
+    if main_type == 'text':
+        ext = 8
+    elif main_type == 'message' and sub_type == 'rfc822':
+        ext = 10
+    else:
+        ext = 7
+    disposition = structure[ext + 1] if len(structure) > ext + 1 else None
+    disposition_type = ''
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _text(disposition[0]).lower()
+        disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+
+    filename = _param_filename(disposition_params) or _param_filename(params)
+    content_type = f"{main_type}/{sub_type}"
+
+    # 与 extract_email_attachments 的判断保持一致
+    is_attachment = disposition_type == 'attachment' or (
+        bool(filename) and content_type not in ('text/plain', 'text/html')
+    )
+    if content_type == 'message/rfc822' and not filename:
+        filename = 'attached_message.eml'
+        is_attachment = True
+
+    return [{
+        'section': section or '1',
+        'content_type': content_type,
+        'charset': params.get('charset'),
+        'encoding': encoding,
+        'size': size,
+        'filename': filename,
+        'is_attachment': is_attachment,
+        'is_text': not is_attachment and content_type in ('text/plain', 'text/html'),
+    }]
+
+
+def estimate_decoded_size(size: int, encoding: str) -> int:
+    """根据传输编码估算附件解码后的大小"""
+    if not size:
+        return 0
+    if encoding == 'base64':
+        # base64 每 76 个字符换行
+        return int(size * 57 / 78)
+    return int(size)
@@ -0,0 +1,305 @@
+"""
+IMAP传输层优化模块
+- 所有 IMAP4_SSL 连接共用一个 SSLContext，并按 (host, port) 复用 TLS 会话，减少握手往返
+- 服务器支持 COMPRESS=DEFLATE (RFC 4978) 时启用压缩
+- 统计线路上的收发字节数和握手耗时，供基准测试和日志使用
+"""
+
+import imaplib
+import os
+import re
+import socket
+import ssl
+import threading
+import time
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# COMPRESS 不是 imaplib 内置命令
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+_CAPABILITY_RE = re.compile(rb'\[CAPABILITY ([^\]]*)\]', re.I)
+
+# 是否启用 COMPRESS=DEFLATE / TLS 会话复用
+COMPRESS_ENABLED = os.environ.get('IMAP_COMPRESS', '1') != '0'
+SESSION_REUSE_ENABLED = os.environ.get('IMAP_TLS_SESSION_REUSE', '1') != '0'
+COMPRESS_LEVEL = int(os.environ.get('IMAP_COMPRESS_LEVEL', '6'))
+# 最低 TLS 版本（如 TLSv1_2），默认沿用 ssl 模块的下限，兼容只支持旧版 TLS 的邮件服务器
+TLS_MIN_VERSION = os.environ.get('IMAP_TLS_MIN_VERSION', '').strip()
+
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_ssl_context():
+    """获取所有IMAP连接共用的 SSLContext（TLS 会话只能在同一个 context 内复用）"""
+    global _ssl_context
+    with _ssl_context_lock:
+        if _ssl_context is None:
+            if os.environ.get('IMAP_TLS_VERIFY', '0') == '1':
+                context = ssl.create_default_context()
+            else:
+                # 与 imaplib 默认行为一致：不校验证书，兼容自签名的私有邮件服务器
+                context = ssl._create_unverified_context()
+            if TLS_MIN_VERSION:
+                try:
+                    context.minimum_version = ssl.TLSVersion[TLS_MIN_VERSION]
+                except (KeyError, ValueError) as e:
+                    logger.warning(f"无效的 IMAP_TLS_MIN_VERSION={TLS_MIN_VERSION}，使用默认值: {str(e)}")
+            context.options |= ssl.OP_NO_COMPRESSION
+            _ssl_context = context
+        return _ssl_context
+
+
+class TransportStats:
+    """进程级的连接统计"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.connections = 0
+        self.sessions_reused = 0
+        self.compressed_connections = 0
+        self.handshake_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_received_uncompressed = 0
+
+    def reset(self):
+        with self.lock:
+            self._clear()
+
+    def record_connection(self, handshake_seconds, reused):
+        with self.lock:
+            self.connections += 1
+            self.handshake_seconds += handshake_seconds
+            if reused:
+                self.sessions_reused += 1
+
+    def record_close(self, conn):
+        with self.lock:
+            self.bytes_sent += conn.bytes_sent
+            self.bytes_received += conn.bytes_received
+            self.bytes_received_uncompressed += conn.bytes_received_uncompressed
+            if conn.compressed:
+                self.compressed_connections += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'sessions_reused': self.sessions_reused,
+                'compressed_connections': self.compressed_connections,
+                'avg_handshake_ms': round(self.handshake_seconds * 1000 / self.connections, 2) if self.connections else 0,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'bytes_received_uncompressed': self.bytes_received_uncompressed,
+            }
+
+
+stats = TransportStats()
+
+
+class _TransportMixin:
+    """在 imaplib 的读写入口上加字节统计和 DEFLATE 压缩"""
+
+    def _init_transport(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_received_uncompressed = 0
+        self.compressed = False
+        self.handshake_seconds = 0.0
+        self.session_reused = False
+        self._compressor = None
+        self._decompressor = None
+        self._inbuf = b''
+        self._closed_recorded = False
+
+    def read(self, size):
+        if not self.compressed:
+            data = super().read(size)
+            self.bytes_received += len(data)
+            self.bytes_received_uncompressed += len(data)
+            return data
+        while len(self._inbuf) < size:
+            self._fill()
+        data, self._inbuf = self._inbuf[:size], self._inbuf[size:]
+        return data
+
+    def readline(self):
+        if not self.compressed:
+            line = super().readline()
+            self.bytes_received += len(line)
+            self.bytes_received_uncompressed += len(line)
+            return line
+        while True:
+            pos = self._inbuf.find(b'\n')
+            if pos >= 0:
+                line, self._inbuf = self._inbuf[:pos + 1], self._inbuf[pos + 1:]
+                return line
+            if len(self._inbuf) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            self._fill()
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise self.abort('socket error: EOF')
+        self.bytes_received += len(chunk)
+        data = self._decompressor.decompress(chunk)
+        self.bytes_received_uncompressed += len(data)
+        self._inbuf += data
+
+    def send(self, data):
+        if self.compressed:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_sent += len(data)
+        super().send(data)
+
+    def login(self, user, password):
+        typ, dat = super().login(user, password)
+        self._refresh_capabilities(dat)
+        self._remember_session()
+        return typ, dat
+
+    def _refresh_capabilities(self, dat):
+        """登录后服务器能力可能变化（如只在认证后通告 COMPRESS），优先使用登录响应里的 CAPABILITY"""
+        match = None
+        for item in dat or []:
+            if isinstance(item, bytes):
+                match = _CAPABILITY_RE.search(item)
+                if match:
+                    break
+        if match:
+            self.capabilities = tuple(match.group(1).decode('ascii', errors='ignore').upper().split())
+            return
+        try:
+            typ, data = self.capability()
+            if typ == 'OK' and data and data[-1]:
+                self.capabilities = tuple(data[-1].decode('ascii', errors='ignore').upper().split())
+        except Exception as e:
+            logger.debug(f"刷新IMAP能力列表失败: {str(e)}")
+
+    def _remember_session(self):
+        pass
+
+    def enable_compression(self):
+        """协商 COMPRESS=DEFLATE，成功后所有读写都经过 raw DEFLATE 流"""
+        if self.compressed or 'COMPRESS=DEFLATE' not in self.capabilities:
+            return False
+        typ, _ = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        # 此后不再经过 self.file 读取，所有数据都从压缩流解出
+        self._inbuf = b''
+        self.compressed = True
+        return True
+
+    def shutdown(self):
+        if not self._closed_recorded:
+            self._closed_recorded = True
+            stats.record_close(self)
+        super().shutdown()
+
+
+class TunedIMAP4(_TransportMixin, imaplib.IMAP4):
+    """带字节统计和压缩支持的明文 IMAP 连接"""
+
+    def __init__(self, host='', port=imaplib.IMAP4_PORT, timeout=None):
+        self._init_transport()
+        super().__init__(host, port, timeout)
+
+    def _create_socket(self, timeout):
+        start = time.monotonic()
+        sock = super()._create_socket(timeout)
+        self.handshake_seconds = time.monotonic() - start
+        stats.record_connection(self.handshake_seconds, False)
+        return sock
+
+
+class TunedIMAP4_SSL(_TransportMixin, imaplib.IMAP4_SSL):
+    """使用共享 SSLContext 并复用 TLS 会话的 IMAP4_SSL"""
+
+    def __init__(self, host='', port=imaplib.IMAP4_SSL_PORT, timeout=None):
+        self._init_transport()
+        super().__init__(host, port, ssl_context=get_ssl_context(), timeout=timeout)
+
+    def _create_socket(self, timeout):
+        start = time.monotonic()
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        key = (self.host, self.port)
+        session = None
+        if SESSION_REUSE_ENABLED:
+            with _sessions_lock:
+                session = _sessions.get(key)
+        try:
+            sslsock = self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=session)
+        except ssl.SSLError:
+            if session is None:
+                raise
+            # 会话失效时丢弃缓存并完整握手
+            with _sessions_lock:
+                _sessions.pop(key, None)
+            sock = imaplib.IMAP4._create_socket(self, timeout)
+            sslsock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+        self.handshake_seconds = time.monotonic() - start
+        self.session_reused = bool(sslsock.session_reused)
+        stats.record_connection(self.handshake_seconds, self.session_reused)
+        return sslsock
+
+    def _remember_session(self):
+        # TLS 1.3 的会话票据在握手后才到达，登录完成后再保存
+        if not SESSION_REUSE_ENABLED:
+            return
+        try:
+            session = self.sock.session
+            if session is not None:
+                with _sessions_lock:
+                    _sessions[(self.host, self.port)] = session
+        except Exception:
+            pass
+
+
+def open_connection(server, port, use_ssl, timeout=None):
+    """建立未登录的IMAP连接"""
+    if use_ssl:
+        return TunedIMAP4_SSL(server, port, timeout=timeout)
+    return TunedIMAP4(server, port, timeout=timeout)
+
+
+def set_timeout(mail, timeout):
+    """调整已建立连接的读写超时"""
+    sock = getattr(mail, 'sock', None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+def abort(mail):
+    """从其他线程中断连接，阻塞中的读写立即返回错误"""
+    sock = getattr(mail, 'sock', None)
+    if sock is None:
+        return
+    try:
+        # 直接关闭底层套接字，不经过 SSL 层的关闭握手
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def enable_compression(mail):
+    """服务器支持时启用 COMPRESS=DEFLATE，返回是否已启用"""
+    if not COMPRESS_ENABLED or not hasattr(mail, 'enable_compression'):
+        return False
+    try:
+        return mail.enable_compression()
+    except Exception as e:
+        logger.debug(f"启用COMPRESS失败: {str(e)}")
+        return False
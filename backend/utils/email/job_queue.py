@@ -0,0 +1,225 @@
+"""
+持久化同步任务队列
+任务保存在 sync_jobs 表中，工作线程按租约领取并定期续约：
+- 进程退出后未完成的任务在租约过期后由其他工作线程重新领取
+- 失败任务按指数退避重试，超过最大次数后标记为 failed
+- 同一邮箱同类任务排队或执行中时不重复添加，同一邮箱同时只执行一个任务
+"""
+
+import os
+import json
+import random
+import socket
+import threading
+import time
+import logging
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+JOB_INCREMENTAL = 'incremental'
+JOB_BACKFILL = 'backfill'
+JOB_ATTACHMENT = 'attachment'
+
+# 租约时长，工作线程每 1/3 租约续约一次
+LEASE_SECONDS = float(os.environ.get('SYNC_JOB_LEASE', '120'))
+# 失败重试的退避基数和上限（秒）
+RETRY_BASE_SECONDS = float(os.environ.get('SYNC_JOB_RETRY_BASE', '30'))
+RETRY_MAX_SECONDS = float(os.environ.get('SYNC_JOB_RETRY_MAX', '1800'))
+MAX_ATTEMPTS = int(os.environ.get('SYNC_JOB_MAX_ATTEMPTS', '5'))
+# 已结束任务保留时长
+RETENTION_SECONDS = float(os.environ.get('SYNC_JOB_RETENTION', '86400'))
+# 队列为空时的轮询间隔
+POLL_SECONDS = 2.0
+
+
+class SyncJobQueue:
+    """sync_jobs 表的读写封装，owner 标识当前进程，每个领取到的任务带各自的租约令牌"""
+
+    def __init__(self, db, owner=None):
+        self.db = db
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+
+    def enqueue(self, email_id, job_type, payload=None, dedup_key='', priority=0, delay=0, max_attempts=None):
+        """添加任务，已有相同任务排队时返回已有任务ID"""
+        return self.db.enqueue_sync_job(
+            email_id,
+            job_type,
+            payload=json.dumps(payload) if payload is not None else None,
+            dedup_key=str(dedup_key or ''),
+            priority=priority,
+            run_after=time.time() + delay,
+            max_attempts=max_attempts or MAX_ATTEMPTS,
+        )
+
+    def claim(self, limit=1, shard=None, exclude_mail_types=None):
+        jobs = self.db.claim_sync_jobs(self.owner, LEASE_SECONDS, limit=limit, shard=shard,
+                                       exclude_mail_types=exclude_mail_types)
+        for job in jobs:
+            job['payload'] = json.loads(job['payload']) if job.get('payload') else {}
+        return jobs
+
+    def heartbeat(self, jobs):
+        """续约，返回租约已丢失的任务ID"""
+        kept = set(self.db.heartbeat_sync_jobs({job['id']: job['lease_owner'] for job in jobs}, LEASE_SECONDS))
+        return [job['id'] for job in jobs if job['id'] not in kept]
+
+    def complete(self, job):
+        return self.db.complete_sync_job(job['id'], job['lease_owner'])
+
+    def fail(self, job, error, retry=True):
+        """记录失败并按退避时间重新排队，返回任务的新状态"""
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(0, job['attempts'] - 1))
+        delay *= random.uniform(0.8, 1.2)
+        return self.db.fail_sync_job(job['id'], job['lease_owner'], error, delay, retry=retry)
+
+    def release(self, job, delay=0):
+        """放回队列，不计入重试次数"""
+        return self.db.release_sync_job(job['id'], job['lease_owner'], delay, count_attempt=False)
+
+
+class SyncJobWorker:
+    """
+    从队列领取任务并在线程池中执行
+
+    handlers 按任务类型返回结果字典，success 为 False 或抛出异常时任务按退避重试；
+    任务结束（完成或重试次数用尽）后通知 listeners(job, result)。
+    传入 lanes（LanePool）和 lane_of(job)（返回 Route）时按服务商通道执行，不领取通道已满的邮箱类型的任务
+    """
+
+    def __init__(self, queue, handlers, max_workers=5, shard=None, lanes=None, lane_of=None):
+        self.queue = queue
+        self.handlers = handlers
+        self.max_workers = max(1, int(max_workers))
+        # 只领取该分片邮箱的任务，None 表示不限
+        self.shard = shard
+        self.lanes = lanes
+        self.lane_of = lane_of
+        self._executor = lanes
+        self._running = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_purge = 0.0
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def notify(self):
+        """有新任务入队时唤醒领取循环"""
+        self._wake.set()
+
+    @property
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def start(self):
+        if self.is_running:
+            return False
+        self._stop_event.clear()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sync-job')
+        self._thread = threading.Thread(target=self._loop, name='sync-job-worker', daemon=True)
+        self._thread.start()
+        logger.info(f"同步任务工作线程已启动: owner={self.queue.owner}, 并发={self.max_workers}")
+        return True
+
+    def stop(self, grace=0):
+        """停止领取新任务，最多等待 grace 秒让执行中的任务结束"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._thread = None
+        deadline = time.monotonic() + grace
+        while self.running_count() and time.monotonic() < deadline:
+            time.sleep(0.2)
+        # 未完成的任务放回队列，由下次启动或其他进程继续
+        with self._lock:
+            running = list(self._running.values())
+        for job in running:
+            self.queue.release(job)
+
+    def running_count(self):
+        with self._lock:
+            return len(self._running)
+
+    def _loop(self):
+        last_heartbeat = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self._wake.clear()
+                free = self.max_workers - self.running_count()
+                if free > 0:
+                    exclude = self.lanes.saturated() if self.lanes else None
+                    for job in self.queue.claim(limit=free, shard=self.shard, exclude_mail_types=exclude):
+                        self._submit(job)
+
+                if time.monotonic() - last_heartbeat >= LEASE_SECONDS / 3:
+                    self._heartbeat()
+                    last_heartbeat = time.monotonic()
+
+                if time.time() - self._last_purge >= 3600:
+                    self._last_purge = time.time()
+                    purged = self.queue.db.purge_sync_jobs(time.time() - RETENTION_SECONDS)
+                    if purged:
+                        logger.info(f"已清理 {purged} 条过期同步任务")
+            except Exception as e:
+                logger.error(f"同步任务领取循环出错: {str(e)}")
+            self._wake.wait(POLL_SECONDS)
+
+    def _heartbeat(self):
+        with self._lock:
+            jobs = list(self._running.values())
+        for job_id in self.queue.heartbeat(jobs):
+            logger.warning(f"同步任务 {job_id} 的租约已被其他工作进程接管")
+
+    def _submit(self, job):
+        with self._lock:
+            self._running[job['id']] = job
+        try:
+            if self.lanes:
+                self.lanes.submit_to(self.lane_of(job), self._run, job)
+            else:
+                self._executor.submit(self._run, job)
+        except RuntimeError:
+            with self._lock:
+                self._running.pop(job['id'], None)
+            self.queue.release(job)
+
+    def _run(self, job):
+        handler = self.handlers.get(job['job_type'])
+        try:
+            if handler is None:
+                result = {'success': False, 'message': f"未知任务类型: {job['job_type']}", 'retry': False}
+            else:
+                result = handler(job) or {}
+        except Exception as e:
+            logger.error(f"同步任务执行异常: id={job['id']} type={job['job_type']} email_id={job['email_id']}: {str(e)}")
+            result = {'success': False, 'message': str(e)}
+        finally:
+            with self._lock:
+                self._running.pop(job['id'], None)
+
+        if result.get('deferred'):
+            # 邮箱正被其他途径同步，稍后再执行
+            self.queue.release(job, delay=result.get('delay', 30))
+            final = False
+        elif result.get('success'):
+            self.queue.complete(job)
+            final = True
+        else:
+            status = self.queue.fail(job, result.get('message'), retry=result.get('retry', True))
+            final = status == 'failed'
+            if status == 'pending':
+                logger.info(f"同步任务将重试: id={job['id']} type={job['job_type']} 第 {job['attempts']} 次失败: {result.get('message')}")
+
+        if final:
+            for listener in list(self._listeners):
+                try:
+                    listener(job, result)
+                except Exception as e:
+                    logger.error(f"同步任务回调出错: {str(e)}")
+        self._wake.set()
@@ -0,0 +1,393 @@
+"""
+按邮箱服务商划分的同步线程池
+outlook、gmail、qq 和通用 IMAP 各有独立的线程（通道），Graph 限流时 Outlook 任务在自己的通道里等待，
+不占用其他服务商的线程。某个通道空闲时它的线程可以帮其他通道执行排队任务（工作窃取），
+但每个通道至少留一个线程处理自己的任务，被帮忙的通道总并发也不超过其上限。
+通用 IMAP 任务另外按服务器限制同时连接数，进程内所有线程池、文件夹并行连接和附件下载共享同一个限制；
+限制按进程计数，SYNC_WORKERS 个分片工作进程各自有一份。
+
+通道内按用户加权公平排队：一次提交大量邮箱的用户不会让其他用户的检查排在其全部任务之后，
+每个用户在通道内的并发也有上限，始终给其他用户留出线程
+"""
+
+import os
+import threading
+import time
+import concurrent.futures
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+LANES = ('outlook', 'gmail', 'qq', 'imap')
+
+# 通用 IMAP 同一服务器在本进程内的最大同时连接数
+IMAP_HOST_MAX_CONNECTIONS = max(1, int(os.environ.get('IMAP_HOST_MAX_CONNECTIONS', '2')))
+# 等待服务器名额的任务定期重新检查（其他线程池释放名额时不会通知本线程池）
+_HOST_RECHECK_SECONDS = 1.0
+
+# 单个用户在一个线程池内的最大并发，0 表示不限
+USER_MAX_RUNNING = max(0, int(os.environ.get('FAIR_SHARE_USER_MAX_RUNNING', '0')))
+# 每个通道给其他用户保留的线程数：单个用户最多占用通道上限减去该值
+RESERVED_SLOTS = max(0, int(os.environ.get('FAIR_SHARE_RESERVED_SLOTS', '1')))
+# 排队位置的刷新间隔（秒）和持续通知的前若干位，靠后的任务只在首次排队时通知
+POSITION_REFRESH_SECONDS = 2.0
+POSITION_NOTIFY_LIMIT = 100
+
+
+def _parse_weights(value):
+    """FAIR_SHARE_WEIGHTS=用户ID:权重,...，未列出的用户权重为 1"""
+    weights = {}
+    for item in (value or '').split(','):
+        user_id, _, weight = item.partition(':')
+        try:
+            weights[int(user_id)] = max(0.01, float(weight))
+        except ValueError:
+            continue
+    return weights
+
+
+USER_WEIGHTS = _parse_weights(os.environ.get('FAIR_SHARE_WEIGHTS'))
+
+# 提交任务时的调度信息：通道、服务器（参与连接数限制，可为 None）、用户、排队位置回调 on_position(位置)
+Route = collections.namedtuple('Route', ['lane', 'host', 'tenant', 'on_position'], defaults=(None, None, None))
+
+
+def route_for(email_info, on_position=None):
+    """邮箱所属的通道、服务器和用户，只有通用 IMAP 的服务器参与连接数限制"""
+    mail_type = email_info.get('mail_type') or 'outlook'
+    tenant = email_info.get('user_id')
+    if mail_type in ('outlook', 'gmail', 'qq'):
+        return Route(mail_type, None, tenant, on_position)
+    from .imap import IMAPMailHandler
+    server = email_info.get('server') or IMAPMailHandler.guess_server(email_info.get('email'))
+    return Route('imap', str(server).lower() if server else None, tenant, on_position)
+
+
+def lane_limits(default_workers):
+    """
+    各通道的配置：{通道: (专属线程数, 含窃取在内的最大并发)}
+
+    SYNC_LANE_<通道>_WORKERS 默认为 default_workers 的一半（向上取整），
+    SYNC_LANE_<通道>_MAX 默认为 default_workers，即单个服务商的并发不超过原来的单一线程池
+    """
+    limits = {}
+    for lane in LANES:
+        prefix = f'SYNC_LANE_{lane.upper()}'
+        workers = max(1, int(os.environ.get(f'{prefix}_WORKERS', (default_workers + 1) // 2)))
+        limit = max(workers, int(os.environ.get(f'{prefix}_MAX', max(workers, default_workers))))
+        limits[lane] = (workers, limit)
+    return limits
+
+
+class HostLimiter:
+    """
+    按服务器计数的连接名额
+
+    同步任务出队时占一个名额（任务的主连接），同步中额外打开的文件夹连接和按需下载附件的连接各占一个
+    """
+
+    def __init__(self, limit=IMAP_HOST_MAX_CONNECTIONS):
+        self.limit = limit
+        self._counts = collections.Counter()
+        self._lock = threading.Condition()
+
+    def available(self, host):
+        with self._lock:
+            return host is None or self._counts[host] < self.limit
+
+    def try_acquire(self, host):
+        if host is None:
+            return True
+        with self._lock:
+            if self._counts[host] >= self.limit:
+                return False
+            self._counts[host] += 1
+            return True
+
+    def acquire(self, host, timeout=None):
+        """等待名额，timeout 秒内没有空出时返回 False"""
+        if host is None:
+            return True
+        with self._lock:
+            if not self._lock.wait_for(lambda: self._counts[host] < self.limit, timeout):
+                return False
+            self._counts[host] += 1
+            return True
+
+    def release(self, host):
+        if host is None:
+            return
+        with self._lock:
+            self._counts[host] -= 1
+            if self._counts[host] <= 0:
+                del self._counts[host]
+            self._lock.notify_all()
+
+
+# 进程内共享的服务器连接名额
+host_limiter = HostLimiter()
+
+
+class _Task:
+    __slots__ = ('future', 'fn', 'args', 'kwargs', 'route', 'tag', 'position')
+
+    def __init__(self, future, fn, args, kwargs, route):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.route = route
+        self.tag = 0.0
+        self.position = None
+
+
+class _FairQueue:
+    """
+    按用户加权公平排队（WFQ）
+
+    任务的虚拟完成时间 = max(当前虚拟时间, 该用户上一个任务的虚拟完成时间) + 1 / 权重，
+    出队时取可执行任务中虚拟完成时间最小的。同一用户的任务保持提交顺序
+    """
+
+    def __init__(self):
+        self._tenants = collections.OrderedDict()
+        self._last = {}
+        self._vtime = 0.0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, task):
+        tenant = task.route.tenant
+        weight = USER_WEIGHTS.get(tenant, 1.0)
+        task.tag = max(self._vtime, self._last.get(tenant, 0.0)) + 1.0 / weight
+        self._last[tenant] = task.tag
+        self._tenants.setdefault(tenant, collections.deque()).append(task)
+        self._size += 1
+
+    def pop(self, tenant_allowed, host_available):
+        """取出虚拟完成时间最小且用户未达并发上限、服务器有名额的任务"""
+        best = None
+        for tenant, tasks in self._tenants.items():
+            if not tenant_allowed(tenant):
+                continue
+            for index, task in enumerate(tasks):
+                if host_available(task.route.host):
+                    if best is None or task.tag < best[2].tag:
+                        best = (tenant, index, task)
+                    break
+        if best is None:
+            return None
+        tenant, index, task = best
+        tasks = self._tenants[tenant]
+        del tasks[index]
+        self._size -= 1
+        self._vtime = max(self._vtime, task.tag)
+        if not tasks:
+            del self._tenants[tenant]
+            # 该用户已没有排队任务且不再领先于虚拟时间，不必保留其记录
+            if self._last.get(tenant, 0.0) <= self._vtime:
+                self._last.pop(tenant, None)
+        return task
+
+    def requeue(self, task):
+        """把刚取出但未能执行的任务放回原位置，保留其虚拟完成时间和用户内的提交顺序"""
+        tenant = task.route.tenant
+        tasks = self._tenants.setdefault(tenant, collections.deque())
+        index = next((i for i, queued in enumerate(tasks) if queued.tag > task.tag), len(tasks))
+        tasks.insert(index, task)
+        self._last[tenant] = max(self._last.get(tenant, 0.0), task.tag)
+        self._size += 1
+
+    def drain(self):
+        tasks = [task for tasks in self._tenants.values() for task in tasks]
+        self._tenants.clear()
+        self._size = 0
+        return tasks
+
+    def ordered(self):
+        """按预计出队顺序排列的排队任务"""
+        return sorted((task for tasks in self._tenants.values() for task in tasks), key=lambda task: task.tag)
+
+
+class LanePool:
+    """按通道调度的线程池，接口与 ThreadPoolExecutor 相近，提交时指定 Route"""
+
+    def __init__(self, name, limits, host_limiter=None):
+        self.name = name
+        self.limits = dict(limits)
+        self.host_limiter = host_limiter or HostLimiter()
+        self._queues = {lane: _FairQueue() for lane in self.limits}
+        self._running = collections.Counter()
+        # 每个通道正在帮其他通道执行任务的线程数
+        self._lent = collections.Counter()
+        # 各用户在各通道和整个线程池中执行中的任务数
+        self._tenant_lane_running = collections.Counter()
+        self._tenant_running = collections.Counter()
+        self._positions_dirty = set()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = []
+
+    @property
+    def workers(self):
+        """线程总数"""
+        return sum(workers for workers, _ in self.limits.values())
+
+    def limit(self, lane):
+        return self.limits[lane][1]
+
+    def tenant_limit(self, lane):
+        """单个用户在通道内的最大并发"""
+        return max(1, self.limit(lane) - RESERVED_SLOTS)
+
+    def submit_to(self, route, fn, *args, **kwargs):
+        if route.lane not in self._queues:
+            raise ValueError(f"未知的同步通道: {route.lane}")
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('线程池已关闭')
+            self._queues[route.lane].push(_Task(future, fn, args, kwargs, route))
+            self._positions_dirty.add(route.lane)
+            self._start_threads()
+            self._cond.notify_all()
+        return future
+
+    def saturated(self):
+        """已有任务排队或并发已满的通道，再提交只会排队"""
+        with self._cond:
+            return [lane for lane, queue in self._queues.items()
+                    if len(queue) or self._running[lane] >= self.limit(lane)]
+
+    def stats(self):
+        with self._cond:
+            return {lane: {'queued': len(queue), 'running': self._running[lane], 'lent': self._lent[lane],
+                           'workers': self.limits[lane][0], 'max': self.limits[lane][1]}
+                    for lane, queue in self._queues.items()}
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._shutdown = True
+            pending = [task for queue in self._queues.values() for task in queue.drain()]
+            self._cond.notify_all()
+        for task in pending:
+            task.future.cancel()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _start_threads(self):
+        # 首次提交时创建线程，避免未使用的线程池占用线程
+        if self._threads:
+            return
+        for lane, (workers, _) in self.limits.items():
+            for i in range(workers):
+                thread = threading.Thread(target=self._worker, args=(lane,), name=f'{self.name}-{lane}-{i}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        thread = threading.Thread(target=self._position_loop, name=f'{self.name}-positions', daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _tenant_allowed(self, lane, tenant):
+        if tenant is None:
+            return True
+        if self._tenant_lane_running[(lane, tenant)] >= self.tenant_limit(lane):
+            return False
+        return not USER_MAX_RUNNING or self._tenant_running[tenant] < USER_MAX_RUNNING
+
+    def _take(self, lane):
+        """从通道队列中公平地取出一个可执行的任务，并占用其服务器名额"""
+        if self._running[lane] >= self.limit(lane):
+            return None
+        task = self._queues[lane].pop(lambda tenant: self._tenant_allowed(lane, tenant), self.host_limiter.available)
+        if task is None:
+            return None
+        if not self.host_limiter.try_acquire(task.route.host):
+            # 名额刚被其他线程池占用，放回原位置稍后重试
+            self._queues[lane].requeue(task)
+            return None
+        self._positions_dirty.add(lane)
+        return task
+
+    def _next(self, home):
+        """本通道的任务优先，本通道没有可执行任务时从排队最多的通道窃取"""
+        task = self._take(home)
+        if task:
+            return home, task
+        if self._lent[home] >= self.limits[home][0] - 1:
+            return None
+        for lane in sorted(self._queues, key=lambda name: len(self._queues[name]), reverse=True):
+            if lane != home and len(self._queues[lane]):
+                task = self._take(lane)
+                if task:
+                    return lane, task
+        return None
+
+    def _worker(self, home):
+        while True:
+            with self._cond:
+                picked = None
+                while not self._shutdown:
+                    picked = self._next(home)
+                    if picked:
+                        break
+                    self._cond.wait(_HOST_RECHECK_SECONDS)
+                if picked is None:
+                    return
+                lane, task = picked
+                tenant = task.route.tenant
+                self._running[lane] += 1
+                self._tenant_lane_running[(lane, tenant)] += 1
+                self._tenant_running[tenant] += 1
+                if lane != home:
+                    self._lent[home] += 1
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        task.future.set_result(task.fn(*task.args, **task.kwargs))
+                    except BaseException as e:
+                        task.future.set_exception(e)
+            finally:
+                self.host_limiter.release(task.route.host)
+                with self._cond:
+                    self._running[lane] -= 1
+                    self._tenant_lane_running[(lane, tenant)] -= 1
+                    if self._tenant_lane_running[(lane, tenant)] <= 0:
+                        del self._tenant_lane_running[(lane, tenant)]
+                    self._tenant_running[tenant] -= 1
+                    if self._tenant_running[tenant] <= 0:
+                        del self._tenant_running[tenant]
+                    if lane != home:
+                        self._lent[home] -= 1
+                    self._cond.notify_all()
+
+    def _position_loop(self):
+        """定期通知排队任务的当前位置（从 1 开始）"""
+        next_refresh = time.monotonic() + POSITION_REFRESH_SECONDS
+        while True:
+            with self._cond:
+                # 条件变量在每个任务结束时都会被通知，按固定间隔刷新
+                while not self._shutdown and time.monotonic() < next_refresh:
+                    self._cond.wait(next_refresh - time.monotonic())
+                if self._shutdown:
+                    return
+                next_refresh = time.monotonic() + POSITION_REFRESH_SECONDS
+                updates = []
+                for lane in self._positions_dirty:
+                    for position, task in enumerate(self._queues[lane].ordered(), 1):
+                        if not task.route.on_position or position == task.position:
+                            continue
+                        # 靠后的任务位置频繁变化，只在首次排队时通知
+                        if task.position is None or position <= POSITION_NOTIFY_LIMIT:
+                            updates.append((task.route.on_position, position))
+                        task.position = position
+                self._positions_dirty.clear()
+            for callback, position in updates:
+                try:
+                    callback(position)
+                except Exception as e:
+                    logger.debug(f"排队位置通知失败: {str(e)}")
@@ -10,6 +10,8 @@ import time
 import traceback
 import concurrent.futures
 import queue
+import json
+import requests
 
 from .common import (
     decode_mime_words,
@@ -32,11 +34,20 @@ from .logger import (
     log_progress,
     timing_decorator
 )
-from .outlook import OutlookMailHandler
+from .outlook import OutlookMailHandler, GRAPH_MAX_CONCURRENCY
+from . import http_session
+from .token_cache import token_cache, INVALID_GRANT
 from .imap import IMAPMailHandler
 from .gmail import GmailHandler
 from .qq import QQMailHandler
-from ._real_time_check import RealTimeChecker
+from ._real_time_check import RealTimeChecker, MIN_INTERVAL as REALTIME_MIN_INTERVAL, ACTIVE_PRIORITY as REALTIME_ACTIVE_PRIORITY
+from .graph_subscriptions import GraphSubscriptionManager
+from .token_refresher import TokenRefreshScheduler
+from .job_queue import SyncJobQueue, SyncJobWorker, JOB_INCREMENTAL, JOB_BACKFILL, JOB_ATTACHMENT
+from .cancellation import CancelToken, SyncCancelled, SYNC_DEADLINE_SECONDS
+from .check_jobs import CheckJobs
+from .lanes import LanePool, Route, route_for, lane_limits, host_limiter
+from .circuit_breaker import CircuitBreakers, classify_error, describe as describe_circuit, retry_time, AUTH, NETWORK
 
 class MailProcessor:
 
@@ -89,6 +100,17 @@ class MailProcessor:
                 except Exception as att_error:
                     logger.error(f"保存附件失败: {str(att_error)}")
 
+        def _store_remote_attachments(mail_id: int, attachments: List[Dict]):
+            # 仅记录附件元数据，内容在首次下载时再获取
+            for attachment in attachments or []:
+                db.add_attachment_metadata(
+                    mail_id=mail_id,
+                    filename=attachment.get("filename", ""),
+                    content_type=attachment.get("content_type", ""),
+                    size=attachment.get("size", 0),
+                    remote_ref=attachment.get("remote_ref"),
+                )
+
         for i, record in enumerate(mail_records):
             try:
                 progress = int((i + 1) / total * 100) if total else 100
@@ -102,6 +124,7 @@ class MailProcessor:
                 sender = record.get("sender", "(未知发件人)")
                 has_attachments = bool(record.get("has_attachments", False))
                 incoming_attachments = record.get("full_attachments", []) if has_attachments else []
+                remote_attachments = record.get("remote_attachments", []) if has_attachments else []
 
                 graph_message_id = (record.get("graph_message_id") or "").strip()
                 received_time = record.get("received_time", datetime.now())
@@ -141,11 +164,15 @@ class MailProcessor:
                         is_read=1 if record.get("is_read", True) else 0,
                         graph_message_id=graph_message_id,
                         has_attachments=1 if has_attachments else 0,
+                        imap_uid=record.get("imap_uid"),
+                        body_loaded=1 if record.get("body_loaded", True) else 0,
                     )
 
                     if success and mail_id:
                         if incoming_attachments:
                             _store_attachments(mail_id, incoming_attachments)
+                        if remote_attachments:
+                            _store_remote_attachments(mail_id, remote_attachments)
                         saved_count += 1
                     else:
                         logger.warning(f"保存邮件记录失败: {subject[:30]}...")
@@ -153,6 +180,8 @@ class MailProcessor:
                     # 已存在记录但无本地附件时，回填一次附件
                     try:
                         existing_id = existing["id"]
+                        if record.get("imap_uid") and not existing["imap_uid"]:
+                            db.set_mail_imap_uid(existing_id, record.get("imap_uid"))
                         if incoming_attachments:
                             existing_atts = db.get_attachments(existing_id) or []
                             if not existing_atts:
@@ -160,6 +189,8 @@ class MailProcessor:
                                     f"检测到历史邮件缺少附件，开始回填: mail_id={existing_id}, count={len(incoming_attachments)}"
                                 )
                                 _store_attachments(existing_id, incoming_attachments)
+                        elif remote_attachments and not (db.get_attachments(existing_id) or []):
+                            _store_remote_attachments(existing_id, remote_attachments)
                     except Exception as backfill_error:
                         logger.error(f"附件回填失败: {str(backfill_error)}")
 
@@ -171,6 +202,104 @@ class MailProcessor:
         logger.info(f"邮件保存完成: 共 {total} 封, 新增 {saved_count} 封")
         return saved_count
 
+    # 按附件ID加锁，同一附件并发下载时只从服务器获取一次；值为 [锁, 持有或等待的线程数]
+    _attachment_locks = {}
+    _attachment_locks_guard = threading.Lock()
+
+    @staticmethod
+    def materialize_attachment(db, attachment_id: int, email_info: Dict, cancel=None):
+        """
+        确保附件内容已保存到本地，未下载过的附件从邮件服务器获取并缓存；
+        cancel 停止或超时后 Graph 附件的流式下载在分块之间退出
+
+        Returns:
+            附件记录（含 file_path）
+        """
+        with MailProcessor._attachment_locks_guard:
+            entry = MailProcessor._attachment_locks.setdefault(attachment_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                attachment = db.get_attachment(attachment_id)
+                if not attachment or attachment['file_path'] or attachment['content'] is not None:
+                    return attachment
+                if not attachment['remote_ref']:
+                    return attachment
+
+                remote_ref = json.loads(attachment['remote_ref'])
+                provider = remote_ref.get('provider')
+                if provider == 'graph':
+                    logger.info(f"按需下载Graph附件: attachment_id={attachment_id}, message={remote_ref.get('message_id')}")
+                    MailProcessor._download_graph_attachment(db, attachment_id, email_info, remote_ref, cancel)
+                    return db.get_attachment(attachment_id)
+                if provider != 'imap':
+                    raise ValueError(f"不支持的附件来源: {provider}")
+
+                handler = {'gmail': GmailHandler, 'qq': QQMailHandler}.get(email_info.get('mail_type'))
+                if handler:
+                    email_info = dict(email_info, server=handler.SERVER, port=handler.PORT, use_ssl=handler.USE_SSL)
+
+                logger.info(f"按需下载附件: attachment_id={attachment_id}, uid={remote_ref.get('uid')}, section={remote_ref.get('section')}")
+                content = IMAPMailHandler.fetch_attachment(email_info, remote_ref)
+                if not db.store_attachment_content(attachment_id, content):
+                    raise IOError("保存附件内容失败")
+                return db.get_attachment(attachment_id)
+        finally:
+            # 最后一个使用者离开时才移除，避免后来者拿到新锁与等待中的线程重复下载
+            with MailProcessor._attachment_locks_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    MailProcessor._attachment_locks.pop(attachment_id, None)
+
+    @staticmethod
+    def load_mail_body(db, mail_record: Dict, email_info: Dict):
+        """
+        获取只保存了摘要的 Graph 邮件正文并写回数据库
+
+        Returns:
+            str: 邮件正文；无需加载时返回原内容
+        """
+        if mail_record.get('body_loaded', 1) or not mail_record.get('graph_message_id'):
+            return mail_record.get('content')
+        message_id = mail_record['graph_message_id']
+        stale_token = None
+        for _ in range(2):
+            access_token = token_cache.get_access_token(db, email_info, stale_token=stale_token)
+            if not access_token:
+                raise ValueError("获取访问令牌失败")
+            try:
+                bodies = OutlookMailHandler.fetch_message_bodies(access_token, [message_id])
+                break
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 401 or stale_token:
+                    raise
+                token_cache.invalidate(email_info['id'], access_token)
+                stale_token = access_token
+        if message_id not in bodies:
+            raise IOError("获取邮件正文失败")
+        db.update_mail_bodies(mail_record['email_id'], bodies)
+        return bodies[message_id]
+
+    @staticmethod
+    def _download_graph_attachment(db, attachment_id: int, email_info: Dict, remote_ref: Dict, cancel=None):
+        """把 Graph 附件直接流式写入附件目录，令牌被拒绝（401）时刷新后重试一次"""
+        stale_token = None
+        for _ in range(2):
+            access_token = token_cache.get_access_token(db, email_info, stale_token=stale_token)
+            if not access_token:
+                raise ValueError("获取访问令牌失败")
+            try:
+                db.store_attachment_stream(
+                    attachment_id,
+                    lambda fileobj: OutlookMailHandler.download_attachment(access_token, remote_ref, fileobj, cancel),
+                )
+                return
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 401 or stale_token:
+                    raise
+                token_cache.invalidate(email_info['id'], access_token)
+                stale_token = access_token
+
     @staticmethod
     def update_check_time(db, email_id: int) -> bool:
         try:
@@ -188,13 +317,33 @@ class EmailBatchProcessor:
         self.processing_emails = {}
         self.lock = threading.Lock()
         # 鍒涘缓涓や釜鐙珛鐨勭嚎绋嬫睜
-        self.manual_thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
-        self.realtime_thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # 每个线程池按服务商分通道，通用 IMAP 的服务器连接数限制在各线程池和 IMAP 连接间共享
+        limits = lane_limits(max_workers)
+        self.manual_thread_pool = LanePool('manual', limits, host_limiter)
+        self.realtime_thread_pool = LanePool('realtime', limits, host_limiter)
+        self.job_lanes = LanePool('sync-job', limits, host_limiter)
+        self.realtime_workers = self.job_lanes.workers
+        # 多个线程池可能同时访问 Graph，连接池按 Outlook 通道的总并发数配置
+        http_session.configure(max(self.manual_thread_pool.limit('outlook') + self.job_lanes.limit('outlook'), GRAPH_MAX_CONCURRENCY))
         self.real_time_running = False
         self.real_time_thread = None
 
+        # 持久化任务队列，实时检查、变更通知和全量拉取都通过队列执行
+        self.job_queue = SyncJobQueue(db)
+        self.job_worker = SyncJobWorker(self.job_queue, {
+            JOB_INCREMENTAL: self._run_sync_job,
+            JOB_BACKFILL: self._run_sync_job,
+            JOB_ATTACHMENT: self._run_attachment_job,
+        }, max_workers=self.job_lanes.workers, lanes=self.job_lanes, lane_of=self._job_lane)
+        # 邮箱和服务器的熔断状态，实时检查和任务队列据此跳过持续失败的邮箱
+        self.circuit_breakers = CircuitBreakers(db)
+        # 手动检查任务的进度和结果，供接口查询和 WebSocket 推送
+        self.check_jobs = CheckJobs()
+
         # 鍒涘缓瀹炴椂妫€鏌ュ櫒
         self.real_time_checker = RealTimeChecker(db, self)
+        self.graph_subscriptions = GraphSubscriptionManager(db, self)
+        self.token_refresher = TokenRefreshScheduler(db)
 
         # 閭绫诲瀷澶勭悊鍣ㄦ槧灏?
         self.handlers = {
@@ -208,17 +357,20 @@ class EmailBatchProcessor:
         self.stop_real_time_check()
         self.manual_thread_pool.shutdown(wait=True)
         self.realtime_thread_pool.shutdown(wait=True)
+        self.job_lanes.shutdown(wait=True)
 
     def is_email_being_processed(self, email_id: int) -> bool:
         with self.lock:
             return email_id in self.processing_emails
 
     def stop_processing(self, email_id: int) -> bool:
+        """请求停止正在同步的邮箱，拉取循环在下一封邮件或下一页之前退出"""
         with self.lock:
-            if email_id in self.processing_emails:
-                self.processing_emails[email_id] = False
-                return True
+            cancel = self.processing_emails.get(email_id)
+        if cancel is None:
             return False
+        cancel.cancel()
+        return True
 
     def parse_email_message(self, msg: Dict, folder: str = "INBOX") -> Dict:
         return MailProcessor.parse_email_message(msg, folder)
@@ -226,10 +378,33 @@ class EmailBatchProcessor:
     def update_check_time(self, db, email_id: int) -> bool:
         return MailProcessor.update_check_time(db, email_id)
 
+    def materialize_attachment(self, attachment_id: int, email_info: Dict):
+        return MailProcessor.materialize_attachment(self.db, attachment_id, email_info)
+
+    def load_mail_body(self, mail_record: Dict, email_info: Dict):
+        return MailProcessor.load_mail_body(self.db, mail_record, email_info)
+
     def save_mail_records(self, db, email_id: int, mail_records: List[Dict], progress_callback: Optional[Callable] = None) -> int:
         return MailProcessor.save_mail_records(db, email_id, mail_records, progress_callback)
 
-    def check_emails(self, email_ids: List[int], progress_callback: Optional[Callable] = None, is_realtime: bool = False) -> bool:
+    def start_check_job(self, user_id: int, email_ids: List[int], kind: str = 'single') -> Dict:
+        """创建手动检查任务并提交到线程池，立即返回任务快照"""
+        job = self.check_jobs.create(user_id, email_ids, kind)
+        if not self.check_emails(email_ids, job_id=job['id']):
+            for email_id in email_ids:
+                self.check_jobs.finish(job['id'], email_id, {'success': False, 'message': '邮箱不存在'})
+        return self.check_jobs.get(job['id']) or job
+
+    def _finish_job_email(self, job_id, email_id, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'success': False, 'message': str(e)}
+        self.check_jobs.finish(job_id, email_id, result)
+
+    def check_emails(self, email_ids: List[int], progress_callback: Optional[Callable] = None, is_realtime: bool = False,
+                     job_id: Optional[str] = None) -> bool:
+        """提交邮箱检查，job_id 不为空时进度和结果记录到对应的检查任务"""
         if not email_ids:
             logger.warning("娌℃湁鎻愪緵閭ID")
             return False
@@ -243,6 +418,8 @@ class EmailBatchProcessor:
         # 鍒涘缓杩涘害鍥炶皟
         def create_email_progress_callback(email_id):
             def callback(progress, message):
+                if job_id:
+                    self.check_jobs.progress(job_id, email_id, progress, message)
                 if progress_callback:
                     progress_callback(email_id, progress, message)
             return callback
@@ -255,6 +432,8 @@ class EmailBatchProcessor:
         for email_info in emails:
             if self.is_email_being_processed(email_info['id']):
                 logger.warning(f"閭 {email_info['email']} 姝ｅ湪澶勭悊涓紝璺宠繃")
+                if job_id:
+                    self.check_jobs.finish(job_id, email_info['id'], {'success': False, 'message': '邮箱正在处理中', 'skipped': True})
                 continue
 
             # 鑾峰彇瀵瑰簲鐨勫鐞嗗櫒
@@ -263,20 +442,38 @@ class EmailBatchProcessor:
 
             if not handler:
                 logger.error(f"涓嶆敮鎸佺殑閭绫诲瀷: {mail_type}")
+                if job_id:
+                    self.check_jobs.finish(job_id, email_info['id'], {'success': False, 'message': f'不支持的邮箱类型: {mail_type}'})
                 continue
 
             # 鏍囪涓烘鍦ㄥ鐞?
+            cancel = CancelToken()
             with self.lock:
-                self.processing_emails[email_info['id']] = True
+                self.processing_emails[email_info['id']] = cancel
 
             # 鎻愪氦浠诲姟鍒扮嚎绋嬫睜
-            future = thread_pool.submit(
+            callback = create_email_progress_callback(email_info['id'])
+            # 同一通道内按用户公平排队，排队期间推送当前位置
+            route = route_for(email_info, on_position=lambda position, callback=callback: callback(0, f"排队等待同步，当前第 {position} 位"))
+            future = thread_pool.submit_to(
+                route,
                 self._check_email_task,
                 email_info,
-                create_email_progress_callback(email_info['id'])
+                callback,
+                cancel,
+                # 用户手动检查不受熔断限制，成功后熔断随之恢复
+                not is_realtime
             )
+            if job_id:
+                future.add_done_callback(lambda f, email_id=email_info['id']: self._finish_job_email(job_id, email_id, f))
             futures.append(future)
 
+        if job_id:
+            found = {email_info['id'] for email_info in emails}
+            for email_id in email_ids:
+                if email_id not in found:
+                    self.check_jobs.finish(job_id, email_id, {'success': False, 'message': f'邮箱 ID:{email_id} 不存在'})
+
         # 鍚姩鐩戞帶绾跨▼锛屽鐞嗗畬鎴愮殑浠诲姟
         threading.Thread(target=self._monitor_futures, args=(futures,), daemon=True).start()
 
@@ -290,13 +487,62 @@ class EmailBatchProcessor:
             except Exception as e:
                 logger.error(f"浠诲姟鎵ц澶辫触: {str(e)}")
 
-    def _check_email_task(self, email_info, callback=None):
+    def _check_email_task(self, email_info, callback=None, cancel=None, force=False):
+        """
+        同步单个邮箱，stop_processing 或超过截止时间后尽快退出并释放线程
+
+        force 为 False 时邮箱或服务器熔断中直接返回，不连接服务器
+        """
         email_id = email_info['id']
+        if not force:
+            breaker = self.circuit_breakers.acquire(email_info)
+            if breaker:
+                message = describe_circuit(breaker)
+                logger.info(f"邮箱 {email_info['email']}(ID={email_id}) {message}")
+                if callback:
+                    callback(0, message)
+                return {
+                    'success': False,
+                    'message': message,
+                    'retry': False,
+                    'circuit': {'key': breaker['key'], 'failure_class': breaker['failure_class'], 'retry_at': retry_time(breaker)},
+                }
+        cancel = cancel or CancelToken()
+        cancel.set_deadline(SYNC_DEADLINE_SECONDS)
+        with self.lock:
+            self.processing_emails[email_id] = cancel
         try:
-            # 鏍囪涓烘鍦ㄥ鐞?
-            with self.lock:
-                self.processing_emails[email_id] = True
+            # 排队期间已被停止
+            cancel.check()
+            result = self._check_email(email_info, callback, cancel)
+            if result.get('success') or not cancel.cancelled:
+                self.circuit_breakers.record(email_info, result.get('error_class'), result.get('message'),
+                                             success=bool(result.get('success')))
+                return result
+        except SyncCancelled:
+            pass
+        finally:
+            # 标记处理完成并释放资源
+            try:
+                with self.lock:
+                    if self.processing_emails.get(email_id) is cancel:
+                        del self.processing_emails[email_id]
+                        logger.info(f"邮箱 ID {email_id} 处理完成，已从处理队列中移除")
+            except Exception as e:
+                logger.error(f"释放邮箱处理资源失败: {str(e)}")
 
+        message = str(SyncCancelled(cancel.reason))
+        logger.warning(f"邮箱 {email_info['email']}(ID={email_id}) {message}")
+        if callback:
+            callback(0, message)
+        # 超时按网络失败计入熔断，手动停止只释放探测名额
+        self.circuit_breakers.record(email_info, NETWORK if cancel.timed_out else None, message)
+        # 超时的同步可以重试，已保存的进度不会丢失；手动停止的不再重试
+        return {'success': False, 'message': message, 'cancelled': True, 'retry': cancel.timed_out}
+
+    def _check_email(self, email_info, callback, cancel):
+        email_id = email_info['id']
+        try:
             # 鑾峰彇涓婃妫€鏌ユ椂闂达紝鐢ㄤ簬浠呰幏鍙栨柊閭欢
             last_check_time = email_info.get('last_check_time')
 
@@ -318,15 +564,17 @@ class EmailBatchProcessor:
 
                 # 鑾峰彇鏂扮殑璁块棶浠ょ墝
                 try:
-                    access_token = OutlookMailHandler.get_new_access_token(refresh_token, client_id)
+                    access_token = token_cache.get_access_token(self.db, email_info)
                     if not access_token:
                         error_msg = "鑾峰彇璁块棶浠ょ墝澶辫触"
                         if callback:
                             callback(0, error_msg)
-                        return {'success': False, 'message': error_msg}
+                        # 刷新令牌已失效时按认证失败熔断，其他情况多为网络问题
+                        current = self.db.get_email_by_id(email_id) or {}
+                        error_class = AUTH if current.get('token_status') == INVALID_GRANT else NETWORK
+                        return {'success': False, 'message': error_msg, 'error_class': error_class}
 
                     # 鏇存柊閭鐨勮闂护鐗?
-                    self.db.update_email_token(email_id, access_token)
                     email_info['access_token'] = access_token
 
                     # 璁板綍寮€濮嬪鐞?
@@ -334,12 +582,16 @@ class EmailBatchProcessor:
 
                     # 浣跨敤 Microsoft Graph 鎷夊彇閭欢
                     try:
-                        mail_records = OutlookMailHandler.fetch_emails_graph(
-                            email_info['email'],
-                            access_token,
-                            callback=callback,
-                            last_check_time=last_check_time
-                        )
+                        try:
+                            sync_result = OutlookMailHandler.sync_mail_graph(email_info, self.db, access_token, callback, cancel)
+                        except Exception as e:
+                            if getattr(getattr(e, 'response', None), 'status_code', None) != 401:
+                                raise
+                            # 缓存的令牌被服务端拒绝（如已吊销），刷新后重试一次
+                            access_token = token_cache.get_access_token(self.db, email_info, stale_token=access_token)
+                            if not access_token:
+                                raise
+                            sync_result = OutlookMailHandler.sync_mail_graph(email_info, self.db, access_token, callback, cancel)
                     except Exception as e:
                         error_msg = f"Graph 鎷夊彇澶辫触: {str(e)}"
                         if hasattr(e, "response") and e.response is not None:
@@ -348,30 +600,31 @@ class EmailBatchProcessor:
                         log_email_error(email_info['email'], email_id, error_msg)
                         if callback:
                             callback(0, error_msg)
-                        return {'success': False, 'message': error_msg}
+                        return {'success': False, 'message': error_msg, 'error_class': classify_error(e)}
 
-                    if not mail_records:
+                    total_count = sync_result['total']
+                    if not total_count:
                         if callback:
                             callback(100, "没有找到新邮件")
 
                         # 娌℃湁鎵惧埌鏂伴偖浠朵篃绠楁垚鍔燂紝鏇存柊妫€鏌ユ椂闂?
                         self.update_check_time(self.db, email_id)
 
-                        return {'success': True, 'message': '没有找到新邮件'}
+                        return {'success': True, 'message': '没有找到新邮件', 'saved': 0, 'synced': sync_result['synced']}
 
-                    # 淇濆瓨閭欢璁板綍锛屼紶閫掗偖浠堕敭鍒楄〃鐢ㄤ簬楂樻晥鍘婚噸
-                    mail_keys = [record.get('mail_key', '') for record in mail_records if 'mail_key' in record]
-                    saved_count = self.save_mail_records(self.db, email_id, mail_records, callback)
+                    saved_count = sync_result['saved']
 
                     # 鏇存柊鏈€鍚庢鏌ユ椂闂?
                     self.update_check_time(self.db, email_id)
 
                     # 璁板綍瀹屾垚
-                    log_email_complete(email_info['email'], email_id, len(mail_records), len(mail_records), saved_count)
+                    log_email_complete(email_info['email'], email_id, total_count, total_count, saved_count)
 
                     return {
                         'success': True,
-                        'message': f'成功获取{len(mail_records)}封邮件，新增{saved_count}封'
+                        'message': f'成功获取{total_count}封邮件，新增{saved_count}封',
+                        'saved': saved_count,
+                        'synced': sync_result['synced']
                     }
 
                 except Exception as e:
@@ -379,11 +632,11 @@ class EmailBatchProcessor:
                     log_email_error(email_info['email'], email_id, error_msg)
                     if callback:
                         callback(0, error_msg)
-                    return {'success': False, 'message': error_msg}
+                    return {'success': False, 'message': error_msg, 'error_class': classify_error(e)}
 
             elif mail_type == 'gmail':
                 # 澶勭悊Gmail閭
-                result = GmailHandler.check_mail(email_info, self.db, callback)
+                result = GmailHandler.check_mail(email_info, self.db, callback, cancel)
                 # 鍙湁鍦ㄦ垚鍔熸椂鏇存柊妫€鏌ユ椂闂?
                 if result.get('success', False):
                     self.update_check_time(self.db, email_id)
@@ -391,7 +644,7 @@ class EmailBatchProcessor:
 
             elif mail_type == 'qq':
                 # 澶勭悊QQ閭
-                result = QQMailHandler.check_mail(email_info, self.db, callback)
+                result = QQMailHandler.check_mail(email_info, self.db, callback, cancel)
                 # 鍙湁鍦ㄦ垚鍔熸椂鏇存柊妫€鏌ユ椂闂?
                 if result.get('success', False):
                     self.update_check_time(self.db, email_id)
@@ -403,46 +656,27 @@ class EmailBatchProcessor:
                     # 璁板綍寮€濮嬪鐞?
                     log_email_start(email_info['email'], email_id)
 
-                    # 鑾峰彇閭欢锛屽鍔爈ast_check_time鍙傛暟
-                    mail_records = IMAPMailHandler.fetch_emails(
-                        email_info['email'],
-                        email_info['password'],
-                        server=email_info.get('server'),
-                        port=email_info.get('port'),
-                        use_ssl=email_info.get('use_ssl', True),
-                        callback=callback,
-                        last_check_time=last_check_time
-                    )
-
-                    if not mail_records:
-                        if callback:
-                            callback(100, "没有找到新邮件")
-
-                        # 娌℃湁鎵惧埌鏂伴偖浠朵篃绠楁垚鍔燂紝鏇存柊妫€鏌ユ椂闂?
-                        self.update_check_time(self.db, email_id)
-
-                        return {'success': True, 'message': '没有找到新邮件'}
-
-                    # 淇濆瓨閭欢璁板綍
-                    saved_count = self.save_mail_records(self.db, email_id, mail_records, callback)
+                    # 按账号配置的文件夹集合并行增量同步，并保存各文件夹状态
+                    result = IMAPMailHandler.check_mail(email_info, self.db, callback, cancel)
+                    if not result.get('success', False):
+                        log_email_error(email_info['email'], email_id, result.get('message'))
+                        return result
 
                     # 鏇存柊鏈€鍚庢鏌ユ椂闂?
                     self.update_check_time(self.db, email_id)
 
                     # 璁板綍瀹屾垚
-                    log_email_complete(email_info['email'], email_id, len(mail_records), len(mail_records), saved_count)
+                    total = result.get('total', 0)
+                    log_email_complete(email_info['email'], email_id, total, total, result.get('saved', 0))
 
-                    return {
-                        'success': True,
-                        'message': f'成功获取 {len(mail_records)} 封邮件，新增 {saved_count} 封'
-                    }
+                    return result
 
                 except Exception as e:
                     error_msg = f"澶勭悊IMAP閭澶辫触: {str(e)}"
                     log_email_error(email_info['email'], email_id, error_msg)
                     if callback:
                         callback(0, error_msg)
-                    return {'success': False, 'message': error_msg}
+                    return {'success': False, 'message': error_msg, 'error_class': classify_error(e)}
 
         except Exception as e:
             error_msg = f"澶勭悊閭澶辫触: {str(e)}"
@@ -451,22 +685,85 @@ class EmailBatchProcessor:
                 callback(0, error_msg)
             return {'success': False, 'message': error_msg}
 
-        finally:
-            # 标记处理完成并释放资源
-            try:
-                with self.lock:
-                    if email_id in self.processing_emails:
-                        del self.processing_emails[email_id]
-                        logger.info(f"邮箱 ID {email_id} 处理完成，已从处理队列中移除")
-            except Exception as e:
-                logger.error(f"释放邮箱处理资源失败: {str(e)}")
+    def enqueue_job(self, email_id, job_type, payload=None, dedup_key='', priority=0, delay=0, max_attempts=None):
+        """添加持久化同步任务并唤醒工作线程，返回任务ID"""
+        job_id = self.job_queue.enqueue(email_id, job_type, payload=payload, dedup_key=dedup_key,
+                                        priority=priority, delay=delay, max_attempts=max_attempts)
+        self.job_worker.notify()
+        return job_id
+
+    def _job_lane(self, job):
+        email_info = self.db.get_email_by_id(job['email_id'])
+        # 邮箱已删除的任务很快以失败结束，放在任一通道均可
+        if not email_info:
+            return Route('imap')
+        route = route_for(email_info)
+        if job['job_type'] == JOB_ATTACHMENT:
+            # 附件下载在 fetch_attachment 中自行占用服务器连接名额
+            return route._replace(host=None)
+        return route
+
+    def _run_sync_job(self, job):
+        email_id = job['email_id']
+        email_info = self.db.get_email_by_id(email_id)
+        if not email_info:
+            return {'success': False, 'message': f'邮箱 ID:{email_id} 不存在', 'retry': False}
+        if self.is_email_being_processed(email_id):
+            return {'deferred': True, 'delay': 30}
+        if job['job_type'] == JOB_BACKFILL:
+            self.db.reset_check_time(email_id)
+            email_info['last_check_time'] = None
+
+        def progress_callback(progress, message):
+            logger.debug(f"同步任务 {job['id']} 邮箱 ID:{email_id} {progress}% {message}")
+
+        result = self._check_email_task(email_info, progress_callback)
+        if result.get('circuit') and job['job_type'] != JOB_INCREMENTAL:
+            # 全量拉取等到熔断恢复后再执行，不消耗重试次数
+            return {'deferred': True, 'delay': max(30, result['circuit']['retry_at'] - time.time())}
+        return result
+
+    def _run_attachment_job(self, job):
+        email_info = self.db.get_email_by_id(job['email_id'])
+        attachment_id = job['payload'].get('attachment_id')
+        if not email_info or not attachment_id:
+            return {'success': False, 'message': '邮箱或附件不存在', 'retry': False}
+        cancel = CancelToken(SYNC_DEADLINE_SECONDS)
+        attachment = MailProcessor.materialize_attachment(self.db, attachment_id, email_info, cancel)
+        if not attachment:
+            return {'success': False, 'message': f'附件 ID:{attachment_id} 不存在', 'retry': False}
+        return {'success': True}
 
     def start_real_time_check(self, check_interval=60):
+        self.job_worker.start()
         return self.real_time_checker.start(check_interval)
 
     def stop_real_time_check(self):
         return self.real_time_checker.stop()
 
+    def set_shard(self, shard):
+        """独立同步进程只处理该分片的邮箱"""
+        self.real_time_checker.shard = shard
+        self.job_worker.shard = shard
+        self.token_refresher.shard = shard
+
+    def mark_active(self, email_id):
+        """用户正在查看该邮箱，实时检查提前并加密轮询"""
+        if self.real_time_checker.running:
+            return self.real_time_checker.mark_active(email_id)
+        # 实时检查运行在独立同步进程中时，通过任务队列通知
+        email_info = self.db.get_email_by_id(email_id)
+        if not email_info or not email_info.get('enable_realtime_check'):
+            return False
+        last_check = normalize_check_time(email_info.get('last_check_time'))
+        # last_check_time 由 CURRENT_TIMESTAMP 写入，为 UTC 时间
+        if last_check and (datetime.utcnow() - last_check.replace(tzinfo=None)).total_seconds() < REALTIME_MIN_INTERVAL:
+            return False
+        return self.enqueue_job(email_id, JOB_INCREMENTAL, priority=REALTIME_ACTIVE_PRIORITY, max_attempts=1) is not None
+
+    def add_to_real_time_queue(self, email_id):
+        return self.mark_active(email_id)
+
     # 灏嗘棫鐨刜real_time_check_loop鏂规硶淇濈暀浣嗘爣璁颁负宸插純鐢?
     def _real_time_check_loop(self, check_interval):
         logger.warning("浣跨敤宸插純鐢ㄧ殑_real_time_check_loop鏂规硶锛屽缓璁娇鐢≧ealTimeChecker")
@@ -4,10 +4,14 @@ Outlook閭欢澶勭悊妯″潡
 
 import imaplib
 import email
+import os
 import requests
+import threading
 import time
 import datetime
 import base64
+import concurrent.futures
+import queue
 from urllib.parse import quote
 from datetime import timezone
 
@@ -17,6 +21,26 @@ from .common import (
     format_date_for_imap_search,
 )
 from .logger import logger
+from . import http_session
+from . import cancellation
+from .cancellation import SyncCancelled
+from .graph_throttle import governor as graph_governor
+
+# 单个邮箱同步时并发的 Graph 请求数（文件夹 delta、附件下载）
+GRAPH_ACCOUNT_CONCURRENCY = max(1, int(os.environ.get('GRAPH_ACCOUNT_CONCURRENCY', '4')))
+# 进程内同时进行的 Graph 请求总数上限，各邮箱的并发共享这一额度
+GRAPH_MAX_CONCURRENCY = max(1, int(os.environ.get('GRAPH_MAX_CONCURRENCY', '16')))
+_graph_slots = threading.BoundedSemaphore(GRAPH_MAX_CONCURRENCY)
+# 网络拉取与入库之间最多缓存的页数，限制首次同步大邮箱时的内存占用
+GRAPH_INGEST_QUEUE_SIZE = max(1, int(os.environ.get('GRAPH_INGEST_QUEUE_SIZE', '4')))
+# 每个邮箱解析出的同步文件夹列表的缓存时间（秒）
+GRAPH_FOLDER_CACHE_TTL = int(os.environ.get('GRAPH_FOLDER_CACHE_TTL', '3600'))
+# 文件夹邮件数和未读数都未变化时跳过 delta 查询，但超过该秒数仍强制查询一次
+GRAPH_FOLDER_RECHECK_SECONDS = int(os.environ.get('GRAPH_FOLDER_RECHECK_SECONDS', '1800'))
+# 同步时的正文模式：full 同步完整正文；preview 只同步 bodyPreview 摘要，打开邮件时再获取正文
+GRAPH_BODY_MODE = os.environ.get('GRAPH_BODY_MODE', 'full').strip().lower()
+_folder_catalog = {}
+_folder_catalog_lock = threading.Lock()
 
 class OutlookMailHandler:
     """Outlook閭澶勭悊鍣?"""
@@ -39,6 +63,14 @@ class OutlookMailHandler:
 
     GRAPH_BASE_URL = 'https://graph.microsoft.com/v1.0'
     GRAPH_RETRY_STATUS = {429, 502, 503, 504}
+    GRAPH_THROTTLE_STATUS = {429, 503}
+    GRAPH_FILE_ATTACHMENT = "#microsoft.graph.fileAttachment"
+    GRAPH_ATTACHMENT_SELECT = "id,name,contentType,size,isInline"
+    GRAPH_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    GRAPH_MESSAGE_SELECT = "id,subject,from,toRecipients,receivedDateTime,body,hasAttachments,isRead"
+    GRAPH_MESSAGE_PREVIEW_SELECT = "id,subject,from,toRecipients,receivedDateTime,bodyPreview,hasAttachments,isRead"
+    GRAPH_DELTA_PAGE_SIZE = 50
+    GRAPH_BATCH_SIZE = 20
 
     @staticmethod
     def _graph_path_id(value):
@@ -188,8 +220,14 @@ class OutlookMailHandler:
             self.mail = None
 
     @staticmethod
-    def get_new_access_token(refresh_token, client_id):
-        """鍒锋柊骞惰繑鍥炴柊鐨勮闂护鐗?"""
+    def refresh_access_token(refresh_token, client_id):
+        """
+        使用 refresh_token 换取访问令牌
+
+        Returns:
+            dict: {'access_token', 'expires_in', 'refresh_token'}；
+                  授权服务器拒绝时返回 {'error', 'error_description'}，网络等异常返回 None
+        """
         url = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
         data = {
             'client_id': client_id,
@@ -197,19 +235,29 @@ class OutlookMailHandler:
             'refresh_token': refresh_token,
         }
         try:
-            response = requests.post(url, data=data)
-            result_status = response.json().get('error')
+            response = http_session.post(url, data=data, timeout=30)
+            payload = response.json()
+            result_status = payload.get('error')
             if result_status is not None:
-                logger.error(f"鑾峰彇璁块棶浠ょ墝澶辫触: {result_status}")
-                return None
-            else:
-                new_access_token = response.json()['access_token']
-                logger.info("鎴愬姛鍒锋柊璁块棶浠ょ墝")
-                return new_access_token
+                logger.error(f"获取访问令牌失败: {result_status}")
+                return {'error': result_status, 'error_description': payload.get('error_description')}
+            logger.info("成功刷新访问令牌")
+            graph_governor.register_token(payload['access_token'], client_id)
+            return {
+                'access_token': payload['access_token'],
+                'expires_in': int(payload.get('expires_in') or 3600),
+                'refresh_token': payload.get('refresh_token'),
+            }
         except Exception as e:
-            logger.error(f"鍒锋柊璁块棶浠ょ墝寮傚父: {str(e)}")
+            logger.error(f"刷新访问令牌异常: {str(e)}")
             return None
 
+    @staticmethod
+    def get_new_access_token(refresh_token, client_id):
+        """刷新并返回新的访问令牌（不经过缓存）"""
+        result = OutlookMailHandler.refresh_access_token(refresh_token, client_id)
+        return result.get('access_token') if result else None
+
     @staticmethod
     def generate_auth_string(user, token):
         """鐢熸垚OAuth2璁よ瘉瀛楃涓?"""
@@ -349,28 +397,32 @@ class OutlookMailHandler:
         return mail_records
 
     @staticmethod
-    def _graph_request(token, url, params=None):
+    def _graph_request(token, url, params=None, headers=None, cancel=None):
         backoff = 1
+        request_headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/json",
+        }
+        if headers:
+            request_headers.update(headers)
         for _ in range(5):
-            resp = requests.get(
-                url,
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Accept": "application/json",
-                },
-                params=params,
-                timeout=30,
-            )
+            cancellation.check(cancel)
+            graph_governor.acquire(token, cancel)
+            with _graph_slots:
+                resp = http_session.get(
+                    url,
+                    headers=request_headers,
+                    params=params,
+                    timeout=cancellation.timeout(cancel, 30),
+                )
+            graph_governor.record(token, resp.status_code, resp.headers.get("Retry-After"))
             if resp.status_code < 400:
                 return resp.json()
             if resp.status_code in OutlookMailHandler.GRAPH_RETRY_STATUS:
-                retry_after = resp.headers.get("Retry-After")
-                if retry_after:
-                    sleep_seconds = int(retry_after)
-                else:
-                    sleep_seconds = min(backoff, 30)
+                # 429/503 由全局限流器暂停后再发，其余暂时性错误本地退避
+                if resp.status_code not in OutlookMailHandler.GRAPH_THROTTLE_STATUS:
+                    cancellation.sleep(cancel, min(backoff, 30))
                     backoff *= 2
-                time.sleep(sleep_seconds)
                 continue
             if resp.status_code >= 400:
                 try:
@@ -381,9 +433,10 @@ class OutlookMailHandler:
         resp.raise_for_status()
 
     @staticmethod
-    def _graph_request_json(method, token, url, payload=None):
+    def _graph_request_json(method, token, url, payload=None, cancel=None):
         backoff = 1
         for _ in range(5):
+            cancellation.check(cancel)
             headers = {
                 "Authorization": f"Bearer {token}",
                 "Accept": "application/json",
@@ -392,22 +445,21 @@ class OutlookMailHandler:
                 "method": method,
                 "url": url,
                 "headers": headers,
-                "timeout": 30,
+                "timeout": cancellation.timeout(cancel, 30),
             }
             if payload is not None:
                 headers["Content-Type"] = "application/json"
                 request_kwargs["json"] = payload
-            resp = requests.request(**request_kwargs)
+            graph_governor.acquire(token, cancel)
+            with _graph_slots:
+                resp = http_session.request(**request_kwargs)
+            graph_governor.record(token, resp.status_code, resp.headers.get("Retry-After"))
             if resp.status_code < 400:
                 return resp.json() if resp.content else {}
             if resp.status_code in OutlookMailHandler.GRAPH_RETRY_STATUS:
-                retry_after = resp.headers.get("Retry-After")
-                if retry_after:
-                    sleep_seconds = int(retry_after)
-                else:
-                    sleep_seconds = min(backoff, 30)
+                if resp.status_code not in OutlookMailHandler.GRAPH_THROTTLE_STATUS:
+                    cancellation.sleep(cancel, min(backoff, 30))
                     backoff *= 2
-                time.sleep(sleep_seconds)
                 continue
             if resp.status_code >= 400:
                 try:
@@ -418,57 +470,66 @@ class OutlookMailHandler:
         resp.raise_for_status()
 
     @staticmethod
-    def _graph_list_folders(token):
+    def _graph_list_folders(token, cancel=None):
         url = f"{OutlookMailHandler.GRAPH_BASE_URL}/me/mailFolders"
         # Some Microsoft tenants reject selecting wellKnownName on this endpoint.
         # Keep the query minimal for compatibility.
         params = {"$top": 200}
-        payload = OutlookMailHandler._graph_request(token, url, params=params)
+        payload = OutlookMailHandler._graph_request(token, url, params=params, cancel=cancel)
         return payload.get("value", [])
 
     @staticmethod
-    def _graph_list_messages(token, folder_id, since_iso):
-        encoded_folder_id = OutlookMailHandler._graph_path_id(folder_id)
-        url = f"{OutlookMailHandler.GRAPH_BASE_URL}/me/mailFolders/{encoded_folder_id}/messages"
-        params = {
-            "$top": 50,
-            "$orderby": "receivedDateTime desc",
-            "$select": "id,subject,from,toRecipients,receivedDateTime,body,hasAttachments,isRead",
-        }
-        if since_iso:
-            params["$filter"] = f"receivedDateTime ge {since_iso}"
-
-        items = []
-        payload = OutlookMailHandler._graph_request(token, url, params=params)
-        items.extend(payload.get("value", []))
-        next_link = payload.get("@odata.nextLink")
-        while next_link:
-            payload = OutlookMailHandler._graph_request(token, next_link, params=None)
-            items.extend(payload.get("value", []))
-            next_link = payload.get("@odata.nextLink")
-        return items
+    def _graph_delta_pages(token, folder_id, start_link=None, since_iso=None, cancel=None):
+        """
+        逐页读取文件夹的 delta 结果
 
-    @staticmethod
-    def _graph_list_attachments(token, message_id):
-        encoded_message_id = OutlookMailHandler._graph_path_id(message_id)
-        url = f"{OutlookMailHandler.GRAPH_BASE_URL}/me/messages/{encoded_message_id}/attachments"
-        params = {"$top": 50}
-        items = []
-        payload = OutlookMailHandler._graph_request(token, url, params=params)
-        items.extend(payload.get("value", []))
-        next_link = payload.get("@odata.nextLink")
-        while next_link:
-            payload = OutlookMailHandler._graph_request(token, next_link, params=None)
-            items.extend(payload.get("value", []))
+        start_link 可以是上次保存的 deltaLink，也可以是中断时保存的 nextLink；为空时从头开始。
+
+        Yields:
+            tuple: (本页邮件, nextLink, deltaLink)，最后一页 nextLink 为 None
+        """
+        headers = {"Prefer": f"odata.maxpagesize={OutlookMailHandler.GRAPH_DELTA_PAGE_SIZE}"}
+        if start_link:
+            url, params = start_link, None
+        else:
+            encoded_folder_id = OutlookMailHandler._graph_path_id(folder_id)
+            url = f"{OutlookMailHandler.GRAPH_BASE_URL}/me/mailFolders/{encoded_folder_id}/messages/delta"
+            select = OutlookMailHandler.GRAPH_MESSAGE_PREVIEW_SELECT if GRAPH_BODY_MODE == "preview" else OutlookMailHandler.GRAPH_MESSAGE_SELECT
+            params = {"$select": select}
+            # delta 查询只支持按 receivedDateTime 过滤，且不支持 $orderby/$top
+            if since_iso:
+                params["$filter"] = f"receivedDateTime ge {since_iso}"
+
+        while url:
+            payload = OutlookMailHandler._graph_request(token, url, params=params, headers=headers, cancel=cancel)
             next_link = payload.get("@odata.nextLink")
-        return items
+            yield payload.get("value", []), next_link, payload.get("@odata.deltaLink")
+            url, params = next_link, None
 
     @staticmethod
-    def _graph_get_attachment(token, message_id, attachment_id):
-        encoded_message_id = OutlookMailHandler._graph_path_id(message_id)
-        encoded_attachment_id = OutlookMailHandler._graph_path_id(attachment_id)
-        url = f"{OutlookMailHandler.GRAPH_BASE_URL}/me/messages/{encoded_message_id}/attachments/{encoded_attachment_id}"
-        return OutlookMailHandler._graph_request(token, url, params=None)
+    def _iter_folder_pages(token, folder_id, folder_name, state, since_iso, cancel=None):
+        """
+        按 nextLink（中断续传）→ deltaLink（增量）→ 从头同步的顺序读取文件夹
+
+        保存的链接失效（410，或续传链接返回 400）时退回下一种方式。
+        """
+        state = state or {}
+        candidates = [link for link in (state.get("next_link"), state.get("delta_link")) if link]
+        candidates.append(None)
+        for start_link in candidates:
+            pages = OutlookMailHandler._graph_delta_pages(token, folder_id, start_link, since_iso, cancel)
+            try:
+                first = next(pages, None)
+            except requests.exceptions.HTTPError as err:
+                status = getattr(err.response, "status_code", None)
+                if start_link and status in (400, 410):
+                    logger.info(f"Graph文件夹 {folder_name} 保存的同步链接已失效(HTTP {status})，改用下一种方式同步")
+                    continue
+                raise
+            if first is not None:
+                yield first
+                yield from pages
+            return
 
     @staticmethod
     def get_profile_email(access_token):
@@ -549,10 +610,118 @@ class OutlookMailHandler:
         return True
 
     @staticmethod
-    def delete_messages_batch(access_token, message_ids):
-        """Use Microsoft Graph $batch to delete multiple messages.
-        Returns dict: {deleted: [message_id], failed: [{message_id, status, body}]}
+    def create_subscription(access_token, resource, notification_url, client_state, expiration):
+        """
+        创建 Graph 变更通知订阅
+
+        Args:
+            resource: 订阅的资源，如 me/mailFolders('Inbox')/messages
+            expiration: 过期时间（UTC datetime）
+        """
+        url = f"{OutlookMailHandler.GRAPH_BASE_URL}/subscriptions"
+        payload = {
+            "changeType": "created,updated,deleted",
+            "notificationUrl": notification_url,
+            "lifecycleNotificationUrl": notification_url,
+            "resource": resource,
+            "expirationDateTime": expiration.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "clientState": client_state,
+        }
+        return OutlookMailHandler._graph_request_json("POST", access_token, url, payload=payload)
+
+    @staticmethod
+    def renew_subscription(access_token, subscription_id, expiration):
+        """延长订阅的过期时间"""
+        url = f"{OutlookMailHandler.GRAPH_BASE_URL}/subscriptions/{OutlookMailHandler._graph_path_id(subscription_id)}"
+        payload = {"expirationDateTime": expiration.strftime("%Y-%m-%dT%H:%M:%SZ")}
+        return OutlookMailHandler._graph_request_json("PATCH", access_token, url, payload=payload)
+
+    @staticmethod
+    def delete_subscription(access_token, subscription_id):
+        url = f"{OutlookMailHandler.GRAPH_BASE_URL}/subscriptions/{OutlookMailHandler._graph_path_id(subscription_id)}"
+        OutlookMailHandler._graph_request_json("DELETE", access_token, url, payload=None)
+        return True
+
+    @staticmethod
+    def _retry_after_seconds(headers, default):
+        for key, value in (headers or {}).items():
+            if str(key).lower() == "retry-after":
+                try:
+                    return max(0, int(value))
+                except (TypeError, ValueError):
+                    break
+        return default
+
+    @staticmethod
+    def _graph_batch(token, batch_requests, max_retries=3, cancel=None):
+        """
+        通过 $batch 执行多个 Graph 请求，每批最多 20 个
+
+        被限流或暂时失败（429/502/503/504）的子请求单独重试，其他子请求的结果直接保留；
+        子请求的 429/503 同样计入全局限流器，由下一次 $batch 请求等待暂停结束。
+
+        Args:
+            batch_requests: [{'method', 'url'（相对 /v1.0 的路径）, 'body'（可选）, 'headers'（可选）}]
+
+        Returns:
+            list: 与 batch_requests 顺序一致的 {'status', 'body', 'headers'}，重试耗尽仍未成功的 status 为最后一次的状态
         """
+        batch_url = f"{OutlookMailHandler.GRAPH_BASE_URL}/$batch"
+        results = [None] * len(batch_requests)
+        pending = list(range(len(batch_requests)))
+        backoff = 1
+        for attempt in range(max_retries + 1):
+            retry = []
+            wait = 0
+            for start in range(0, len(pending), OutlookMailHandler.GRAPH_BATCH_SIZE):
+                chunk = pending[start:start + OutlookMailHandler.GRAPH_BATCH_SIZE]
+                sub_requests = []
+                for index in chunk:
+                    item = batch_requests[index]
+                    sub = {"id": str(index), "method": item.get("method", "GET"), "url": item["url"]}
+                    headers = dict(item.get("headers") or {})
+                    if item.get("body") is not None:
+                        sub["body"] = item["body"]
+                        headers.setdefault("Content-Type", "application/json")
+                    if headers:
+                        sub["headers"] = headers
+                    sub_requests.append(sub)
+
+                response = OutlookMailHandler._graph_request_json("POST", token, batch_url, payload={"requests": sub_requests}, cancel=cancel)
+                answered = set()
+                for sub in response.get("responses", []):
+                    try:
+                        index = int(sub.get("id"))
+                    except (TypeError, ValueError):
+                        continue
+                    answered.add(index)
+                    status = int(sub.get("status") or 0)
+                    result = {"status": status, "body": sub.get("body"), "headers": sub.get("headers") or {}}
+                    results[index] = result
+                    if status in OutlookMailHandler.GRAPH_THROTTLE_STATUS:
+                        retry.append(index)
+                        graph_governor.record(token, status, OutlookMailHandler._retry_after_seconds(result["headers"], None))
+                    elif status in OutlookMailHandler.GRAPH_RETRY_STATUS:
+                        retry.append(index)
+                        wait = max(wait, backoff)
+                # 没有返回结果的子请求同样重试
+                for index in chunk:
+                    if index not in answered:
+                        retry.append(index)
+                        wait = max(wait, backoff)
+
+            if not retry or attempt == max_retries:
+                break
+            logger.info(f"Graph $batch 有 {len(retry)} 个子请求需要重试")
+            if wait:
+                cancellation.sleep(cancel, min(wait, 30))
+            backoff = min(backoff * 2, 30)
+            pending = sorted(retry)
+
+        return [result or {"status": 0, "body": None, "headers": {}} for result in results]
+
+    @staticmethod
+    def _normalize_message_ids(message_ids):
         normalized = []
         seen = set()
         for mid in message_ids or []:
@@ -560,49 +729,60 @@ class OutlookMailHandler:
             if value and value not in seen:
                 seen.add(value)
                 normalized.append(value)
+        return normalized
 
+    @staticmethod
+    def delete_messages_batch(access_token, message_ids):
+        """Use Microsoft Graph $batch to delete multiple messages.
+        Returns dict: {deleted: [message_id], failed: [{message_id, status, body}]}
+        """
+        normalized = OutlookMailHandler._normalize_message_ids(message_ids)
         if not normalized:
             return {"deleted": [], "failed": []}
 
-        batch_url = f"{OutlookMailHandler.GRAPH_BASE_URL}/$batch"
+        results = OutlookMailHandler._graph_batch(access_token, [
+            {"method": "DELETE", "url": f"/me/messages/{OutlookMailHandler._graph_path_id(mid)}"}
+            for mid in normalized
+        ])
         deleted = []
         failed = []
+        for mid, item in zip(normalized, results):
+            status = item["status"]
+            # 404 means already deleted remotely, treat as success for idempotency.
+            if 200 <= status < 300 or status == 404:
+                deleted.append(mid)
+            else:
+                failed.append({"message_id": mid, "status": status, "body": item.get("body")})
+        return {"deleted": deleted, "failed": failed}
 
-        # Graph $batch usually limits to 20 requests per batch.
-        chunk_size = 20
-        for i in range(0, len(normalized), chunk_size):
-            chunk = normalized[i:i + chunk_size]
-            requests_payload = []
-            reqid_to_mid = {}
-            for idx, mid in enumerate(chunk):
-                req_id = str(idx + 1)
-                reqid_to_mid[req_id] = mid
-                encoded_mid = OutlookMailHandler._graph_path_id(mid)
-                requests_payload.append({
-                    "id": req_id,
-                    "method": "DELETE",
-                    "url": f"/me/messages/{encoded_mid}",
-                })
-
-            payload = {"requests": requests_payload}
-            response = OutlookMailHandler._graph_request_json("POST", access_token, batch_url, payload=payload)
-            for item in response.get("responses", []):
-                req_id = str(item.get("id", ""))
-                mid = reqid_to_mid.get(req_id)
-                if not mid:
-                    continue
-                status = int(item.get("status") or 0)
-                # 404 means already deleted remotely, treat as success for idempotency.
-                if 200 <= status < 300 or status == 404:
-                    deleted.append(mid)
-                else:
-                    failed.append({
-                        "message_id": mid,
-                        "status": status,
-                        "body": item.get("body"),
-                    })
+    @staticmethod
+    def mark_messages_read_batch(access_token, message_ids, is_read=True):
+        """
+        通过 $batch 批量设置邮件已读/未读
 
-        return {"deleted": deleted, "failed": failed}
+        Returns:
+            dict: {'updated': [message_id], 'failed': [{message_id, status, body}]}
+        """
+        normalized = OutlookMailHandler._normalize_message_ids(message_ids)
+        if not normalized:
+            return {"updated": [], "failed": []}
+
+        results = OutlookMailHandler._graph_batch(access_token, [
+            {
+                "method": "PATCH",
+                "url": f"/me/messages/{OutlookMailHandler._graph_path_id(mid)}",
+                "body": {"isRead": bool(is_read)},
+            }
+            for mid in normalized
+        ])
+        updated = []
+        failed = []
+        for mid, item in zip(normalized, results):
+            if 200 <= item["status"] < 300:
+                updated.append(mid)
+            else:
+                failed.append({"message_id": mid, "status": item["status"], "body": item.get("body")})
+        return {"updated": updated, "failed": failed}
 
     @staticmethod
     def _to_graph_recipients(items):
@@ -719,18 +899,9 @@ class OutlookMailHandler:
         return True
 
     @staticmethod
-    def fetch_emails_graph(email_address, access_token, callback=None, last_check_time=None):
-        """閫氳繃 Microsoft Graph 鎷夊彇 Outlook/Hotmail 閭欢"""
-        mail_records = []
-        if callback is None:
-            callback = lambda progress, folder: None
-
-        last_check_time = normalize_check_time(last_check_time)
-        if not last_check_time:
-            last_check_time = datetime.datetime.utcnow() - datetime.timedelta(days=60)
-        since_iso = last_check_time.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
-
-        folders = OutlookMailHandler._graph_list_folders(access_token)
+    def _graph_select_folders(token, cancel=None):
+        """列出需要同步的文件夹（收件箱、垃圾邮件、已发送）"""
+        folders = OutlookMailHandler._graph_list_folders(token, cancel)
         if not folders:
             folders = [
                 {"id": "inbox", "displayName": "Inbox", "wellKnownName": "inbox"},
@@ -754,7 +925,8 @@ class OutlookMailHandler:
                 ("junkemail", "Junk Email"),
                 ("sentitems", "Sent Items"),
             ):
-                if fid not in existing_keys:
+                # 列表中已有同名文件夹时不再追加别名，避免同一文件夹同步两次
+                if fid not in existing_keys and dname.lower() not in existing_keys:
                     folders.append({"id": fid, "displayName": dname, "wellKnownName": fid})
 
         allowed_names = {
@@ -774,106 +946,456 @@ class OutlookMailHandler:
 
         folders = [f for f in folders if _folder_allowed(f)]
         logger.info(f"Graph已选择文件夹: {[(f.get('displayName'), f.get('wellKnownName')) for f in folders]}")
+        return folders
+
+    @staticmethod
+    def _graph_folder_counts(token, folders, cancel=None):
+        """
+        通过 $batch 获取缓存文件夹当前的邮件数和未读数
+
+        Returns:
+            list: 带最新计数的文件夹；任一文件夹已不存在（404）时返回 None
+        """
+        responses = OutlookMailHandler._graph_batch(token, [
+            {
+                "method": "GET",
+                "url": f"/me/mailFolders/{OutlookMailHandler._graph_path_id(f['id'])}?$select=id,displayName,totalItemCount,unreadItemCount",
+            }
+            for f in folders
+        ], cancel=cancel)
+        result = []
+        for folder, item in zip(folders, responses):
+            if item["status"] == 404:
+                logger.info(f"Graph文件夹 {folder.get('displayName')} 已不存在，重新获取文件夹列表")
+                return None
+            body = item.get("body") if 200 <= item["status"] < 300 else None
+            current = dict(folder)
+            if body:
+                current["totalItemCount"] = body.get("totalItemCount")
+                current["unreadItemCount"] = body.get("unreadItemCount")
+            result.append(current)
+        return result
+
+    @staticmethod
+    def _graph_folder_catalog(token, account_id=None, cancel=None):
+        """
+        获取需要同步的文件夹及其计数，文件夹列表按邮箱缓存 GRAPH_FOLDER_CACHE_TTL 秒
+
+        缓存命中时只需一次 $batch 刷新计数；某个文件夹返回 404 时作废缓存并重新列出。
+        """
+        if account_id is not None:
+            with _folder_catalog_lock:
+                entry = _folder_catalog.get(account_id)
+            if entry and entry["expires_at"] > time.monotonic():
+                folders = OutlookMailHandler._graph_folder_counts(token, entry["folders"], cancel)
+                if folders is not None:
+                    return folders
+                OutlookMailHandler.invalidate_folder_catalog(account_id)
+
+        folders = OutlookMailHandler._graph_select_folders(token, cancel)
+        if account_id is not None and folders:
+            cached = [
+                {key: f.get(key) for key in ("id", "displayName", "wellKnownName")}
+                for f in folders if f.get("id")
+            ]
+            with _folder_catalog_lock:
+                _folder_catalog[account_id] = {"folders": cached, "expires_at": time.monotonic() + GRAPH_FOLDER_CACHE_TTL}
+        return folders
 
-        total_folders = len(folders)
-        for idx, folder in enumerate(folders):
+    @staticmethod
+    def invalidate_folder_catalog(account_id):
+        with _folder_catalog_lock:
+            _folder_catalog.pop(account_id, None)
+
+    @staticmethod
+    def _folder_unchanged(folder, state):
+        """文件夹计数与上次同步完成时一致，且距上次查询未超过 GRAPH_FOLDER_RECHECK_SECONDS"""
+        if not state or not state.get("delta_link") or state.get("next_link"):
+            return False
+        total, unread = folder.get("totalItemCount"), folder.get("unreadItemCount")
+        if total is None or unread is None:
+            return False
+        if state.get("total_count") != total or state.get("unread_count") != unread:
+            return False
+        try:
+            checked_at = datetime.datetime.strptime(str(state.get("updated_at")), "%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError):
+            return False
+        return (datetime.datetime.utcnow() - checked_at).total_seconds() < GRAPH_FOLDER_RECHECK_SECONDS
+
+    @staticmethod
+    def _graph_list_attachments_batch(token, message_ids, cancel=None):
+        """
+        通过 $batch 获取一组邮件（最多20封）的附件元数据，不下载附件内容
+
+        Returns:
+            dict: {message_id: [{'filename', 'content_type', 'size', 'remote_ref'}]}
+        """
+        result = {}
+        try:
+            responses = OutlookMailHandler._graph_batch(token, [
+                {
+                    "method": "GET",
+                    "url": f"/me/messages/{OutlookMailHandler._graph_path_id(mid)}/attachments?$top=50&$select={OutlookMailHandler.GRAPH_ATTACHMENT_SELECT}",
+                }
+                for mid in message_ids
+            ], cancel=cancel)
+            for mid, item in zip(message_ids, responses):
+                if not 200 <= item["status"] < 300:
+                    logger.warning(f"获取Graph附件列表失败，message={mid}, status={item['status']}")
+                    continue
+                body = item.get("body") or {}
+                attachments = list(body.get("value", []))
+                next_link = body.get("@odata.nextLink")
+                while next_link:
+                    payload = OutlookMailHandler._graph_request(token, next_link, params=None, cancel=cancel)
+                    attachments.extend(payload.get("value", []))
+                    next_link = payload.get("@odata.nextLink")
+
+                remote_attachments = []
+                for att in attachments:
+                    # 仅处理 fileAttachment（暂不处理 item/reference 附件）
+                    if att.get("@odata.type", OutlookMailHandler.GRAPH_FILE_ATTACHMENT) != OutlookMailHandler.GRAPH_FILE_ATTACHMENT:
+                        continue
+                    if not att.get("id"):
+                        continue
+                    remote_attachments.append({
+                        "filename": att.get("name") or "attachment.bin",
+                        "content_type": att.get("contentType") or "application/octet-stream",
+                        "size": int(att.get("size") or 0),
+                        "remote_ref": {"provider": "graph", "message_id": mid, "attachment_id": att["id"]},
+                    })
+                result[mid] = remote_attachments
+        except SyncCancelled:
+            raise
+        except Exception as e:
+            logger.warning(f"批量获取Graph附件列表失败，messages={len(message_ids)}: {e}")
+        return result
+
+    @staticmethod
+    def fetch_message_bodies(access_token, message_ids):
+        """
+        通过 $batch 获取邮件正文
+
+        Returns:
+            dict: {message_id: 正文内容}，获取失败的邮件不在结果中；令牌被拒绝时抛出 HTTPError(401)
+        """
+        message_ids = OutlookMailHandler._normalize_message_ids(message_ids)
+        responses = OutlookMailHandler._graph_batch(access_token, [
+            {"method": "GET", "url": f"/me/messages/{OutlookMailHandler._graph_path_id(mid)}?$select=body"}
+            for mid in message_ids
+        ])
+        bodies = {}
+        for mid, item in zip(message_ids, responses):
+            if item["status"] == 401:
+                response = requests.Response()
+                response.status_code = 401
+                raise requests.exceptions.HTTPError("Graph access token rejected", response=response)
+            if 200 <= item["status"] < 300:
+                bodies[mid] = ((item.get("body") or {}).get("body") or {}).get("content") or ""
+            else:
+                logger.warning(f"获取Graph邮件正文失败，message={mid}, status={item['status']}")
+        return bodies
+
+    @staticmethod
+    def download_attachment(access_token, remote_ref, fileobj, cancel=None):
+        """
+        通过 /attachments/{id}/$value 把附件内容分块写入 fileobj，不在内存中保留整个附件
+
+        Returns:
+            int: 写入的字节数
+        """
+        message_id = OutlookMailHandler._graph_path_id(remote_ref["message_id"])
+        attachment_id = OutlookMailHandler._graph_path_id(remote_ref["attachment_id"])
+        url = f"{OutlookMailHandler.GRAPH_BASE_URL}/me/messages/{message_id}/attachments/{attachment_id}/$value"
+        headers = {"Authorization": f"Bearer {access_token}"}
+        backoff = 1
+        for _ in range(5):
+            cancellation.check(cancel)
+            graph_governor.acquire(access_token, cancel)
+            with _graph_slots:
+                resp = http_session.get(url, headers=headers, stream=True,
+                                        timeout=cancellation.timeout(cancel, 30))
+                try:
+                    graph_governor.record(access_token, resp.status_code, resp.headers.get("Retry-After"))
+                    if resp.status_code < 400:
+                        written = 0
+                        for chunk in resp.iter_content(chunk_size=OutlookMailHandler.GRAPH_DOWNLOAD_CHUNK_SIZE):
+                            cancellation.check(cancel)
+                            if chunk:
+                                fileobj.write(chunk)
+                                written += len(chunk)
+                        return written
+                    # 读完错误响应体，连接可以放回连接池
+                    resp.content
+                finally:
+                    resp.close()
+            if resp.status_code in OutlookMailHandler.GRAPH_RETRY_STATUS:
+                if resp.status_code not in OutlookMailHandler.GRAPH_THROTTLE_STATUS:
+                    cancellation.sleep(cancel, min(backoff, 30))
+                    backoff *= 2
+                continue
+            logger.error(f"Graph附件下载失败: status={resp.status_code}, url={url}")
+            resp.raise_for_status()
+        resp.raise_for_status()
+
+    @staticmethod
+    def _graph_message_to_record(msg, folder_name, remote_attachments=None):
+        """把 Graph 邮件转换为邮件记录，附件只带元数据，首次下载时再获取内容"""
+        sender = ""
+        sender_obj = msg.get("from") or {}
+        sender_addr = (sender_obj.get("emailAddress") or {}).get("address")
+        if sender_addr:
+            sender = sender_addr
+        recipient = ", ".join(
+            (r.get("emailAddress") or {}).get("address", "").strip()
+            for r in (msg.get("toRecipients") or [])
+            if (r.get("emailAddress") or {}).get("address")
+        )
+
+        received_time = msg.get("receivedDateTime")
+        try:
+            received_dt = datetime.datetime.fromisoformat(received_time.replace("Z", "+00:00"))
+        except Exception:
+            received_dt = datetime.datetime.utcnow()
+
+        remote_attachments = remote_attachments or []
+        # preview 模式下只有 bodyPreview，先保存摘要，正文稍后获取
+        body_loaded = "body" in msg or "bodyPreview" not in msg
+        if body_loaded:
+            content = (msg.get("body") or {}).get("content") or ""
+        else:
+            content = msg.get("bodyPreview") or ""
+        return {
+            "subject": msg.get("subject") or "(无主题)",
+            "sender": sender or "(未知发件人)",
+            "recipient": recipient,
+            "received_time": received_dt,
+            "content": content,
+            "body_loaded": body_loaded,
+            "folder": folder_name,
+            "is_read": bool(msg.get("isRead", True)),
+            "graph_message_id": msg.get("id"),
+            "has_attachments": bool(remote_attachments) or bool(msg.get("hasAttachments")),
+            "full_attachments": [],
+            "remote_attachments": remote_attachments,
+        }
+
+    @staticmethod
+    def iter_sync_pages(access_token, folder_states=None, known_ids=None, callback=None, last_check_time=None, account_id=None, cancel=None):
+        """
+        通过 delta 查询增量同步各文件夹，按页产出结果
+
+        各文件夹在后台线程中并行拉取，结果经有界队列交给调用方逐页入库，内存占用与邮箱大小无关。
+
+        Args:
+            access_token: 访问令牌
+            folder_states: 上次同步保存的状态 {folder_id: {'delta_link', 'next_link'}}
+            known_ids: 本地已保存的 Graph 消息ID，这些邮件只同步已读状态，不再下载正文和附件
+            callback: 进度回调 callback(progress, folder_name)
+            last_check_time: 从头同步的文件夹从该时间开始，默认最近60天
+            account_id: 邮箱ID，指定时使用该邮箱缓存的文件夹列表，并跳过计数未变化的文件夹
+            cancel: CancelToken，取消后在页之间抛出 SyncCancelled，不再等待后台线程中的请求
+
+        Yields:
+            dict: {'folder_id', 'folder_name', 'records': 新邮件, 'updates': {消息ID: {'is_read', 'folder'}},
+                   'removed': 本文件夹中已删除的消息ID, 'state': 本页处理完后应保存的文件夹状态}
+        """
+        folder_states = folder_states or {}
+        known_ids = set(known_ids or ())
+        known_lock = threading.Lock()
+        if callback is None:
+            callback = lambda progress, folder: None
+
+        last_check_time = normalize_check_time(last_check_time)
+        if not last_check_time:
+            last_check_time = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+        since_iso = last_check_time.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
+
+        pages = queue.Queue(maxsize=GRAPH_INGEST_QUEUE_SIZE)
+        stop = threading.Event()
+        done = object()
+
+        def _put(item):
+            # 调用方提前结束时不再阻塞在已满的队列上
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _build_page(items, folder_id, folder_name, attachment_executor):
+            updates = {}
+            removed = []
+            pending = []
+            with known_lock:
+                for msg in items:
+                    message_id = msg.get("id")
+                    if not message_id:
+                        continue
+                    if "@removed" in msg:
+                        removed.append(message_id)
+                        known_ids.discard(message_id)
+                    elif message_id in known_ids:
+                        updates[message_id] = {"is_read": bool(msg.get("isRead", True)), "folder": folder_name}
+                    else:
+                        known_ids.add(message_id)
+                        pending.append(msg)
+
+            # 带附件的新邮件每 20 封一组通过 $batch 获取附件元数据，各组并行
+            with_attachments = [msg.get("id") for msg in pending if msg.get("hasAttachments")]
+            groups = [
+                with_attachments[i:i + OutlookMailHandler.GRAPH_BATCH_SIZE]
+                for i in range(0, len(with_attachments), OutlookMailHandler.GRAPH_BATCH_SIZE)
+            ]
+            attachments = {}
+            for result in attachment_executor.map(
+                lambda group: OutlookMailHandler._graph_list_attachments_batch(access_token, group, cancel), groups
+            ):
+                attachments.update(result)
+
+            records = [
+                OutlookMailHandler._graph_message_to_record(msg, folder_name, attachments.get(msg.get("id")))
+                for msg in pending
+            ]
+            return {"folder_id": folder_id, "folder_name": folder_name, "records": records, "updates": updates, "removed": removed}
+
+        def _produce(folder, attachment_executor):
             folder_id = folder.get("id")
             folder_name = folder.get("displayName", folder_id)
-            if not folder_id:
-                continue
-            callback(10, folder_name)
-            messages = OutlookMailHandler._graph_list_messages(access_token, folder_id, since_iso)
-
-            for msg in messages:
-                sender = ""
-                sender_obj = msg.get("from") or {}
-                sender_addr = (sender_obj.get("emailAddress") or {}).get("address")
-                if sender_addr:
-                    sender = sender_addr
-                recipient = ", ".join(
-                    (r.get("emailAddress") or {}).get("address", "").strip()
-                    for r in (msg.get("toRecipients") or [])
-                    if (r.get("emailAddress") or {}).get("address")
-                )
+            state = folder_states.get(folder_id) or {}
+            if stop.is_set():
+                return
+            try:
+                for items, next_link, delta_link in OutlookMailHandler._iter_folder_pages(
+                    access_token, folder_id, folder_name, state, since_iso, cancel
+                ):
+                    if stop.is_set():
+                        return
+                    page = _build_page(items, folder_id, folder_name, attachment_executor)
+                    page["state"] = {
+                        "folder_id": folder_id,
+                        "folder_name": folder_name,
+                        # 中途保存 nextLink 以便中断后续传，最后一页保存新的 deltaLink
+                        "delta_link": delta_link or state.get("delta_link"),
+                        "next_link": next_link,
+                        "total_count": folder.get("totalItemCount"),
+                        "unread_count": folder.get("unreadItemCount"),
+                    }
+                    page["last"] = not next_link
+                    if not _put(page):
+                        return
+            except requests.exceptions.HTTPError as e:
+                if account_id is not None and getattr(e.response, "status_code", None) == 404:
+                    # 文件夹已被删除或移动，下一轮重新获取文件夹列表
+                    logger.warning(f"Graph文件夹 {folder_name} 不存在(HTTP 404)，已作废文件夹缓存")
+                    OutlookMailHandler.invalidate_folder_catalog(account_id)
+                else:
+                    _put(e)
+            except Exception as e:
+                _put(e)
+            finally:
+                _put(done)
+
+        folder_executor = concurrent.futures.ThreadPoolExecutor(max_workers=GRAPH_ACCOUNT_CONCURRENCY)
+        attachment_executor = concurrent.futures.ThreadPoolExecutor(max_workers=GRAPH_ACCOUNT_CONCURRENCY)
+        try:
+            # 文件夹列表同样在后台线程获取，服务器无响应时也能及时响应取消
+            catalog = cancellation.wait_result(cancel, folder_executor.submit(
+                OutlookMailHandler._graph_folder_catalog, access_token, account_id, cancel
+            ))
+            folders = [f for f in catalog if f.get("id")]
+            unchanged = [f for f in folders if OutlookMailHandler._folder_unchanged(f, folder_states.get(f["id"]))]
+            if unchanged:
+                logger.info(f"Graph文件夹无变化，跳过: {[f.get('displayName') for f in unchanged]}")
+                folders = [f for f in folders if f not in unchanged]
+            if not folders:
+                return
+
+            for folder in folders:
+                folder_executor.submit(_produce, folder, attachment_executor)
 
-                received_time = msg.get("receivedDateTime")
+            finished = 0
+            completed = 0
+            while finished < len(folders):
                 try:
-                    received_dt = datetime.datetime.fromisoformat(received_time.replace("Z", "+00:00"))
-                except Exception:
-                    received_dt = datetime.datetime.utcnow()
-
-                body = (msg.get("body") or {}).get("content") or ""
-                is_read = bool(msg.get("isRead", True))
-                graph_message_id = msg.get("id")
-                has_attachments = bool(msg.get("hasAttachments"))
-                full_attachments = []
-                if has_attachments and graph_message_id:
-                    try:
-                        attachments = OutlookMailHandler._graph_list_attachments(access_token, graph_message_id)
-                        for att in attachments:
-                            # 浠呭鐞?fileAttachment锛堟殏涓嶅鐞?item/reference 闄勪欢锛?
-                            if att.get("@odata.type") != "#microsoft.graph.fileAttachment":
-                                continue
-                            content_b64 = att.get("contentBytes")
-                            if not content_b64 and att.get("id"):
-                                try:
-                                    detail = OutlookMailHandler._graph_get_attachment(
-                                        access_token, graph_message_id, att.get("id")
-                                    )
-                                    if detail:
-                                        content_b64 = detail.get("contentBytes") or content_b64
-                                        att = {
-                                            **att,
-                                            "name": detail.get("name") or att.get("name"),
-                                            "contentType": detail.get("contentType") or att.get("contentType"),
-                                            "size": detail.get("size") or att.get("size"),
-                                        }
-                                except Exception as detail_error:
-                                    logger.warning(
-                                        "Fetch Graph attachment detail failed, message=%s attachment=%s err=%s",
-                                        graph_message_id,
-                                        att.get("id"),
-                                        detail_error,
-                                    )
-                            if not content_b64:
-                                continue
-                            try:
-                                content_bytes = base64.b64decode(content_b64)
-                            except Exception:
-                                logger.warning("瑙ｆ瀽Graph闄勪欢鍐呭澶辫触锛宮essage=%s", graph_message_id)
-                                continue
-                            full_attachments.append({
-                                "filename": att.get("name") or "attachment.bin",
-                                "content_type": att.get("contentType") or "application/octet-stream",
-                                "size": int(att.get("size") or len(content_bytes)),
-                                "content": content_bytes,
-                            })
-                    except Exception as e:
-                        logger.warning(f"鑾峰彇Graph闄勪欢澶辫触锛宮essage={graph_message_id}: {e}")
-                mail_records.append({
-                    "subject": msg.get("subject") or "(无主题)",
-                    "sender": sender or "(未知发件人)",
-                    "recipient": recipient,
-                    "received_time": received_dt,
-                    "content": body,
-                    "folder": folder_name,
-                    "is_read": is_read,
-                    "graph_message_id": graph_message_id,
-                    "has_attachments": bool(full_attachments) or has_attachments,
-                    "full_attachments": full_attachments,
-                })
-
-            progress = int(10 + ((idx + 1) / max(total_folders, 1)) * 80)
-            callback(progress, folder_name)
+                    item = pages.get(timeout=0.5)
+                except queue.Empty:
+                    cancellation.check(cancel)
+                    continue
+                cancellation.check(cancel)
+                if item is done:
+                    finished += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                if item.pop("last"):
+                    completed += 1
+                    callback(int(10 + (completed / len(folders)) * 80), item["folder_name"])
+                yield item
+        finally:
+            stop.set()
+            # 已取消时不等待阻塞在请求上的后台线程，它们在请求超时后自行退出
+            wait = not (cancel is not None and cancel.cancelled)
+            folder_executor.shutdown(wait=wait, cancel_futures=True)
+            attachment_executor.shutdown(wait=wait)
 
+    @staticmethod
+    def fetch_emails_graph(email_address, access_token, callback=None, last_check_time=None):
+        """通过 Microsoft Graph 拉取 last_check_time 之后的邮件（不保存增量状态）"""
+        mail_records = []
+        for page in OutlookMailHandler.iter_sync_pages(access_token, callback=callback, last_check_time=last_check_time):
+            mail_records.extend(page["records"])
         return mail_records
+
     @staticmethod
-    def check_mail(email_info, db, progress_callback=None):
+    def sync_mail_graph(email_info, db, access_token, callback=None, cancel=None):
+        """
+        增量同步邮箱：逐页保存新邮件、应用已读状态变化和删除，每页入库后保存同步进度
+
+        Returns:
+            dict: {'total': 新邮件数, 'saved': 新增入库数, 'synced': {'updated', 'deleted'}}
+        """
+        from .mail_processor import MailProcessor
+
+        email_id = email_info['id']
+        total = 0
+        saved_count = 0
+        synced = {'updated': 0, 'deleted': 0}
+        for page in OutlookMailHandler.iter_sync_pages(
+            access_token,
+            folder_states=db.get_graph_sync_states(email_id),
+            known_ids=db.get_graph_message_ids(email_id),
+            callback=callback,
+            account_id=email_id,
+            cancel=cancel
+        ):
+            records = page["records"]
+            if records:
+                total += len(records)
+                saved_count += MailProcessor.save_mail_records(db, email_id, records)
+
+            page_synced = db.sync_graph_message_changes(email_id, page["updates"], page["removed"], folder=page["folder_name"])
+            synced['updated'] += page_synced['updated']
+            synced['deleted'] += page_synced['deleted']
+
+            # 本页入库后再保存进度，中断后从下一页继续
+            db.save_graph_sync_states(email_id, [page["state"]])
+
+        if synced['updated'] or synced['deleted']:
+            logger.info(f"邮箱 {email_info.get('email')} 同步已读状态 {synced['updated']} 封，删除 {synced['deleted']} 封")
+        if GRAPH_BODY_MODE == "preview":
+            from .body_prefetch import body_prefetcher
+            body_prefetcher.schedule(db, email_info)
+        return {"total": total, "saved": saved_count, "synced": synced}
+
+    @staticmethod
+    def check_mail(email_info, db, progress_callback=None, cancel=None):
         """检查 Outlook/Hotmail 邮件并保存到数据库。"""
         email_id = email_info['id']
         email_address = email_info['email']
-        refresh_token = email_info['refresh_token']
-        client_id = email_info['client_id']
 
         logger.info(f"开始检查 Outlook 邮箱: ID={email_id}, 邮箱={email_address}")
 
@@ -883,14 +1405,14 @@ class OutlookMailHandler:
         progress_callback(0, "正在获取访问令牌...")
 
         try:
-            access_token = OutlookMailHandler.get_new_access_token(refresh_token, client_id)
+            from .token_cache import token_cache
+            access_token = token_cache.get_access_token(db, email_info)
             if not access_token:
                 error_msg = f"邮箱 {email_address}(ID={email_id}) 刷新访问令牌失败"
                 logger.error(error_msg)
                 progress_callback(0, error_msg)
                 return {'success': False, 'message': error_msg}
 
-            db.update_email_token(email_id, access_token)
             progress_callback(10, "开始获取邮件...")
 
             def folder_progress_callback(progress, folder):
@@ -899,47 +1421,9 @@ class OutlookMailHandler:
                 progress_callback(total_progress, msg)
 
             try:
-                mail_records = OutlookMailHandler.fetch_emails_graph(
-                    email_address,
-                    access_token,
-                    callback=folder_progress_callback,
-                    last_check_time=normalize_check_time(email_info.get('last_check_time'))
-                )
-
-                count = len(mail_records)
-                progress_callback(90, f"已获取 {count} 封邮件，正在保存...")
-
-                saved_count = 0
-                for record in mail_records:
-                    try:
-                        success, mail_id = db.add_mail_record(
-                            email_id,
-                            record['subject'],
-                            record['sender'],
-                            record['received_time'],
-                            record['content'],
-                            recipient=record.get('recipient'),
-                            is_read=1,
-                            graph_message_id=record.get('graph_message_id'),
-                            has_attachments=1 if record.get('has_attachments', False) else 0
-                        )
-                        if success and mail_id and record.get('has_attachments') and record.get('full_attachments'):
-                            for attachment in record.get('full_attachments', []):
-                                filename = attachment.get('filename')
-                                content = attachment.get('content')
-                                if not filename or not content:
-                                    continue
-                                db.add_attachment(
-                                    mail_id=mail_id,
-                                    filename=filename,
-                                    content_type=attachment.get('content_type') or 'application/octet-stream',
-                                    size=attachment.get('size') or len(content),
-                                    content=content
-                                )
-                        if success and mail_id:
-                            saved_count += 1
-                    except Exception as e:
-                        logger.error(f"保存邮件记录失败: {str(e)}")
+                sync_result = OutlookMailHandler.sync_mail_graph(email_info, db, access_token, folder_progress_callback, cancel)
+                count = sync_result['total']
+                saved_count = sync_result['saved']
 
                 try:
                     db.update_check_time(email_id)
@@ -36,7 +36,7 @@ class QQMailHandler(IMAPMailHandler):
         )
 
     @classmethod
-    def check_mail(cls, email_info, db, progress_callback=None):
+    def check_mail(cls, email_info, db, progress_callback=None, cancel=None):
         """检查QQ邮箱的邮件"""
         # 更新邮箱信息为QQ邮箱特定配置
         email_info['server'] = cls.SERVER
@@ -44,4 +44,4 @@ class QQMailHandler(IMAPMailHandler):
         email_info['use_ssl'] = cls.USE_SSL
 
         # 调用父类的检查方法
-        return super().check_mail(email_info, db, progress_callback)
\ No newline at end of file
+        return super().check_mail(email_info, db, progress_callback, cancel)
\ No newline at end of file
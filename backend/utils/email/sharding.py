@@ -0,0 +1,40 @@
+"""
+同步分片模块
+多个同步工作进程按邮箱ID的 crc32 哈希划分邮箱，每个邮箱只由一个分片同步
+"""
+
+import zlib
+
+
+def shard_of(email_id, count):
+    """邮箱所属的分片序号"""
+    return zlib.crc32(str(int(email_id)).encode()) % max(1, int(count))
+
+
+class Shard:
+    """当前进程负责的分片，index 从 0 开始"""
+
+    def __init__(self, index=0, count=1):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"无效的分片: {index}/{count}")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, spec):
+        """解析 'i/n' 形式的分片参数"""
+        try:
+            index, count = (int(part) for part in str(spec).split('/', 1))
+        except ValueError:
+            raise ValueError(f"分片参数格式应为 i/n: {spec}")
+        return cls(index, count)
+
+    @property
+    def is_all(self):
+        return self.count == 1
+
+    def owns(self, email_id):
+        return self.is_all or shard_of(email_id, self.count) == self.index
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
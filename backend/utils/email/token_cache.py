@@ -0,0 +1,185 @@
+"""
+Outlook访问令牌缓存模块
+按邮箱缓存 access_token 及其过期时间，临近过期才刷新；
+同一邮箱的并发调用共享一次刷新请求，微软轮换的 refresh_token 写回数据库
+"""
+
+import os
+import threading
+import time
+import logging
+
+from .outlook import OutlookMailHandler
+from .graph_throttle import governor as graph_governor
+
+logger = logging.getLogger(__name__)
+
+# 距离过期不足该秒数时提前刷新
+REFRESH_SKEW_SECONDS = int(os.environ.get('OUTLOOK_TOKEN_REFRESH_SKEW', '300'))
+
+# 刷新令牌已被吊销或过期，需要用户重新授权
+INVALID_GRANT = 'invalid_grant'
+
+
+class AccessTokenCache:
+    """进程内令牌缓存，数据库中的 access_token / token_expires_at 作为二级缓存"""
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._last_used = {}
+        self._lock = threading.Lock()
+
+    def _account_lock(self, email_id):
+        with self._lock:
+            lock = self._locks.get(email_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks[email_id] = lock
+            return lock
+
+    @staticmethod
+    def _is_fresh(entry, email_info):
+        if not entry or not entry.get('access_token') or not entry.get('expires_at'):
+            return False
+        # 刷新令牌或 client_id 变更后旧令牌不再可信；轮换前后的刷新令牌都视为同一凭据
+        if email_info.get('refresh_token') not in entry.get('refresh_tokens', ()) or entry.get('client_id') != email_info.get('client_id'):
+            return False
+        return entry['expires_at'] - REFRESH_SKEW_SECONDS > time.time()
+
+    def _lookup(self, db, email_info):
+        email_id = email_info['id']
+        with self._lock:
+            entry = self._entries.get(email_id)
+        if self._is_fresh(entry, email_info):
+            return entry['access_token']
+
+        # 进程重启后从数据库恢复
+        row = db.get_email_by_id(email_id) if db else None
+        if row:
+            entry = {
+                'access_token': row.get('access_token'),
+                'expires_at': row.get('token_expires_at'),
+                'refresh_tokens': {row.get('refresh_token')},
+                'client_id': row.get('client_id'),
+            }
+            with self._lock:
+                cached = self._entries.get(email_id)
+            if cached and cached.get('client_id') == entry['client_id']:
+                entry['refresh_tokens'] |= cached.get('refresh_tokens', set())
+            if self._is_fresh(entry, email_info):
+                with self._lock:
+                    self._entries[email_id] = entry
+                # 恢复的令牌同样计入所属 client_id 的限流预算
+                graph_governor.register_token(entry['access_token'], entry['client_id'])
+                return entry['access_token']
+        return None
+
+    def get_access_token(self, db, email_info, stale_token=None):
+        """
+        获取邮箱可用的访问令牌
+
+        Args:
+            db: 数据库实例
+            email_info: 邮箱信息，需包含 id、refresh_token、client_id
+            stale_token: 已被 Graph 拒绝（401）的令牌，缓存命中该令牌时强制刷新
+
+        Returns:
+            str: 访问令牌，失败返回 None
+        """
+        email_id = email_info['id']
+        with self._lock:
+            self._last_used[email_id] = time.time()
+        token = self._lookup(db, email_info)
+        if token and token != stale_token:
+            return token
+
+        with self._account_lock(email_id):
+            # 等锁期间其他线程可能已刷新完成
+            token = self._lookup(db, email_info)
+            if token and token != stale_token:
+                return token
+            return self._refresh_locked(db, email_info)
+
+    def refresh(self, db, email_info, min_ttl=0):
+        """
+        后台预刷新：令牌剩余有效期不足 min_ttl 秒时刷新，不计入邮箱的使用时间
+
+        Returns:
+            bool: 刷新后（或无需刷新时）邮箱是否有可用令牌
+        """
+        email_id = email_info['id']
+        with self._account_lock(email_id):
+            token = self._lookup(db, email_info)
+            if token:
+                with self._lock:
+                    entry = self._entries.get(email_id)
+                # 等锁期间用户请求可能已经刷新过
+                if entry and entry['expires_at'] - min_ttl > time.time():
+                    return True
+            return self._refresh_locked(db, email_info) is not None
+
+    def _refresh_locked(self, db, email_info):
+        """调用方需持有邮箱锁；以数据库中最新的刷新令牌换取访问令牌"""
+        email_id = email_info['id']
+        refresh_token = email_info.get('refresh_token')
+        client_id = email_info.get('client_id')
+        known_tokens = {refresh_token}
+        row = db.get_email_by_id(email_id) if db else None
+        if row:
+            if row.get('token_status') == INVALID_GRANT and row.get('refresh_token') == refresh_token:
+                logger.warning(f"邮箱 ID:{email_id} 的刷新令牌已失效，需要重新授权")
+                return None
+            # 调用方持有的可能是轮换前的旧令牌
+            if row.get('refresh_token') and row.get('client_id') == client_id:
+                refresh_token = row['refresh_token']
+                known_tokens.add(refresh_token)
+
+        result = OutlookMailHandler.refresh_access_token(refresh_token, client_id)
+        if not result or result.get('error'):
+            self.invalidate(email_id)
+            if result and result['error'] == INVALID_GRANT and db:
+                db.mark_email_token_invalid(email_id, INVALID_GRANT)
+            return None
+
+        expires_at = int(time.time()) + result['expires_in']
+        rotated = result.get('refresh_token')
+        if rotated and rotated != refresh_token:
+            known_tokens.add(rotated)
+        else:
+            rotated = None
+        entry = {
+            'access_token': result['access_token'],
+            'expires_at': expires_at,
+            'refresh_tokens': known_tokens,
+            'client_id': client_id,
+        }
+        with self._lock:
+            self._entries[email_id] = entry
+        if db:
+            db.update_email_token(email_id, result['access_token'], expires_at, refresh_token=rotated)
+        logger.debug(f"邮箱 ID:{email_id} 访问令牌已刷新，{result['expires_in']} 秒后过期{'，刷新令牌已轮换' if rotated else ''}")
+        return result['access_token']
+
+    def recently_used(self, seconds):
+        """最近 seconds 秒内通过 get_access_token 取过令牌的邮箱ID"""
+        cutoff = time.time() - seconds
+        with self._lock:
+            for email_id in [k for k, v in self._last_used.items() if v < cutoff]:
+                self._last_used.pop(email_id, None)
+            return list(self._last_used)
+
+    def invalidate(self, email_id, access_token=None):
+        """
+        作废缓存的令牌
+
+        指定 access_token 时仅在缓存仍是该令牌时作废，避免覆盖其他线程刚刷新的结果。
+        """
+        with self._lock:
+            entry = self._entries.get(email_id)
+            if entry and access_token and entry.get('access_token') != access_token:
+                return
+            self._entries.pop(email_id, None)
+
+
+token_cache = AccessTokenCache()
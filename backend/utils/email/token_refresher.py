@@ -0,0 +1,117 @@
+"""
+Outlook访问令牌预刷新模块
+后台为即将用到的 Outlook 邮箱（开启实时检查的用户的邮箱、最近使用过的邮箱）在过期前刷新令牌，
+刷新时间按邮箱ID打散并限制每分钟刷新次数，用户请求无需等待令牌刷新
+"""
+
+import os
+import math
+import threading
+import time
+import logging
+
+from .token_cache import token_cache
+
+logger = logging.getLogger(__name__)
+
+# 过期前多少秒开始预刷新
+REFRESH_AHEAD_SECONDS = int(os.environ.get('OUTLOOK_TOKEN_REFRESH_AHEAD', '900'))
+# 在预刷新时间点之前再按邮箱打散的最大秒数，避免同一时刻集中刷新
+REFRESH_SPREAD_SECONDS = int(os.environ.get('OUTLOOK_TOKEN_REFRESH_SPREAD', '600'))
+# 每分钟最多刷新次数
+REFRESH_PER_MINUTE = max(1, int(os.environ.get('OUTLOOK_TOKEN_REFRESH_PER_MINUTE', '30')))
+# 最近多少秒内使用过的邮箱也保持令牌有效
+KEEPALIVE_SECONDS = int(os.environ.get('OUTLOOK_TOKEN_KEEPALIVE', '3600'))
+# 调度间隔
+TICK_SECONDS = 15
+# 刷新失败（非 invalid_grant）后的重试退避上限
+MAX_RETRY_SECONDS = 1800
+
+
+class TokenRefreshScheduler:
+    """后台令牌预刷新线程"""
+
+    def __init__(self, db):
+        self.db = db
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._failures = {}
+        # 独立同步进程只刷新本分片的邮箱
+        self.shard = None
+        self.refreshed = 0
+        self.failed = 0
+
+    @staticmethod
+    def _due_at(account):
+        """邮箱的预刷新时间点，没有令牌记录时立即刷新"""
+        expires_at = account.get('token_expires_at')
+        if not expires_at:
+            return 0
+        offset = (int(account['id']) * 2654435761) % (REFRESH_SPREAD_SECONDS + 1)
+        return expires_at - REFRESH_AHEAD_SECONDS - offset
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return False
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name='token-refresher', daemon=True)
+        self._thread.start()
+        logger.info(f"令牌预刷新已启动，提前 {REFRESH_AHEAD_SECONDS} 秒刷新，每分钟最多 {REFRESH_PER_MINUTE} 次")
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"令牌预刷新出错: {str(e)}")
+            self._stop_event.wait(TICK_SECONDS)
+
+    def run_once(self, now=None):
+        """
+        刷新已到预刷新时间的邮箱，每轮最多刷新 TICK_SECONDS 对应的配额
+
+        Returns:
+            int: 本轮刷新成功的邮箱数
+        """
+        now = now or time.time()
+        accounts = self.db.get_token_refresh_candidates(token_cache.recently_used(KEEPALIVE_SECONDS))
+        if self.shard is not None:
+            accounts = [account for account in accounts if self.shard.owns(account['id'])]
+        due = []
+        for account in accounts:
+            failure = self._failures.get(account['id'])
+            if failure and failure[1] > now:
+                continue
+            due_at = self._due_at(account)
+            if due_at <= now:
+                due.append((due_at, account))
+        if not due:
+            return 0
+
+        due.sort(key=lambda item: (item[0], item[1]['id']))
+        budget = math.ceil(REFRESH_PER_MINUTE * TICK_SECONDS / 60)
+        refreshed = 0
+        for _, account in due[:budget]:
+            if self._stop_event.is_set():
+                break
+            email_id = account['id']
+            # 令牌若已被用户请求刷新过，剩余有效期足够时直接跳过
+            if token_cache.refresh(self.db, account, min_ttl=REFRESH_AHEAD_SECONDS + REFRESH_SPREAD_SECONDS):
+                self._failures.pop(email_id, None)
+                refreshed += 1
+            else:
+                count = self._failures.get(email_id, (0, 0))[0] + 1
+                self._failures[email_id] = (count, now + min(MAX_RETRY_SECONDS, 60 * 2 ** (count - 1)))
+                self.failed += 1
+                logger.warning(f"邮箱 {account.get('email')}(ID={email_id}) 预刷新令牌失败，第 {count} 次")
+        self.refreshed += refreshed
+        if len(due) > budget:
+            logger.info(f"令牌预刷新: 本轮刷新 {refreshed} 个，{len(due) - budget} 个顺延")
+        return refreshed
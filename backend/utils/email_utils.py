@@ -45,6 +45,7 @@ from .email import (
     MailProcessor,
     EmailBatchProcessor
 )
+from .email.lanes import route_for
 
 # 保持原有API兼容性
 __all__ = [
@@ -154,7 +155,8 @@ def check_realtime_emails():
                             )
                         
                         # 提交任务到线程池
-                        future = processor.realtime_thread_pool.submit(
+                        future = processor.realtime_thread_pool.submit_to(
+                            route_for(account),
                             processor._check_email_task,
                             account,
                             progress_callback
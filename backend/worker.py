@@ -0,0 +1,85 @@
+#  -*- coding: utf-8 -*-
+"""
+独立同步进程
+运行实时检查、同步任务队列和令牌预刷新，不提供 API。多个进程按分片划分邮箱，
+通过共享的 SQLite 数据库协调，不需要额外的消息队列：
+
+    SYNC_IN_PROCESS=0 python backend/app.py
+    python backend/worker.py --shard 0/2
+    python backend/worker.py --shard 1/2
+"""
+
+import os
+import argparse
+import logging
+import signal
+import threading
+from logging.handlers import RotatingFileHandler
+
+from database.db import Database
+from utils.email import EmailBatchProcessor
+from utils.email.sharding import Shard
+
+logger = logging.getLogger('FireMail.worker')
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='学在华邮件助手同步进程')
+    parser.add_argument('--shard', default=os.environ.get('SYNC_SHARD', '0/1'), help='负责的分片，格式 i/n，从 0 开始')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SYNC_WORKER_THREADS', '5')), help='同步线程数')
+    parser.add_argument('--check-interval', type=int, default=300, help='实时检查的基础间隔（秒）')
+    return parser.parse_args()
+
+
+def setup_logging(shard):
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f"worker-{shard.index}-of-{shard.count}.log")
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - [shard {shard}] %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            RotatingFileHandler(log_file, maxBytes=1 * 1024 * 1024, backupCount=3, encoding='utf-8'),
+            logging.StreamHandler()
+        ],
+        # 导入邮件模块时可能已创建默认日志处理器
+        force=True
+    )
+
+
+def main():
+    args = parse_args()
+    shard = Shard.parse(args.shard)
+    setup_logging(shard)
+
+    db = Database()
+    processor = EmailBatchProcessor(db, max_workers=args.workers)
+    processor.set_shard(shard)
+
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info(f"收到信号 {signum}，正在停止同步进程...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    processor.start_real_time_check(check_interval=args.check_interval)
+    processor.token_refresher.start()
+    logger.info(f"同步进程已启动: 分片 {shard}, 同步线程 {args.workers}, pid {os.getpid()}")
+
+    while not stop_event.wait(1):
+        pass
+
+    processor.stop_real_time_check()
+    processor.token_refresher.stop()
+    # 等待执行中的任务结束，超时未完成的放回队列，其他进程或重启后的本进程可立即领取
+    processor.job_worker.stop(grace=int(os.environ.get('SYNC_WORKER_STOP_GRACE', '30')))
+    processor.graph_subscriptions.cancel_all()
+    logger.info("同步进程已停止")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,6 @@ import asyncio
 import logging
 import websockets
 import jwt
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from utils.email.outlook import OutlookMailHandler
 
@@ -16,6 +15,7 @@ class WebSocketHandler:
         self.db = None
         self.email_processor = None
         self.port = 8765
+        self.loop = None  # WebSocket 服务器的事件循环，供其他线程推送消息
         self.clients = {}  # 连接的客户端 {websocket: user_id}
         self.user_sockets = {}  # 用户的连接 {user_id: set(websockets)}
         self.client_tokens = {}  # 存储客户端的认证信息
@@ -265,31 +265,14 @@ class WebSocketHandler:
                 }))
                 return
             
-            # 定义详细的进度回调函数
-            def progress_callback(email_id, progress, message):
-                # 获取邮箱信息用于更详细的日志
-                email_info = self.db.get_email_by_id(email_id)
-                email_address = email_info['email'] if email_info else f"ID:{email_id}"
-                
-                # 记录进度日志
-                if progress == 0:
-                    logger.info(f"开始检查邮箱 {email_address}")
-                elif progress == 100:
-                    logger.info(f"完成检查邮箱 {email_address}")
-                else:
-                    logger.info(f"邮箱 {email_address} 检查进度: {progress}% - {message}")
-                
-                # 发送进度更新到WebSocket
-                asyncio.run(self.send_progress_update(user_id, email_id, progress, message))
-            
-            # 启动检查邮箱任务
-            with ThreadPoolExecutor() as executor:
-                executor.submit(self.email_processor.check_emails, valid_ids, progress_callback)
+            # 创建检查任务，进度和结果通过 send_to_user_threadsafe 推送
+            job = self.email_processor.start_check_job(user_id, valid_ids, 'batch' if len(valid_ids) > 1 else 'single')
             
             # 发送开始检查的消息
             await websocket.send(json.dumps({
                 'type': 'success',
-                'message': f'开始检查 {len(valid_ids)} 个邮箱'
+                'message': f'开始检查 {len(valid_ids)} 个邮箱',
+                'job_id': job['id']
             }))
             
             logger.info(f"开始检查邮箱: {valid_ids} (用户ID: {user_id})")
@@ -540,6 +523,13 @@ class WebSocketHandler:
         
         return success_count > 0
     
+    def send_to_user_threadsafe(self, user_id, message):
+        """从非事件循环线程（如同步线程池）向用户推送消息"""
+        if self.loop is None or not self.loop.is_running() or user_id not in self.user_sockets:
+            return False
+        asyncio.run_coroutine_threadsafe(self.broadcast_to_user(user_id, message), self.loop)
+        return True
+    
     async def broadcast_emails_deleted(self, email_ids):
         """向所有连接的客户端广播邮箱已删除的消息"""
         message = json.dumps({
@@ -793,6 +783,7 @@ class WebSocketHandler:
         # 创建事件循环
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        self.loop = loop
         
         # 启动WebSocket服务器
         start_server = websockets.serve(
@@ -44,6 +44,29 @@ caddy run --config /app/Caddyfile &
 
 # 启动Python后端应用
 cd /app
+
+# SYNC_WORKERS 大于 0 时邮件同步放到独立进程，按分片划分邮箱，Web 进程只处理 API
+export SYNC_WORKERS="${SYNC_WORKERS:-0}"
+# 同步进程退出后自动重启，避免某个分片的邮箱停止同步
+run_sync_worker() {
+    while true; do
+        echo "启动同步进程: 分片 $1"
+        python3 ./backend/worker.py --shard "$1" && status=0 || status=$?
+        echo "同步进程已退出: 分片 $1, 退出码 $status, ${SYNC_WORKER_RESTART_DELAY}秒后重启"
+        sleep "$SYNC_WORKER_RESTART_DELAY"
+    done
+}
+
+if [ "$SYNC_WORKERS" -gt 0 ]; then
+    export SYNC_IN_PROCESS=0
+    SYNC_WORKER_RESTART_DELAY="${SYNC_WORKER_RESTART_DELAY:-5}"
+    i=0
+    while [ "$i" -lt "$SYNC_WORKERS" ]; do
+        run_sync_worker "$i/$SYNC_WORKERS" &
+        i=$((i + 1))
+    done
+fi
+
 echo "启动后端服务..."
 exec python3 ./backend/app.py --host "$HOST" --port "$FLASK_PORT" --ws-port "$WS_PORT"
 
@@ -322,6 +322,7 @@ const apiMethods = {
       }
       return api.get('/mail_records', { params }).then(res => res.data);
     },
+    getMail: (mailId) => api.get(`/mail_records/${mailId}`).then(res => res.data),
     getAttachments: (mailId) => api.get(`/mail_records/${mailId}/attachments`).then(res => res.data),
     markRead: (mailId) => api.post(`/mail_records/${mailId}/mark-read`).then(res => res.data),
     setTag: (mailId, tag) => api.post(`/mail_records/${mailId}/tag`, { tag }).then(res => res.data),
@@ -345,6 +346,7 @@ const apiMethods = {
       }
     },
     recheckAll: (emailId) => api.post(`/emails/${emailId}/recheck_all`, null, { timeout: 60000 }).then(res => res.data),
+    getCheckJob: (jobId) => api.get(`/check_jobs/${jobId}`).then(res => res.data),
     delete: (emailIds) => {
       if (Array.isArray(emailIds) && emailIds.length === 1) {
         return api.delete(`/emails/${emailIds[0]}`);
@@ -14,6 +14,7 @@ const MessageTypes = {
 
   EMAILS_LIST: 'emails_list',
   CHECK_PROGRESS: 'check_progress',
+  CHECK_JOB: 'check_job',
   EMAILS_IMPORTED: 'emails_imported',
   EMAILS_DELETED: 'emails_deleted',
   EMAIL_ADDED: 'email_added',
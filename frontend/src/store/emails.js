@@ -81,6 +81,18 @@ export const useEmailsStore = defineStore('emails', {
         }
       });
 
+      // 检查任务结束，各邮箱的最终结果（含失败原因）
+      websocket.onMessage('check_job', (data) => {
+        const results = Array.isArray(data?.job?.results) ? data.job.results : [];
+        results.forEach(({ email_id, message }) => {
+          this.processingEmails[email_id] = { progress: 100, message };
+        });
+        this.fetchEmails().catch((e) => console.error('fetchEmails after check_job failed:', e));
+        if (results.some(({ email_id }) => email_id === this.currentEmailId)) {
+          this.fetchMailRecords(this.currentEmailId).catch((e) => console.error('fetchMailRecords after check_job failed:', e));
+        }
+      });
+
       websocket.onMessage('mail_records', (data) => {
         if (!data || Number(data.email_id) !== Number(this.currentEmailId)) return;
         const records = Array.isArray(data.data) ? data.data : [];